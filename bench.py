@@ -0,0 +1,345 @@
+#Benchmark suite for the board routes. Seeds a database with synthetic users
+#and cards, drives the routes through the Flask test client and through a
+#multi-threaded HTTP load generator, and reports latency percentiles,
+#throughput and SQL statements per request. Results can be saved as a JSON
+#baseline and compared with a later run, for instance:
+#
+#   python bench.py --users 10000 --cards 1000000 --save before.json
+#   python bench.py --users 10000 --cards 1000000 --compare before.json
+#
+#Seeding and every request are driven by --seed, so two runs with the same
+#arguments send the same requests against the same board
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import secrets
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+from werkzeug.serving import WSGIRequestHandler, make_server
+import kanban
+from kanban import app, db
+
+####################################################################
+# Seeding Section
+####################################################################
+BENCH_PASSWORD = "benchmark"
+BENCH_SALT = "benchmark-salt"
+WORDS = ("fix", "write", "review", "deploy", "release", "design", "test", "refactor", "report", "meeting",
+         "invoice", "customer", "bug", "feature", "backlog", "sprint", "docs", "server", "database", "login")
+#Share of the cards seeded in each default column
+COLUMN_WEIGHTS = (("todo", 5), ("doing", 3), ("done", 2))
+#Rows inserted per executemany while seeding
+SEED_CHUNK_SIZE = 10000
+
+#A user driven by the benchmark, with some of its card ids to move and delete
+BenchUser = namedtuple('BenchUser', 'id name cards')
+
+#Fills a fresh database with `users` users and `cards` cards spread evenly
+#over them. All users share one password hash, so seeding does not spend
+#its time hashing
+def seedDatabase(users, cards, seed=1, log=print):
+    rng = random.Random(seed)
+    db.session.remove()
+    db.drop_all()
+    kanban.dbHelper()
+    pwhash = kanban.hasher.hash(BENCH_PASSWORD + BENCH_SALT)
+    for start in range(0, users, SEED_CHUNK_SIZE):
+        db.session.execute(kanban.User.__table__.insert(), [
+            dict(id=i + 1, username="user%d" % (i + 1), passwordHash=pwhash, passwordSalt=BENCH_SALT)
+            for i in range(start, min(start + SEED_CHUNK_SIZE, users))])
+        db.session.commit()
+    #Users come in without the ORM, so their personal boards, numbered like
+    #them, are added in bulk
+    kanban.addPersonalBoards()
+    names = [name for name, weight in COLUMN_WEIGHTS for i in range(weight)]
+    last = dict()
+    for start in range(0, cards, SEED_CHUNK_SIZE):
+        rows = list()
+        for i in range(start, min(start + SEED_CHUNK_SIZE, cards)):
+            userid = i % users + 1
+            typeid = kanban.workflow.typeId(rng.choice(names))
+            position = last[(userid, typeid)] = kanban.positionBetween(last.get((userid, typeid)), None)
+            text = "%s %s %d" % (rng.choice(WORDS), rng.choice(WORDS), i)
+            rows.append(dict(text=text, userid=userid, boardid=userid, type=typeid, position=position))
+        db.session.execute(kanban.Todo.__table__.insert(), rows)
+        db.session.commit()
+        log("Seeded %d of %d cards" % (start + len(rows), cards))
+    kanban.repairCounters()
+
+#Picks the users the benchmark logs in as, with up to 500 of their cards
+def pickUsers(count, seed=1):
+    users = db.session.query(kanban.User.id, kanban.User.username).order_by(kanban.User.id).all()
+    picked = random.Random(seed).sample(users, min(count, len(users)))
+    return [BenchUser(userid, name, [i for i, in db.session.query(kanban.Todo.id)
+                                      .filter(kanban.Todo.boardid==userid).limit(500)])
+            for userid, name in picked]
+
+
+####################################################################
+# Clients Section
+####################################################################
+#Both clients send a request and return its status code. Redirects are
+#not followed, so every request measured is exactly one request
+class TestClientSession(object):
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+class NoRedirects(HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+class HttpSession(object):
+    def __init__(self, url):
+        self.url = url
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirects())
+
+    def request(self, method, path, data=None):
+        body = urlencode(data, doseq=True).encode() if data is not None else None
+        try:
+            with self.opener.open(self.url + path, data=body, timeout=60) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            error.read()
+            return error.code
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+#Serves the app on a free local port from a thread, like a single
+#multi-threaded worker process
+class BenchServer(object):
+    def __init__(self):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+####################################################################
+# Scenarios Section
+####################################################################
+#Every scenario gives the request to measure as (method, path, form data),
+#after doing any untimed preparation with the session. The endpoint names
+#the route, to read its SQL statements from the app metrics
+def loginRequest(session, user, rng):
+    session.request('GET', '/logout')
+    return 'POST', '/login', dict(username=user.name, password=BENCH_PASSWORD)
+
+def moveRequest(session, user, rng):
+    return 'POST', '/todo', {"button": "Move task to next stage", "todotask": rng.sample(user.cards, min(5, len(user.cards)))}
+
+def deleteRequest(session, user, rng):
+    cards = [user.cards.pop(rng.randrange(len(user.cards)))] if user.cards else []
+    return 'POST', '/todo', {"button": "Delete task", "todotask": cards}
+
+SCENARIOS = OrderedDict([
+    ("login", ("login", loginRequest)),
+    ("index", ("index", lambda session, user, rng: ('GET', '/', None))),
+    ("board", ("boardJson", lambda session, user, rng: ('GET', '/board', None))),
+    ("add", ("addtodo", lambda session, user, rng: ('POST', '/addTodoTask', dict(todoitem="bench %d" % rng.randrange(10 ** 6))))),
+    ("move", ("todo", moveRequest)),
+    ("search", ("search", lambda session, user, rng: ('GET', '/search?q=%s' % rng.choice(WORDS), None))),
+    ("delete", ("todo", deleteRequest)),
+])
+
+
+####################################################################
+# Runner Section
+####################################################################
+#Nearest-rank percentile of sorted values
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values), max(1, math.ceil(fraction * len(values)))) - 1]
+
+#Sends `requests` requests of one scenario from `threads` threads, each
+#thread using its own share of the logged in sessions
+def runScenario(name, sessions, requests, threads, seed=1):
+    endpoint, build = SCENARIOS[name]
+    latencies = list()
+    errors = [0]
+    lock = threading.Lock()
+    def worker(index):
+        rng = random.Random("%s-%s-%d" % (seed, name, index))
+        mine = sessions[index::threads] or sessions
+        for i in range(index, requests, threads):
+            session, user = mine[(i // threads) % len(mine)]
+            method, path, data = build(session, user, rng)
+            start = time.perf_counter()
+            status = session.request(method, path, data)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += status >= 400
+    kanban.metrics.reset()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    wall = time.perf_counter() - start
+    statements, total = kanban.metrics.totals('kanban_request_sql_statements', endpoint=endpoint)
+    latencies.sort()
+    milliseconds = lambda value: round(value * 1000, 3) if value is not None else None
+    return OrderedDict([
+        ("requests", len(latencies)),
+        ("errors", errors[0]),
+        ("p50_ms", milliseconds(percentile(latencies, 0.50))),
+        ("p95_ms", milliseconds(percentile(latencies, 0.95))),
+        ("p99_ms", milliseconds(percentile(latencies, 0.99))),
+        ("throughput_rps", round(len(latencies) / wall, 1) if wall else None),
+        ("sql_per_request", round(total / statements, 2) if statements else None),
+    ])
+
+#Logs every picked user in through the given session factory
+def openSessions(users, factory):
+    sessions = list()
+    for user in users:
+        session = factory()
+        session.request('POST', '/login', dict(username=user.name, password=BENCH_PASSWORD))
+        sessions.append((session, user))
+    return sessions
+
+#Runs the chosen scenarios with one kind of client, returning their results
+def runMode(mode, users, scenarios, requests, threads, seed=1, log=print):
+    server = BenchServer() if mode == "http" else None
+    factory = (lambda: HttpSession(server.url)) if server else TestClientSession
+    try:
+        sessions = openSessions(users, factory)
+        results = OrderedDict()
+        for name in scenarios:
+            results[name] = runScenario(name, sessions, requests, threads if server else 1, seed)
+            log(formatRow(mode, name, results[name]))
+        return results
+    finally:
+        if server:
+            server.stop()
+
+
+####################################################################
+# Report Section
+####################################################################
+COLUMNS = ("requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput_rps", "sql_per_request")
+
+def formatRow(mode, name, result):
+    return "%-7s %-8s" % (mode, name) + "".join("%16s" % result[column] for column in COLUMNS)
+
+def formatHeader():
+    return "%-7s %-8s" % ("mode", "scenario") + "".join("%16s" % column for column in COLUMNS)
+
+#What the numbers were measured on, saved with them
+def environment(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([
+        ("date", datetime.datetime.utcnow().isoformat() + "Z"),
+        ("commit", commit),
+        ("python", platform.python_version()),
+        ("sqlite", sqlite3.sqlite_version),
+        ("platform", platform.platform()),
+        ("users", args.users), ("cards", args.cards), ("seed", args.seed),
+        ("requests", args.requests), ("threads", args.threads), ("production", args.production),
+    ])
+
+#Compares two runs scenario by scenario. A scenario regressed when its p95
+#latency grew by more than `tolerance` (0.2 is 20%) or when it issues more
+#SQL statements per request than before. Returns the regressions found
+def compareResults(baseline, current, tolerance=0.2):
+    regressions = list()
+    for mode, scenarios in current.items():
+        for name, result in scenarios.items():
+            before = baseline.get(mode, {}).get(name)
+            if not before:
+                continue
+            if before["p95_ms"] and result["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append("%s %s: p95 %.1f ms -> %.1f ms" % (mode, name, before["p95_ms"], result["p95_ms"]))
+            if before["sql_per_request"] is not None and result["sql_per_request"] is not None \
+                    and result["sql_per_request"] > before["sql_per_request"] + 0.5:
+                regressions.append("%s %s: %.2f -> %.2f SQL statements per request"
+                                   % (mode, name, before["sql_per_request"], result["sql_per_request"]))
+    return regressions
+
+
+####################################################################
+# Runs the benchmark
+####################################################################
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the kanban board routes")
+    parser.add_argument('--users', type=int, default=1000, help="users to seed")
+    parser.add_argument('--cards', type=int, default=100000, help="cards to seed, spread over the users")
+    parser.add_argument('--database', default='bench.db', help="SQLite file to seed and run against")
+    parser.add_argument('--reuse', action='store_true', help="run against the database of a previous run")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sessions', type=int, default=20, help="users logged in during the run")
+    parser.add_argument('--requests', type=int, default=500, help="requests per scenario and mode")
+    parser.add_argument('--threads', type=int, default=8, help="load generator threads in http mode")
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='both')
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS), help="comma separated, from %s" % ", ".join(SCENARIOS))
+    parser.add_argument('--production', action='store_true', help="use the SQLite production profile")
+    parser.add_argument('--save', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="compare with the results saved in this file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="p95 growth allowed by --compare")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArguments(argv)
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        sys.exit("Unknown scenarios: %s" % ", ".join(unknown))
+    #Every simulated user sends from the same address, faster than the rate
+    #limits allow a real client, and background work would skew the timings.
+    #seedDatabase() sets the database up itself
+    kanban.create_app(dict(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.abspath(args.database),
+                           SECRET_KEY=secrets.token_hex(16), SESSION_TYPE='cookie',
+                           SQLITE_PRODUCTION=args.production, WRITE_COALESCING=args.production,
+                           RATE_LIMIT_ENABLED=False, BACKGROUND_TASKS=False,
+                           INIT_DATABASE=False))
+    if not args.reuse:
+        seedDatabase(args.users, args.cards, args.seed)
+    users = pickUsers(args.sessions, args.seed)
+    results = OrderedDict()
+    print(formatHeader())
+    for mode in (('client', 'http') if args.mode == 'both' else (args.mode,)):
+        results[mode] = runMode(mode, users, scenarios, args.requests, args.threads, args.seed)
+    report = OrderedDict([("environment", environment(args)), ("results", results)])
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as saved:
+            regressions = compareResults(json.load(saved)["results"], results, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+        print("No regressions against %s" % args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from wtforms import Form, BooleanField, TextField, PasswordField, validators
 import os
+import json
+import bisect
+import io
+import csv
+import codecs
+import re
+import math
+import queue
+import threading
+import multiprocessing
+import atexit
+import time
+import datetime
+import logging
+import sqlite3
+import socket
+import secrets
+import hashlib
+import gzip
+import mimetypes
+from urllib.parse import urlparse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import CallbackDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
 import bcrypt
+from markupsafe import Markup
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from flask_login import LoginManager, UserMixin, current_user, login_user, logout_user, login_required
 app = Flask(__name__)
 
@@ -15,8 +54,131 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///todo.db'
 #Because login relies on session to keep users logged in,
 #we have to specify where this information will be stored and
 #provide an app key to associate with the session
+#Sessions are kept server side by create_app(), see the Sessions Section.
+#SESSION_TYPE is one of 'cookie', 'filesystem', 'sqlite' or 'redis'
 app.config['SESSION_TYPE'] = 'filesystem'
-app.secret_key = os.urandom(12)
+app.config['SESSION_FILE_DIR'] = None
+app.config['SESSION_SQLITE_PATH'] = None
+app.config['SESSION_REDIS_URL'] = 'redis://localhost:6379/0'
+#Development key, which changes on every start. create_app() requires a
+#fixed SECRET_KEY from the configuration unless the app runs in debug mode
+DEVELOPMENT_SECRET_KEY = os.urandom(12)
+app.secret_key = DEVELOPMENT_SECRET_KEY
+#PBKDF2 rounds used for new password hashes. Hashes stored with other
+#parameters are upgraded the next time their owner logs in
+app.config['PASSWORD_HASH_ITERATIONS'] = 150000
+#Number of processes hashing passwords (0 hashes inside the request thread)
+#and how many seconds a login waits for a free process before giving up
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+#How many logged in users are kept in memory, and for how many seconds
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 300
+#Cards shown per column when the board opens, the rest is fetched on demand
+app.config['COLUMN_PAGE_SIZE'] = 50
+#Seconds between keep-alive comments on idle change streams
+app.config['CHANGE_STREAM_HEARTBEAT'] = 15
+#Redis server relaying board changes between worker processes, so that
+#every open page hears about every write. None keeps them in the process
+app.config['CHANGE_STREAM_REDIS_URL'] = None
+#Seconds the change log keeps every entry, and seconds between compactions.
+#Clients that last synced before the retention window get a full reload
+app.config['CHANGE_LOG_RETENTION'] = 7 * 24 * 3600
+app.config['CHANGE_LOG_COMPACT_INTERVAL'] = 3600
+#SQLite production profile, see useSqliteProduction(). Pragmas are run on
+#every new connection; cache_size is negative to mean KiB instead of pages
+app.config['SQLITE_PRODUCTION'] = False
+app.config['SQLITE_POOL_SIZE'] = 8
+app.config['SQLITE_PRAGMAS'] = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64000),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+]
+#Group the writes of concurrent requests into one transaction (needs the
+#production profile). A group closes after this many writes or after
+#waiting this many seconds for more
+app.config['WRITE_COALESCING'] = False
+app.config['WRITE_COALESCE_MAX_BATCH'] = 64
+app.config['WRITE_COALESCE_WAIT'] = 0.002
+#Seconds a process trusts its copy of the workflow, so edits made through
+#another worker process show up without a restart
+app.config['WORKFLOW_CACHE_TTL'] = 30
+#Columns whose position keys grow past this length are renumbered by a
+#background task running every POSITION_REBALANCE_INTERVAL seconds
+app.config['POSITION_KEY_MAX_LENGTH'] = 24
+app.config['POSITION_REBALANCE_INTERVAL'] = 600
+#Cards that stay this many seconds in one of the ARCHIVE_COLUMNS are moved
+#to the archive by a background task running every ARCHIVE_INTERVAL seconds
+app.config['ARCHIVE_COLUMNS'] = ['done']
+app.config['ARCHIVE_AFTER'] = 30 * 24 * 3600
+app.config['ARCHIVE_INTERVAL'] = 3600
+#SQL statements slower than this many seconds are logged. When METRICS_TOKEN
+#is set, /metrics wants it as "Authorization: Bearer <token>"
+app.config['SLOW_QUERY_THRESHOLD'] = 0.1
+app.config['METRICS_TOKEN'] = None
+#Rendered card lists kept per column, and for how many seconds
+app.config['FRAGMENT_CACHE_SIZE'] = 4096
+app.config['FRAGMENT_CACHE_TTL'] = 3600
+#Board memberships kept in memory, and for how many seconds. Changes made
+#through another worker process show up once the entry expires
+app.config['MEMBERSHIP_CACHE_SIZE'] = 16384
+app.config['MEMBERSHIP_CACHE_TTL'] = 30
+#Worker threads running queued jobs in each process, and seconds they sleep
+#when the queue is empty. A failed job is tried JOB_MAX_ATTEMPTS times in
+#all, waiting JOB_RETRY_DELAY seconds times the attempts made in between.
+#Jobs running for more than JOB_TIMEOUT seconds are taken to have lost
+#their worker and queued again, and ended jobs are kept JOB_RETENTION seconds
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_POLL_INTERVAL'] = 1
+app.config['JOB_MAX_ATTEMPTS'] = 3
+app.config['JOB_RETRY_DELAY'] = 5
+app.config['JOB_TIMEOUT'] = 3600
+app.config['JOB_RETENTION'] = 7 * 24 * 3600
+app.config['JOB_TIDY_INTERVAL'] = 600
+#Whether create_app() starts the job workers and the periodic housekeeping
+#(archiving, change log compaction, position rebalancing, job cleanup) in
+#the process it configures. Turn it off in the web workers when a separate
+#"flask run-worker" process does that work
+app.config['BACKGROUND_TASKS'] = True
+#Whether create_app() creates the tables and upgrades a database made by an
+#older version, see dbHelper(). With several workers, run "flask init-db"
+#once before starting them and turn this off, so they do not all migrate
+#the same database at once
+app.config['INIT_DATABASE'] = True
+#Requests allowed per endpoint as (requests, seconds): a client may send
+#`requests` at once, then one more every seconds/requests. Each client
+#address and each logged in user has its own token bucket per endpoint.
+#A key like 'POST login' limits only that method of the endpoint.
+#RATE_LIMIT_STORAGE is 'memory', where every process counts on its own, or
+#'redis' to share the buckets of every worker through RATE_LIMIT_REDIS_URL.
+#At most RATE_LIMIT_MAX_BUCKETS buckets are kept in memory
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMITS'] = {
+    'POST login': (20, 60),
+    'POST register_page': (10, 600),
+    'addtodo': (60, 60),
+    'adddoing': (60, 60),
+    'adddone': (60, 60),
+    'addtask': (60, 60),
+    'todo': (60, 60),
+    'todoBatch': (60, 60),
+    'moveCard': (120, 60),
+    'importBoard': (10, 60),
+}
+app.config['RATE_LIMIT_STORAGE'] = 'memory'
+app.config['RATE_LIMIT_REDIS_URL'] = 'redis://localhost:6379/0'
+app.config['RATE_LIMIT_MAX_BUCKETS'] = 100000
+#Number of reverse proxies in front of the app. Client addresses, and the
+#scheme and host of requests, are then read from the X-Forwarded-* headers
+#those proxies add. Leave it at 0 when clients reach the app directly, as
+#they could otherwise pick their own address
+app.config['TRUSTED_PROXIES'] = 0
+#Dynamic responses of at least GZIP_MIN_SIZE bytes are gzipped at this level
+app.config['GZIP_LEVEL'] = 6
+app.config['GZIP_MIN_SIZE'] = 500
 
 #Setup database and login managers
 #Flask Login module helps with session management,
@@ -27,15 +189,50 @@ db = SQLAlchemy(app)
 login = LoginManager(app)
 login.login_view = 'login'
 
-#Tells the login manager which field to lookup when checking
-#if user is authorized
-@login.user_loader
-def load_user(id):
-    return User.query.get(int(id))
+#create_all does not touch tables that already exist, so columns added to
+#a model after its table was created are added here with ALTER TABLE
+def addMissingColumns():
+    inspector = inspect(db.engine)
+    for table in db.Model.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = 'ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, column.name, column.type.compile(db.engine.dialect))
+                if column.server_default is not None:
+                    ddl += " DEFAULT %s" % column.server_default.arg
+                db.engine.execute(ddl)
+
+#Todo tables created before card ids had to stay unique hand the id of the
+#newest card out again once that card is archived, and the archive would
+#then refuse the card that got it. Such a table is rebuilt with
+#AUTOINCREMENT, its sequence starting past every id already archived
+def addAutoincrement():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    ddl = db.engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Todo'").scalar()
+    if "AUTOINCREMENT" in ddl.upper():
+        return
+    table = Todo.__table__
+    columns = ", ".join('"%s"' % column.name for column in table.columns)
+    with db.engine.begin() as connection:
+        dropSearchIndex(table, connection)
+        for index in inspect(connection).get_indexes('Todo'):
+            connection.execute('DROP INDEX "%s"' % index['name'])
+        connection.execute('ALTER TABLE "Todo" RENAME TO "TodoRebuild"')
+        #Creating the table creates its indexes and its search index, which
+        #the insert trigger fills while the cards are copied
+        table.create(bind=connection)
+        connection.execute('INSERT INTO "Todo" (%s) SELECT %s FROM "TodoRebuild"' % (columns, columns))
+        connection.execute('DROP TABLE "TodoRebuild"')
+        last = connection.execute('SELECT max(id) FROM (SELECT max(id) AS id FROM "Todo" '
+                                  'UNION ALL SELECT max(id) FROM "ArchivedTodo")').scalar()
+        connection.execute("DELETE FROM sqlite_sequence WHERE name = 'Todo'")
+        connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('Todo', ?)", last or 0)
 
 #Helper function to populate Task Type table and create all tables in the database
 def dbHelper():
     db.create_all()
+    addMissingColumns()
     types = list()
     t1 = TodoType.query.filter(TodoType.id==1).filter(TodoType.type=="todo").first()
     if not t1:
@@ -50,6 +247,506 @@ def dbHelper():
     if types:
         db.session.add_all(types)
         db.session.commit()
+    addAutoincrement()
+    #create_all only creates indexes for brand new tables, so boards
+    #created before the composite index existed get it added here
+    for table in (Todo.__table__, ArchivedTodo.__table__):
+        existing = set(index['name'] for index in inspect(db.engine).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+        for name in OBSOLETE_INDEXES:
+            if name in existing:
+                db.engine.execute('DROP INDEX "%s"' % name)
+    addSearchIndex()
+    #Users and cards from before shared boards get their personal board
+    addPersonalBoards()
+    workflow.load()
+    #Cards created before positions existed get one, in id order
+    rebalancePositions()
+    #Counters start from the cards already there, and are checked on every start
+    repairCounters()
+
+
+####################################################################
+# Metrics Section
+####################################################################
+#Latency buckets in seconds, and buckets for the statements of a request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+#Counters and histograms kept in memory by each process and written out in
+#the Prometheus text format. A metric is declared once with its help text,
+#then updated with a dict of labels. Metrics computed when they are read,
+#like cache statistics, are added as collectors returning [(labels, value)]
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.declared = OrderedDict()
+        self.values = dict()
+        self.collectors = list()
+
+    def counter(self, name, help):
+        self.declared[name] = ("counter", help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.declared[name] = ("histogram", help, buckets)
+
+    def collector(self, name, kind, help, function):
+        self.collectors.append((name, kind, help, function))
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = self.declared[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            #One count per bucket plus +Inf, then the sum of the values
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    #Number of observations and their sum for a histogram, over the
+    #label sets that include the given labels
+    def totals(self, name, **labels):
+        count, total = 0, 0
+        with self.lock:
+            for (metric, pairs), value in self.values.items():
+                if metric == name and set(labels.items()) <= set(pairs):
+                    count += sum(value[:-1])
+                    total += value[-1]
+        return count, total
+
+    def render(self):
+        with self.lock:
+            values = dict((key, list(value) if isinstance(value, list) else value) for key, value in self.values.items())
+        lines = list()
+        for name, (kind, help, buckets) in self.declared.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    continue
+                if kind == "counter":
+                    lines.append("%s%s %s" % (name, formatLabels(labels), formatValue(value)))
+                    continue
+                total = 0
+                for bound, count in zip(buckets + ("+Inf",), value):
+                    total += count
+                    lines.append("%s_bucket%s %d" % (name, formatLabels(labels + (("le", str(bound)),)), total))
+                lines.append("%s_sum%s %s" % (name, formatLabels(labels), formatValue(value[-1])))
+                lines.append("%s_count%s %d" % (name, formatLabels(labels), total))
+        for name, kind, help, function in self.collectors:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in function():
+                lines.append("%s%s %s" % (name, formatLabels(tuple(sorted(labels.items()))), formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+def formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = Metrics()
+metrics.histogram('kanban_request_duration_seconds', 'Time spent answering requests, by endpoint')
+metrics.counter('kanban_requests_total', 'Requests answered, by endpoint and status')
+metrics.histogram('kanban_request_sql_statements', 'SQL statements issued by one request, by endpoint',
+                  STATEMENT_BUCKETS)
+metrics.histogram('kanban_sql_duration_seconds', 'Time spent running SQL statements, by kind of statement')
+metrics.counter('kanban_sql_slow_statements_total', 'SQL statements slower than SLOW_QUERY_THRESHOLD')
+metrics.histogram('kanban_password_hash_seconds', 'Time spent hashing and checking passwords, waiting included')
+metrics.counter('kanban_password_hash_busy_total', 'Logins refused because every hashing process was busy')
+
+#Name of the endpoint a request went to, for labels. Unknown URLs share one
+def endpointName():
+    return request.endpoint or "unmatched"
+
+@app.before_request
+def startRequestTimer():
+    g.requestStart = time.perf_counter()
+    g.sqlStatements = 0
+
+@app.after_request
+def recordRequest(response):
+    if 'requestStart' in g:
+        labels = dict(endpoint=endpointName(), method=request.method)
+        metrics.observe('kanban_request_duration_seconds', labels, time.perf_counter() - g.requestStart)
+        metrics.observe('kanban_request_sql_statements', labels, g.sqlStatements)
+        metrics.inc('kanban_requests_total', dict(labels, status=str(response.status_code)))
+    return response
+
+#Statements are timed on every engine. Those run by a request count towards
+#its statements; writes handed to the write coalescer run on its thread and
+#are only timed
+@event.listens_for(Engine, 'before_cursor_execute')
+def startStatementTimer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('statementStart', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def recordStatement(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['statementStart'].pop()
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "EMPTY"
+    metrics.observe('kanban_sql_duration_seconds', dict(statement=kind), elapsed)
+    if elapsed > app.config['SLOW_QUERY_THRESHOLD']:
+        metrics.inc('kanban_sql_slow_statements_total', dict(statement=kind))
+        logging.getLogger(__name__).warning("Slow query (%.3fs) in %s: %s", elapsed,
+                                            endpointName() if has_request_context() else "background",
+                                            " ".join(statement.split())[:500])
+    if has_request_context() and 'sqlStatements' in g:
+        g.sqlStatements += 1
+
+#Statements that fail never reach after_cursor_execute
+@event.listens_for(Engine, 'handle_error')
+def forgetStatementTimer(context):
+    starts = context.connection.info.get('statementStart') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+####################################################################
+# SQLite Section
+####################################################################
+#Switches the app to the SQLite production profile: WAL journaling and
+#tuned pragmas, a pool of reusable connections instead of one new
+#connection per request, and optionally the write coalescer below.
+#Has to be called before the first query, as the engine is created then
+def useSqliteProduction(coalesceWrites=False):
+    app.config['SQLITE_PRODUCTION'] = True
+    app.config['WRITE_COALESCING'] = coalesceWrites
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        poolclass=QueuePool,
+        pool_size=app.config['SQLITE_POOL_SIZE'],
+        max_overflow=app.config['SQLITE_POOL_SIZE'],
+        connect_args=dict(check_same_thread=False, timeout=30),
+    )
+
+#Runs the pragmas on new SQLite connections. Also takes transaction
+#handling away from the sqlite3 module, which otherwise defers BEGIN and
+#breaks the SAVEPOINTs the write coalescer relies on; BEGIN is emitted by
+#the hook below instead
+@event.listens_for(Engine, 'connect')
+def sqliteConnect(connection, record):
+    if app.config['SQLITE_PRODUCTION'] and isinstance(connection, sqlite3.Connection):
+        connection.isolation_level = None
+        cursor = connection.cursor()
+        for pragma, value in app.config['SQLITE_PRAGMAS']:
+            cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        cursor.close()
+
+@event.listens_for(Engine, 'begin')
+def sqliteBegin(connection):
+    if app.config['SQLITE_PRODUCTION'] and connection.dialect.name == 'sqlite':
+        connection.execute('BEGIN')
+
+#Group commit for SQLite. Requests hand their writes to a single writer
+#thread, which runs every write waiting in the queue inside one transaction
+#and commits them together, so a burst of requests pays for one commit and
+#one acquisition of the database write lock. Each write runs inside its own
+#SAVEPOINT: a write that fails is rolled back alone and its exception is
+#raised in the request that sent it, while the others still commit
+class WriteCoalescer(object):
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batches = 0
+        self.writes = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='write-coalescer', daemon=True)
+                self.thread.start()
+
+    #Queues a write and waits until it is committed. Returns what the write
+    #returned, or raises what it raised
+    def submit(self, function):
+        self.start()
+        future = Future()
+        self.requests.put((function, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + app.config['WRITE_COALESCE_WAIT']
+            while len(batch) < app.config['WRITE_COALESCE_MAX_BATCH']:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            with app.app_context():
+                try:
+                    self.apply(batch)
+                except Exception as error:
+                    #The session broke in a way apply() could not recover
+                    #from. The writes still waiting learn why, and the
+                    #thread lives on for the next batch
+                    log.exception("Write batch failed")
+                    for function, future in batch:
+                        if not future.done():
+                            future.set_exception(error)
+                finally:
+                    db.session.remove()
+
+    def apply(self, batch):
+        done = list()
+        for function, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            pending = db.session.info.setdefault('changes', [])
+            mark = len(pending)
+            savepoint = None
+            try:
+                savepoint = db.session.begin_nested()
+                result = function()
+                savepoint.commit()
+            except Exception as error:
+                del pending[mark:]
+                future.set_exception(error)
+                #Without its savepoint the write cannot be undone alone
+                if savepoint is None:
+                    raise
+                savepoint.rollback()
+            else:
+                done.append((future, result))
+        try:
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            for future, result in done:
+                future.set_exception(error)
+            return
+        self.batches += 1
+        self.writes += len(done)
+        for future, result in done:
+            future.set_result(result)
+
+coalescer = WriteCoalescer()
+
+#Runs a write and commits it, returning what the write returned. Writes are
+#functions that change db.session without committing; with write coalescing
+#on they run on the writer thread, so they must not use request or
+#current_user and should return plain data rather than database objects
+def runWrite(function):
+    if app.config['WRITE_COALESCING'] and app.config['SQLITE_PRODUCTION']:
+        #Ends the request's own read transaction before waiting for the writer
+        db.session.commit()
+        return coalescer.submit(function)
+    try:
+        result = function()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
+
+
+####################################################################
+# Caching Section
+####################################################################
+#Thread safe least recently used cache whose entries also expire after
+#ttl seconds. Keeps hit/miss/eviction counters so its efficiency can be checked
+class LRUCache(object):
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self.items[key]
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    #Takes new limits, dropping what was cached under the old ones
+    def resize(self, maxsize, ttl):
+        with self.lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        size=len(self.items), maxsize=self.maxsize)
+
+#Users rebuilt by the login manager on every request, keyed by user id
+userCache = LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+#Rendered card lists of the board page, keyed by board, column, column
+#version and page size, see columnFragments()
+fragmentCache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+#Role of a user on a board keyed by (user id, board id), "" meaning not a
+#member, see boardRole()
+membershipCache = LRUCache(app.config['MEMBERSHIP_CACHE_SIZE'], app.config['MEMBERSHIP_CACHE_TTL'])
+#The caches are made with the defaults above when the module is imported,
+#and sized again by create_app() from the configuration it was given
+def resizeCaches():
+    userCache.resize(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    fragmentCache.resize(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+    membershipCache.resize(app.config['MEMBERSHIP_CACHE_SIZE'], app.config['MEMBERSHIP_CACHE_TTL'])
+
+metrics.collector('kanban_user_cache_events_total', 'counter', 'Lookups and evictions of the user cache',
+                  lambda: [(dict(event=event), userCache.stats()[event]) for event in ("hits", "misses", "evictions")])
+metrics.collector('kanban_user_cache_size', 'gauge', 'Users held in the user cache',
+                  lambda: [(dict(), userCache.stats()["size"])])
+
+#Tells the login manager which field to lookup when checking
+#if user is authorized. Users come from userCache when possible; the cache
+#holds detached copies which are merged into the request's session without
+#a query, so a commit in one request never expires another request's user
+@login.user_loader
+def load_user(id):
+    cached = userCache.get(int(id))
+    if cached is not None:
+        return db.session.merge(cached, load=False)
+    user = User.query.get(int(id))
+    if user is not None:
+        copy = User(id=user.id, username=user.username, boardid=user.boardid,
+                    passwordHash=user.passwordHash, passwordSalt=user.passwordSalt)
+        make_transient_to_detached(copy)
+        userCache.set(user.id, copy)
+    return user
+
+
+####################################################################
+# Password Hashing Section
+####################################################################
+#Raised when every hashing process is busy for longer than PASSWORD_HASH_TIMEOUT
+class HashingBusy(Exception):
+    pass
+
+#Both functions run inside the hashing processes, so they have to live
+#at module level where the pool can find them
+def hashPassword(password, method):
+    return generate_password_hash(password, method=method)
+
+def verifyPassword(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+#Runs password hashing in a small pool of processes, so a burst of logins
+#keeps at most PASSWORD_HASH_WORKERS cores busy and never blocks the
+#threads serving board requests. Requests wait for a free process and
+#give up with HashingBusy instead of queueing without limit
+class PasswordHasher(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.slots = None
+
+    #Starts the pool the first time it is needed, so importing the
+    #module (for instance from the tests) does not start any process.
+    #Hashing processes come from a fork server (or are spawned where there
+    #is none) rather than being forked from this process, whose other
+    #threads may hold locks the copy would never see released
+    def executor(self, workers):
+        with self.lock:
+            if self.pool is None:
+                self.pool = self.newPool(workers)
+                self.slots = threading.BoundedSemaphore(workers)
+            return self.pool, self.slots
+
+    def newPool(self, workers):
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+    #A pool loses all its processes once one of them dies, for instance
+    #when it is killed for lack of memory. The first caller to notice
+    #replaces it, the others get the replacement
+    def replace(self, broken, workers):
+        with self.lock:
+            if self.pool is broken:
+                self.pool = self.newPool(workers)
+                broken.shutdown(wait=False)
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def run(self, function, *args):
+        start = time.perf_counter()
+        try:
+            return self.call(function, *args)
+        finally:
+            metrics.observe('kanban_password_hash_seconds', dict(operation=function.__name__),
+                            time.perf_counter() - start)
+
+    def call(self, function, *args):
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        if not workers:
+            return function(*args)
+        pool, slots = self.executor(workers)
+        if not slots.acquire(timeout=app.config['PASSWORD_HASH_TIMEOUT']):
+            metrics.inc('kanban_password_hash_busy_total', dict())
+            raise HashingBusy()
+        try:
+            try:
+                return pool.submit(function, *args).result()
+            except BrokenProcessPool:
+                log.warning("Password hashing processes died, starting new ones")
+                return self.replace(pool, workers).submit(function, *args).result()
+        finally:
+            slots.release()
+
+    #Hash method string for the current cost, as stored in the hash prefix
+    def method(self):
+        return 'pbkdf2:sha256:%d' % app.config['PASSWORD_HASH_ITERATIONS']
+
+    def hash(self, password):
+        return self.run(hashPassword, password, self.method())
+
+    def verify(self, pwhash, password):
+        return self.run(verifyPassword, pwhash, password)
+
+    def needsRehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.method()
+
+hasher = PasswordHasher()
+atexit.register(hasher.shutdown)
 
 
 ####################################################################
@@ -60,6 +757,8 @@ class User(UserMixin, db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20))
+    #The user's personal board, opened when no other board is asked for
+    boardid = db.Column(db.Integer)
     passwordHash = db.Column(db.String)
     passwordSalt = db.Column(db.String)
 
@@ -68,10 +767,20 @@ class User(UserMixin, db.Model):
 #password and hashing the hash+password string
     def set_password(self, password):
         self.passwordSalt = str(bcrypt.gensalt())
-        self.passwordHash = generate_password_hash(password + self.passwordSalt)
+        self.passwordHash = hasher.hash(password + self.passwordSalt)
 
     def check_password(self, password):
-        return check_password_hash(self.passwordHash, password + self.passwordSalt)
+        return hasher.verify(self.passwordHash, password + self.passwordSalt)
+
+    #True when the stored hash was made with older cost parameters
+    def needs_rehash(self):
+        return hasher.needsRehash(self.passwordHash)
+
+#Any change to a user drops its cached copy
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forgetCachedUser(mapper, connection, target):
+    userCache.invalidate(target.id)
 
 class TodoType(db.Model):
     __tablename__ = 'TodoType'
@@ -84,8 +793,1908 @@ class Todo(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(200))
+    #Who added the card, and the board it is on
     userid = db.Column(db.Integer, db.ForeignKey('User.id'))
+    boardid = db.Column(db.Integer, db.ForeignKey('Board.id'))
     type = db.Column(db.Integer, db.ForeignKey('TodoType.id'))
+    #Order of the card inside its column, see the Card Positions Section
+    position = db.Column(db.String(200))
+    #When the card entered its current column, see the Archive Section
+    movedat = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    #Every board read filters by board, splits by column and orders by
+    #position, so SQLite answers it by walking this index. id is the rowid,
+    #so it is part of every entry and breaks ties between equal positions.
+    #The archive job finds the cards that sat long enough in a column
+    #through the second one. Ids are never reused, as archived cards
+    #keep theirs; older tables are rebuilt by addAutoincrement()
+    __table_args__ = (db.Index('ix_Todo_boardid_type_position', 'boardid', 'type', 'position'),
+                      db.Index('ix_Todo_type_movedat', 'type', 'movedat'),
+                      {'sqlite_autoincrement': True})
+
+#Indexes of older versions that newer indexes made redundant
+OBSOLETE_INDEXES = ['ix_Todo_userid_type', 'ix_Todo_userid_type_position', 'ix_ArchivedTodo_userid']
+
+#Cards taken off the board by the archive job. They keep their id, so links
+#to a card still lead to it, and are read through their own routes only
+class ArchivedTodo(db.Model):
+    __tablename__ = 'ArchivedTodo'
+
+    id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.String(200))
+    userid = db.Column(db.Integer)
+    boardid = db.Column(db.Integer)
+    type = db.Column(db.Integer)
+    position = db.Column(db.String(200))
+    movedat = db.Column(db.DateTime)
+    archivedat = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_ArchivedTodo_boardid', 'boardid'),)
+
+#Every user gets a personal board when created, and may create more boards
+#to share with others. Users who had a board before boards could be shared
+#kept it under their own id, so boardid columns of older rows stay valid
+class Board(db.Model):
+    __tablename__ = 'Board'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80))
+    ownerid = db.Column(db.Integer, db.ForeignKey('User.id'))
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = ({'sqlite_autoincrement': True},)
+
+#Who may use a board, and how, see ROLES. Permission checks read one row
+#by its primary key; the second index lists the boards of a user
+class BoardMember(db.Model):
+    __tablename__ = 'BoardMember'
+
+    boardid = db.Column(db.Integer, db.ForeignKey('Board.id'), primary_key=True, autoincrement=False)
+    userid = db.Column(db.Integer, db.ForeignKey('User.id'), primary_key=True, autoincrement=False)
+    role = db.Column(db.String(20), nullable=False)
+
+    __table_args__ = (db.Index('ix_BoardMember_userid_boardid', 'userid', 'boardid'),)
+
+#New users get their personal board in the transaction that creates them
+@event.listens_for(User, 'after_insert')
+def addPersonalBoard(mapper, connection, target):
+    boardid = connection.execute(Board.__table__.insert().values(
+        name=target.username, ownerid=target.id)).inserted_primary_key[0]
+    connection.execute(BoardMember.__table__.insert().values(boardid=boardid, userid=target.id, role="owner"))
+    connection.execute(User.__table__.update().where(User.__table__.c.id == target.id).values(boardid=boardid))
+    set_committed_value(target, 'boardid', boardid)
+
+#Any change to a membership drops its cached role
+@event.listens_for(BoardMember, 'after_insert')
+@event.listens_for(BoardMember, 'after_update')
+@event.listens_for(BoardMember, 'after_delete')
+def forgetCachedRole(mapper, connection, target):
+    membershipCache.invalidate((target.userid, target.boardid))
+    if has_request_context():
+        g.pop('roles', None)
+
+#A board without BoardColumn rows shows the default columns
+class BoardColumn(db.Model):
+    __tablename__ = 'BoardColumn'
+
+    id = db.Column(db.Integer, primary_key=True)
+    boardid = db.Column(db.Integer, index=True)
+    type = db.Column(db.Integer, db.ForeignKey('TodoType.id'))
+    position = db.Column(db.Integer)
+
+#Allowed moves between columns. Rows without a board apply to every board
+#that has no transitions of its own; when there are none at all, cards move
+#from each column to the one on its right
+class TodoTransition(db.Model):
+    __tablename__ = 'TodoTransition'
+
+    id = db.Column(db.Integer, primary_key=True)
+    boardid = db.Column(db.Integer, index=True)
+    fromtype = db.Column(db.Integer, db.ForeignKey('TodoType.id'))
+    totype = db.Column(db.Integer, db.ForeignKey('TodoType.id'))
+
+#Number of cards in each column of a board, kept up to date by every write
+#that adds, moves or removes cards, so counts and WIP limits are read from
+#one row instead of counting the column. wiplimit is the most cards the
+#column may hold, None meaning no limit
+class ColumnCounter(db.Model):
+    __tablename__ = 'ColumnCounter'
+
+    boardid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    type = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    wiplimit = db.Column(db.Integer)
+    #Board version of the last change to the cards of the column, which
+    #tells whether its cached fragment is still good
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+#Counter bumped by every change to a board, used as the board's ETag
+class BoardVersion(db.Model):
+    __tablename__ = 'BoardVersion'
+
+    boardid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    #Highest version whose change log entries were compacted away
+    compacted = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+#Append-only log of the changes made to each board. version is the board
+#version the change produced, so it grows monotonically per board
+class ChangeLog(db.Model):
+    __tablename__ = 'ChangeLog'
+
+    id = db.Column(db.Integer, primary_key=True)
+    boardid = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    cardid = db.Column(db.Integer)
+    column = db.Column(db.String(80))
+    text = db.Column(db.String(200))
+    position = db.Column(db.String(200))
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_ChangeLog_boardid_version', 'boardid', 'version'),)
+
+#Queue of the work done by the job runner, see the Jobs Section. Rows stay
+#once the job ended, so clients can poll its outcome
+class Job(db.Model):
+    __tablename__ = 'Job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    boardid = db.Column(db.Integer)
+    userid = db.Column(db.Integer)
+    payload = db.Column(db.Text)
+    #queued, running, done or failed
+    status = db.Column(db.String(20), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    #A queued job waits until then, which spaces out the retries
+    runafter = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    #Workers find the next due job through the first index,
+    #users list their jobs through the second
+    __table_args__ = (db.Index('ix_Job_status_runafter', 'status', 'runafter'),
+                      db.Index('ix_Job_userid', 'userid'))
+
+
+####################################################################
+# Workflow Section
+####################################################################
+#Names of the default board columns, in the order they are shown on the page
+DEFAULT_COLUMNS = ("todo", "doing", "done")
+
+#Keeps the task types, board columns and transitions in memory so that
+#requests translate between names, ids and next stages without touching
+#the database. The tables are read once and kept until invalidate() is
+#called, which every function editing the workflow does after committing
+class WorkflowRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.loaded = 0
+
+    #Reads the whole workflow with three queries and swaps it in at once,
+    #so concurrent readers never see a half built registry
+    def load(self):
+        with self.lock:
+            types = TodoType.query.order_by(TodoType.id).all()
+            columns = BoardColumn.query.order_by(BoardColumn.position, BoardColumn.id).all()
+            transitions = TodoTransition.query.order_by(TodoTransition.id).all()
+            snapshot = dict(
+                ids=dict((t.type, t.id) for t in types),
+                names=dict((t.id, t.type) for t in types),
+                columns=dict(),
+                transitions=dict(),
+            )
+            for column in columns:
+                snapshot["columns"].setdefault(column.boardid, []).append(column.type)
+            for transition in transitions:
+                moves = snapshot["transitions"].setdefault(transition.boardid, dict())
+                moves.setdefault(transition.fromtype, []).append(transition.totype)
+            #An empty TodoType table means the database is not seeded yet,
+            #keep reading it until it is
+            self.snapshot = snapshot if types else None
+            self.loaded = time.monotonic()
+            return snapshot
+
+    def invalidate(self):
+        self.snapshot = None
+
+    def current(self):
+        if self.snapshot is None or time.monotonic() - self.loaded > app.config['WORKFLOW_CACHE_TTL']:
+            return self.load()
+        return self.snapshot
+
+    def typeId(self, name):
+        return self.current()["ids"].get(name)
+
+    def typeName(self, typeid):
+        return self.current()["names"].get(typeid)
+
+    #Ids of the columns of a board, in the order they are shown
+    def columns(self, boardid):
+        snapshot = self.current()
+        if boardid is not None and int(boardid) in snapshot["columns"]:
+            return list(snapshot["columns"][int(boardid)])
+        return [snapshot["ids"][name] for name in DEFAULT_COLUMNS if name in snapshot["ids"]]
+
+    #Maps each column of a board to the columns its cards may move to
+    def transitions(self, boardid):
+        snapshot = self.current()
+        columns = self.columns(boardid)
+        moves = snapshot["transitions"].get(int(boardid) if boardid is not None else None)
+        if moves is None:
+            moves = snapshot["transitions"].get(None)
+        if moves is None:
+            return dict((a, [b]) for a, b in zip(columns, columns[1:]))
+        return dict((a, [b for b in targets if b in columns]) for a, targets in moves.items() if a in columns)
+
+    #Maps each column to the one its cards go to when moved to the next stage.
+    #Columns without an allowed move, like "done", have no entry
+    def nextStages(self, boardid):
+        return dict((a, targets[0]) for a, targets in self.transitions(boardid).items() if targets)
+
+    def canMove(self, boardid, fromtype, totype):
+        return totype in self.transitions(boardid).get(fromtype, [])
+
+workflow = WorkflowRegistry()
+
+#Returns the id of a task type, creating the type when it does not exist yet
+def findOrCreateType(name):
+    tasktype = TodoType.query.filter_by(type=name).first()
+    if not tasktype:
+        tasktype = TodoType(type=name)
+        db.session.add(tasktype)
+        db.session.flush()
+    return tasktype.id
+
+#Sets the columns of a board, in order. Cards in columns that are
+#removed stay in the database but are no longer shown
+def setBoardColumns(boardid, names):
+    def write():
+        BoardColumn.query.filter_by(boardid=boardid).delete()
+        for position, name in enumerate(names):
+            db.session.add(BoardColumn(boardid=boardid, type=findOrCreateType(name), position=position))
+        recordChanges(boardid, [("workflow", {})])
+    runWrite(write)
+    workflow.invalidate()
+
+#Sets the allowed moves of a board from a list of (from, to) column names.
+#An empty list brings back the default left to right workflow
+def setBoardTransitions(boardid, pairs):
+    def write():
+        TodoTransition.query.filter_by(boardid=boardid).delete()
+        for fromname, toname in pairs:
+            db.session.add(TodoTransition(boardid=boardid, fromtype=findOrCreateType(fromname), totype=findOrCreateType(toname)))
+        recordChanges(boardid, [("workflow", {})])
+    runWrite(write)
+    workflow.invalidate()
+
+#Describes the workflow of a board with column names instead of ids
+def describeWorkflow(boardid):
+    name = workflow.typeName
+    limits = db.session.query(ColumnCounter.type, ColumnCounter.wiplimit).filter(ColumnCounter.boardid==boardid)\
+        .filter(ColumnCounter.wiplimit != None)
+    return dict(
+        columns=[name(c) for c in workflow.columns(boardid)],
+        transitions=[[name(a), name(b)] for a, targets in workflow.transitions(boardid).items() for b in targets],
+        limits=dict((name(typeid), limit) for typeid, limit in limits if typeid in workflow.columns(boardid)),
+    )
+
+
+####################################################################
+# Boards Section
+####################################################################
+#Roles of board members, each allowed what the ones before it are: viewers
+#read the board, editors also add, move and delete cards, owners also
+#change its workflow and members
+ROLES = ("viewer", "editor", "owner")
+
+#Raised when a membership change is not allowed
+class InvalidMember(Exception):
+    pass
+
+#Role of a user on a board, or None when the user is not a member. A
+#request checks its board once and keeps the answer in g, and the answer
+#stays in membershipCache for the next requests, so permission checks
+#rarely reach the database and cards are read by board id without
+#joining the memberships
+def boardRole(userid, boardid):
+    key = (int(userid), int(boardid))
+    roles = g.setdefault('roles', dict()) if has_request_context() else dict()
+    if key not in roles:
+        role = membershipCache.get(key)
+        if role is None:
+            role = db.session.query(BoardMember.role).filter_by(userid=key[0], boardid=key[1]).scalar() or ""
+            membershipCache.set(key, role)
+        roles[key] = role or None
+    return roles[key]
+
+def hasRole(role, wanted):
+    return role is not None and ROLES.index(role) >= ROLES.index(wanted)
+
+#Answers 404 when the logged in user is not a member of the board, and 403
+#when their role does not allow `role`. Returns the board id
+def checkBoard(boardid, role="viewer"):
+    current = boardRole(current_user.id, boardid) if boardid is not None else None
+    if current is None:
+        abort(404)
+    if not hasRole(current, role):
+        abort(403)
+    return boardid
+
+#Board a request works on: the one named by ?board=, else the one last
+#opened in the session, else the user's personal board
+def currentBoard(role="viewer"):
+    boardid = request.args.get('board', type=int)
+    if boardid is None:
+        boardid = session.get('board')
+        if boardid is None or boardRole(current_user.id, boardid) is None:
+            boardid = current_user.boardid
+    return checkBoard(boardid, role)
+
+#Boards a user is a member of, with the user's role on each
+def userBoards(userid):
+    return db.session.query(Board.id, Board.name, BoardMember.role)\
+        .join(BoardMember, BoardMember.boardid == Board.id).filter(BoardMember.userid==userid)\
+        .order_by(Board.id).all()
+
+def boardMembers(boardid):
+    return db.session.query(User.id, User.username, BoardMember.role)\
+        .join(BoardMember, BoardMember.userid == User.id).filter(BoardMember.boardid==boardid)\
+        .order_by(User.id).all()
+
+#Creates a board owned by a user and returns its id
+def createBoard(userid, name):
+    def write():
+        board = Board(name=name, ownerid=userid)
+        db.session.add(board)
+        db.session.flush()
+        db.session.add(BoardMember(boardid=board.id, userid=userid, role="owner"))
+        return board.id
+    return runWrite(write)
+
+#Adds a user to a board or changes their role. The creator of a board
+#always stays one of its owners
+def setMember(boardid, userid, role):
+    if role not in ROLES:
+        raise InvalidMember("role must be one of %s" % ", ".join(ROLES))
+    def write():
+        if Board.query.get(boardid).ownerid == userid:
+            raise InvalidMember("The creator of a board stays its owner")
+        member = BoardMember.query.get((boardid, userid))
+        if member is None:
+            db.session.add(BoardMember(boardid=boardid, userid=userid, role=role))
+        else:
+            member.role = role
+    runWrite(write)
+
+#Takes a user off a board, returning False when they were not a member
+def removeMember(boardid, userid):
+    def write():
+        if Board.query.get(boardid).ownerid == userid:
+            raise InvalidMember("The creator of a board stays its owner")
+        member = BoardMember.query.get((boardid, userid))
+        if member is not None:
+            db.session.delete(member)
+        return member is not None
+    return runWrite(write)
+
+#Gives every user without a board the personal board they had before
+#boards could be shared: same id as the user, so cards, columns, counters
+#and versions recorded under the user's id stay with it. Users whose id is
+#already taken by a board get a new one. Then cards without a board go to
+#the personal board of whoever added them
+def addPersonalBoards():
+    users = db.session.query(User.id, User.username).filter(User.boardid == None).all()
+    if users:
+        def write():
+            taken = set(i for i, in db.session.query(Board.id).filter(Board.id.in_([u.id for u in users])))
+            boards = dict()
+            for userid, username in users:
+                values = dict(name=username, ownerid=userid)
+                if userid not in taken:
+                    values["id"] = userid
+                boards[userid] = db.session.execute(Board.__table__.insert().values(**values)).inserted_primary_key[0]
+            db.session.execute(BoardMember.__table__.insert(), [dict(boardid=boardid, userid=userid, role="owner")
+                                                                for userid, boardid in boards.items()])
+            update = User.__table__.update().where(User.__table__.c.id == db.bindparam('userid'))
+            db.session.execute(update.values(boardid=db.bindparam('boardid')),
+                               [dict(userid=userid, boardid=boardid) for userid, boardid in boards.items()])
+        runWrite(write)
+        userCache.clear()
+    for model in (Todo, ArchivedTodo):
+        personal = db.session.query(User.boardid).filter(User.id == model.userid).as_scalar()
+        runWrite(lambda: model.query.filter(model.boardid == None)
+                 .update({model.boardid: personal}, synchronize_session=False))
+
+
+####################################################################
+# Column Counters Section
+####################################################################
+#Raised when cards would go over the WIP limit of a column
+class WipLimitReached(Exception):
+    pass
+
+#Counts the cards of a column the slow way, to start or repair its counter
+def columnCount(boardid, typeid):
+    return db.session.query(db.func.count(Todo.id)).filter(Todo.boardid==boardid)\
+        .filter(Todo.type==typeid).scalar()
+
+#Adds delta to the counter of a column, in the transaction of the write
+#that adds or removes the cards. An increase only happens if the column
+#stays within its WIP limit, checked by the UPDATE itself so two writes
+#cannot both take the last free place. Columns without a counter yet get
+#one, counted before the write changes the column
+def changeCount(boardid, typeid, delta):
+    if boardid is None or not delta:
+        return
+    table = ColumnCounter.__table__
+    update = table.update().where(table.c.boardid == boardid).where(table.c.type == typeid)\
+        .values(count=table.c.count + delta)
+    if delta > 0:
+        update = update.where((table.c.wiplimit == None) | (table.c.count + delta <= table.c.wiplimit))
+    if db.session.execute(update).rowcount:
+        return
+    counter = db.session.query(ColumnCounter.count, ColumnCounter.wiplimit).filter_by(boardid=boardid, type=typeid).first()
+    if counter is not None:
+        raise WipLimitReached("%s is full, it holds %d of at most %d cards"
+                              % (workflow.typeName(typeid), counter.count, counter.wiplimit))
+    db.session.execute(table.insert().values(boardid=boardid, type=typeid,
+                                             count=max(columnCount(boardid, typeid) + delta, 0)))
+
+#Applies the changes of one write to several columns, {typeid: delta}.
+#Cards leave their columns before they enter others
+def changeCounts(boardid, deltas):
+    for typeid, delta in sorted(deltas.items(), key=lambda item: item[1]):
+        changeCount(boardid, typeid, delta)
+
+#Count, WIP limit and version of every column of a board,
+#{typeid: (count, limit, version)}. Columns that never had a counter are
+#counted, which only happens until their first write. Their version is 0:
+#the first write to a column creates its counter with a newer version
+def columnCounters(boardid):
+    counters = dict((row.type, (row.count, row.wiplimit, row.version)) for row in
+                    db.session.query(ColumnCounter.type, ColumnCounter.count, ColumnCounter.wiplimit,
+                                     ColumnCounter.version).filter(ColumnCounter.boardid==boardid))
+    for typeid in workflow.columns(boardid):
+        if typeid not in counters:
+            counters[typeid] = (columnCount(boardid, typeid), None, 0)
+    return counters
+
+#Sets the WIP limits of a board from {column name: limit}, a limit of None
+#removing it. Pages reload to show the new limits
+def setColumnLimits(boardid, limits):
+    def write():
+        table = ColumnCounter.__table__
+        for name, limit in limits.items():
+            typeid = workflow.typeId(name)
+            updated = db.session.execute(table.update().where(table.c.boardid == boardid)
+                                         .where(table.c.type == typeid).values(wiplimit=limit)).rowcount
+            if not updated:
+                db.session.execute(table.insert().values(boardid=boardid, type=typeid,
+                                                         count=columnCount(boardid, typeid), wiplimit=limit))
+        recordChanges(boardid, [("workflow", {})])
+    runWrite(write)
+
+#Recounts every column, or the columns of one board, and fixes the counters
+#that drifted, for instance after cards were changed by hand in the
+#database. Returns how many counters were fixed
+def repairCounters(boardid=None):
+    def write():
+        table = ColumnCounter.__table__
+        cards = db.session.query(Todo.boardid, Todo.type, db.func.count(Todo.id)).group_by(Todo.boardid, Todo.type)
+        counters = db.session.query(ColumnCounter.boardid, ColumnCounter.type, ColumnCounter.count)
+        if boardid is not None:
+            cards = cards.filter(Todo.boardid==boardid)
+            counters = counters.filter(ColumnCounter.boardid==boardid)
+        actual = dict(((board, typeid), count) for board, typeid, count in cards)
+        stored = dict(((row.boardid, row.type), row.count) for row in counters)
+        fixed = 0
+        for (board, typeid) in set(actual) | set(stored):
+            count = actual.get((board, typeid), 0)
+            if (board, typeid) not in stored:
+                db.session.execute(table.insert().values(boardid=board, type=typeid, count=count))
+            elif stored[(board, typeid)] != count:
+                db.session.execute(table.update().where(table.c.boardid == board)
+                                   .where(table.c.type == typeid).values(count=count))
+            else:
+                continue
+            fixed += 1
+        return fixed
+    return runWrite(write)
+
+
+####################################################################
+# Card Positions Section
+####################################################################
+#Cards are ordered by string keys compared character by character, so a
+#card can always be given a key between the keys of two neighbours and a
+#reorder writes a single row instead of renumbering the whole column.
+#Keys have an integer part, whose first letter tells its length ("a0",
+#"a1", ... "az", "b10", ...) and which grows by one when appending, and a
+#fraction after it used to fit keys between two others ("a0V" sits between
+#"a0" and "a1"). Same scheme as the fractional-indexing library
+POSITION_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+FIRST_POSITION = "a0"
+
+def integerLength(head):
+    if 'a' <= head <= 'z':
+        return ord(head) - ord('a') + 2
+    if 'A' <= head <= 'Z':
+        return ord('Z') - ord(head) + 2
+    raise ValueError("Invalid position key %r" % head)
+
+def integerPart(key):
+    return key[:integerLength(key[0])]
+
+#Returns a fraction between fractions a and b (b may be None for "no upper bound")
+def midpoint(a, b):
+    if b is not None:
+        common = 0
+        while common < len(b) and (a[common] if common < len(a) else '0') == b[common]:
+            common += 1
+        if common > 0:
+            return b[:common] + midpoint(a[common:], b[common:])
+    low = POSITION_DIGITS.index(a[0]) if a else 0
+    high = POSITION_DIGITS.index(b[0]) if b is not None else len(POSITION_DIGITS)
+    if high - low > 1:
+        return POSITION_DIGITS[(low + high + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return POSITION_DIGITS[low] + midpoint(a[1:], None)
+
+def incrementInteger(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = POSITION_DIGITS.index(digits[i]) + 1
+        if digit < len(POSITION_DIGITS):
+            digits[i] = POSITION_DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = '0'
+    if head == 'Z':
+        return FIRST_POSITION
+    if head == 'z':
+        return None
+    head = chr(ord(head) + 1)
+    if head > 'a':
+        digits.append('0')
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+def decrementInteger(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = POSITION_DIGITS.index(digits[i]) - 1
+        if digit >= 0:
+            digits[i] = POSITION_DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = POSITION_DIGITS[-1]
+    if head == 'a':
+        return 'Z' + POSITION_DIGITS[-1]
+    if head == 'A':
+        return None
+    head = chr(ord(head) - 1)
+    if head < 'Z':
+        digits.append(POSITION_DIGITS[-1])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+#Returns a key that sorts after `before` and before `after`. Either may be
+#None for the start or the end of the column
+def positionBetween(before, after):
+    if before is not None and after is not None and before >= after:
+        raise ValueError("%r does not sort before %r" % (before, after))
+    if before is None:
+        if after is None:
+            return FIRST_POSITION
+        integer = integerPart(after)
+        if integer == 'A' + '0' * 26:
+            return integer + midpoint('', after[len(integer):])
+        if integer < after:
+            return integer
+        return decrementInteger(integer)
+    integer = integerPart(before)
+    fraction = before[len(integer):]
+    if after is None:
+        following = incrementInteger(integer)
+        return following if following is not None else integer + midpoint(fraction, None)
+    if integer == integerPart(after):
+        return integer + midpoint(fraction, after[len(integer):])
+    following = incrementInteger(integer)
+    if following is not None and following < after:
+        return following
+    return integer + midpoint(fraction, None)
+
+#Returns `count` keys in order, all after `before`
+def positionsAfter(before, count):
+    keys = list()
+    for i in range(count):
+        before = positionBetween(before, None)
+        keys.append(before)
+    return keys
+
+#Key of the last card of a column, found through the position index
+def lastPosition(boardid, typeid):
+    return db.session.query(db.func.max(Todo.position)).filter(Todo.boardid==boardid)\
+        .filter(Todo.type==typeid).scalar()
+
+#Renumbers the columns whose keys grew too long, or that have cards without
+#a key, with short evenly spaced keys. The order of the cards is kept, but
+#every card of those columns gets a new key, so the boards involved record
+#a "reordered" change and open pages reload their columns
+def rebalancePositions():
+    limit = app.config['POSITION_KEY_MAX_LENGTH']
+    columns = db.session.query(Todo.boardid, Todo.type).filter(
+        (Todo.position == None) | (db.func.length(Todo.position) > limit)).distinct().all()
+    for boardid, typeid in columns:
+        def write():
+            ids = [i for i, in db.session.query(Todo.id).filter(Todo.boardid==boardid).filter(Todo.type==typeid)
+                   .order_by(Todo.position == None, Todo.position, Todo.id)]
+            update = Todo.__table__.update().where(Todo.__table__.c.id == db.bindparam('cardid'))
+            keys = positionsAfter(None, len(ids))
+            for start in range(0, len(ids), BULK_CHUNK_SIZE):
+                db.session.execute(update.values(position=db.bindparam('key')),
+                                   [dict(cardid=i, key=key) for i, key in
+                                    zip(ids[start:start + BULK_CHUNK_SIZE], keys[start:start + BULK_CHUNK_SIZE])])
+            recordChanges(boardid, [("reordered", dict(column=workflow.typeName(typeid)))])
+        runWrite(write)
+    return len(columns)
+
+
+####################################################################
+# Board Loading Section
+####################################################################
+#Titles of the default columns, custom columns are titled after their name
+COLUMN_TITLES = {"todo": "SUCH TO DO", "doing": "VERY DOING", "done": "MANY DONE"}
+
+#Largest page a client may ask for in one /columns request
+MAX_COLUMN_PAGE_SIZE = 200
+
+#Pages are fetched with one card more than asked for. If that card is there,
+#it is dropped and the last card shown becomes the cursor of the next page
+def pageOf(cards, limit):
+    if limit is None or len(cards) <= limit:
+        return dict(cards=cards, cursor=None)
+    cards = cards[:limit]
+    return dict(cards=cards, cursor="%s:%d" % (cards[-1].position, cards[-1].id))
+
+#Fetches a board in a single query and returns the cards already
+#split into the board's columns, in the order they are shown. With a limit,
+#only the first page of each column is read: the query has one LIMITed
+#branch per column, so SQLite walks the position index of each column and
+#stops after the page, however long the column is. only limits the read
+#to some of the columns
+def loadBoard(boardid, limit=None, only=None):
+    columns = [column for column in workflow.columns(boardid) if only is None or column in only]
+    board = dict((workflow.typeName(column), []) for column in columns)
+    query = Todo.query.filter(Todo.boardid==boardid)
+    if only is not None:
+        query = query.filter(Todo.type.in_(columns))
+    if limit is not None and columns:
+        pages = [db.session.query(Todo.id).filter(Todo.boardid==boardid).filter(Todo.type==column)
+                 .order_by(Todo.position, Todo.id).limit(limit + 1).subquery().select() for column in columns]
+        query = Todo.query.filter(Todo.id.in_(union_all(*pages)))
+    for todo in query.order_by(Todo.type, Todo.position, Todo.id):
+        column = workflow.typeName(todo.type)
+        if column in board:
+            board[column].append(todo)
+    return dict((column, pageOf(cards, limit)) for column, cards in board.items())
+
+#Reads the cards of one column that come after the cursor, ordered by
+#position. Keyset pagination costs the same for the first and the
+#thousandth page. The cursor holds the position and id of the last card
+#sent, so cards deleted or moved in the meantime do not shift the pages
+def loadColumnPage(boardid, typeid, after=None, limit=None):
+    limit = limit or app.config['COLUMN_PAGE_SIZE']
+    query = Todo.query.filter(Todo.boardid==boardid).filter(Todo.type==typeid)
+    if after is not None:
+        query = query.filter(db.tuple_(Todo.position, Todo.id) > after)
+    return pageOf(query.order_by(Todo.position, Todo.id).limit(limit + 1).all(), limit)
+
+#Reads the cursor sent back by the client as a (position, id) pair,
+#raising ValueError when it is not one of ours
+def parseCursor(value):
+    if value is None or value == "":
+        return None
+    position, separator, cardid = value.rpartition(":")
+    if not separator or not position:
+        raise ValueError("Invalid cursor %r" % value)
+    return position, int(cardid)
+
+#What clients get to know about a card
+def cardData(todo):
+    return dict(id=todo.id, text=todo.text, column=workflow.typeName(todo.type), position=todo.position)
+
+#Describes every column of a board the way the index template shows it.
+#board holds what each column shows, its first page of cards and cursor
+#or its rendered fragment
+def boardView(boardid, board, counters=None):
+    stages = workflow.nextStages(boardid)
+    counters = counters or columnCounters(boardid)
+    columns = list()
+    for column in workflow.columns(boardid):
+        name = workflow.typeName(column)
+        count, limit, version = counters[column]
+        columns.append(dict(board[name], name=name, title=COLUMN_TITLES.get(name, name.upper()),
+                            movable=column in stages, count=count, limit=limit))
+    return columns
+
+#Card lists of the board page, rendered from templates/cards.html. A column
+#is only loaded and rendered when its version changed since the fragment
+#cached for it was made; versions are read first, so a fragment is never
+#stored under a version newer than its cards
+def columnFragments(boardid, counters):
+    limit = app.config['COLUMN_PAGE_SIZE']
+    fragments = dict()
+    missing = list()
+    for typeid in workflow.columns(boardid):
+        fragment = fragmentCache.get((boardid, typeid, counters[typeid][2], limit))
+        if fragment is None:
+            missing.append(typeid)
+        else:
+            fragments[workflow.typeName(typeid)] = dict(fragment=fragment)
+    if missing:
+        board = loadBoard(boardid, limit, missing)
+        for typeid in missing:
+            name = workflow.typeName(typeid)
+            fragment = Markup(render_template('cards.html', column=dict(board[name], name=name)))
+            fragmentCache.set((boardid, typeid, counters[typeid][2], limit), fragment)
+            fragments[name] = dict(fragment=fragment)
+    return fragments
+
+
+####################################################################
+# Search Section
+####################################################################
+#Cards are searched through an FTS5 index over Todo, and archived cards
+#through another one over ArchivedTodo. An index holds no copy of the text
+#(content='Todo'), and triggers on its table keep it up to date, so every
+#insert, move and delete made by the helpers above is indexed in the same
+#transaction. The board and the column are indexed too, which lets FTS5
+#narrow a search to one board and column by itself
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table}Search USING fts5("
+    "text, boardid, type, content='{table}', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS {table}Search_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}Search(rowid, text, boardid, type) VALUES (new.id, new.text, new.boardid, new.type); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}Search_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}Search({table}Search, rowid, text, boardid, type) "
+    "VALUES ('delete', old.id, old.text, old.boardid, old.type); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}Search_update AFTER UPDATE OF text, boardid, type ON {table} BEGIN "
+    "INSERT INTO {table}Search({table}Search, rowid, text, boardid, type) "
+    "VALUES ('delete', old.id, old.text, old.boardid, old.type); "
+    "INSERT INTO {table}Search(rowid, text, boardid, type) VALUES (new.id, new.text, new.boardid, new.type); END",
+]
+SEARCH_TRIGGERS = ("insert", "delete", "update")
+SEARCHED_TABLES = [Todo.__table__, ArchivedTodo.__table__]
+
+#Largest number of results a client may ask for in one /search request
+MAX_SEARCH_RESULTS = 100
+
+#Words of a search, a trailing * makes a word match as a prefix
+SEARCH_TERM = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+def createSearchIndex(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(statement.format(table=target.name))
+
+def dropSearchIndex(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for trigger in SEARCH_TRIGGERS:
+            connection.execute('DROP TRIGGER IF EXISTS %sSearch_%s' % (target.name, trigger))
+        connection.execute('DROP TABLE IF EXISTS %sSearch' % target.name)
+
+for table in SEARCHED_TABLES:
+    event.listen(table, 'after_create', createSearchIndex)
+    event.listen(table, 'before_drop', dropSearchIndex)
+
+#Boards created before search existed get the index, filled from their
+#cards, and indexes made when cards were searched by owner are rebuilt
+def addSearchIndex():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for table in SEARCHED_TABLES:
+        ddl = db.engine.execute("SELECT sql FROM sqlite_master WHERE name = ?", table.name + "Search").scalar()
+        if ddl is None or "boardid" not in ddl:
+            with db.engine.begin() as connection:
+                dropSearchIndex(table, connection)
+                createSearchIndex(table, connection)
+                connection.execute("INSERT INTO {0}Search({0}Search) VALUES ('rebuild')".format(table.name))
+
+#Turns what the user typed into an FTS5 query made of quoted terms, so
+#quotes and operators in the input cannot break the query syntax
+def searchExpression(query):
+    terms = ['"%s"%s' % (term, star) for term, star in SEARCH_TERM.findall(query)]
+    return " ".join(terms[:16])
+
+#Best matching cards of a board, optionally only those of one column.
+#model is Todo to search the board, or ArchivedTodo to search the archive
+def searchCards(boardid, query, typeid=None, limit=20, model=Todo):
+    expression = searchExpression(query)
+    if not expression:
+        return []
+    if db.engine.dialect.name != 'sqlite':
+        cards = model.query.filter(model.boardid==boardid).filter(model.text.ilike('%%%s%%' % query.strip()))
+        if typeid is not None:
+            cards = cards.filter(model.type==typeid)
+        return cards.order_by(model.id).limit(limit).all()
+    match = 'boardid : "%s" AND text : (%s)' % (int(boardid), expression)
+    if typeid is not None:
+        match += ' AND type : "%s"' % int(typeid)
+    return db.session.execute(
+        "SELECT {0}.id, {0}.text, {0}.type, {0}.position FROM {0}Search "
+        "JOIN {0} ON {0}.id = {0}Search.rowid WHERE {0}Search MATCH :match "
+        "ORDER BY bm25({0}Search, 1.0, 0.0, 0.0), {0}.id LIMIT :limit".format(model.__tablename__),
+        dict(match=match, limit=limit)).fetchall()
+
+
+####################################################################
+# Board Versions Section
+####################################################################
+#Adds one to the version of a board inside the current transaction, so the
+#new version becomes visible together with the change that caused it.
+#Returns the new version
+def bumpBoardVersion(boardid):
+    updated = BoardVersion.query.filter_by(boardid=boardid)\
+        .update({BoardVersion.version: BoardVersion.version + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(BoardVersion(boardid=boardid, version=1))
+        return 1
+    return boardVersion(boardid)
+
+#Current version of a board, 0 for boards that never changed
+def boardVersion(boardid):
+    return db.session.query(BoardVersion.version).filter_by(boardid=boardid).scalar() or 0
+
+#Answers a read of a board with 304 Not Modified when the client already has
+#its current version, so polling an unchanged board costs one primary key
+#lookup. The version is read before the data: a change landing in between
+#is then sent with an older ETag and fetched again, never the other way round
+def conditionalBoardResponse(boardid, build):
+    etag = '%s-%s' % (boardid, boardVersion(boardid))
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+####################################################################
+# Change Stream Section
+####################################################################
+#In-process publish/subscribe of board changes. Every subscriber gets its
+#own bounded queue; one that falls too far behind is told to reload instead
+#of holding the publisher back. Any object with the same subscribe,
+#unsubscribe and publish methods (for instance one relaying through Redis
+#pub/sub to other processes) can take its place in `changes`
+class LocalPubSub(object):
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.channels = dict()
+
+    def subscribe(self, channel):
+        subscription = queue.Queue(self.maxsize)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self.lock:
+            subscribers = self.channels.get(channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.channels.pop(channel, None)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                with subscription.mutex:
+                    subscription.queue.clear()
+                    subscription.queue.append(("reset", {}, None))
+                    subscription.not_empty.notify()
+
+#Relays changes through Redis pub/sub, so that pages streaming from one
+#worker process hear about the writes of every other. Each process keeps
+#its subscribers in memory like LocalPubSub and listens to every board on
+#one connection. Its own changes come back through Redis as well, so
+#every subscriber gets them once and in order. While Redis is out of
+#reach changes only reach this process, and once the listener is back
+#every stream is told to reload, as it may have missed some
+class RedisPubSub(LocalPubSub):
+    def __init__(self, url, prefix='changes:', maxsize=1000):
+        LocalPubSub.__init__(self, maxsize)
+        self.url = url
+        self.prefix = prefix
+        self.client = RedisClient(url)
+        self.listener = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.listen, name="change-listener", daemon=True)
+        self.thread.start()
+
+    def publish(self, channel, message):
+        try:
+            self.client.execute('PUBLISH', self.prefix + channel, json.dumps(message))
+        except (OSError, EOFError, RuntimeError) as error:
+            log.warning("Changes not relayed through Redis: %s", error)
+            LocalPubSub.publish(self, channel, message)
+
+    def resetAll(self):
+        with self.lock:
+            channels = list(self.channels)
+        for channel in channels:
+            LocalPubSub.publish(self, channel, ("reset", {}, None))
+
+    def listen(self):
+        missed = False
+        while not self.stopped:
+            self.listener = RedisClient(self.url)
+            try:
+                self.listener.execute('PSUBSCRIBE', self.prefix + '*')
+                #Boards can stay quiet for longer than any socket timeout
+                self.listener.local.connection.settimeout(None)
+                if missed:
+                    self.resetAll()
+                while not self.stopped:
+                    kind, pattern, channel, data = self.listener.reply()
+                    if kind == b'pmessage':
+                        channel = channel.decode('utf-8')[len(self.prefix):]
+                        LocalPubSub.publish(self, channel, tuple(json.loads(data.decode('utf-8'))))
+            except (OSError, EOFError, RuntimeError, ValueError) as error:
+                if not self.stopped:
+                    log.warning("Change listener lost Redis, reconnecting: %s", error)
+                    time.sleep(1)
+            missed = True
+            self.closeListener()
+
+    def closeListener(self):
+        connection = getattr(self.listener.local, 'connection', None) if self.listener else None
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    #Stops the listener, for instance when create_app() switches stores
+    def close(self):
+        self.stopped = True
+        self.closeListener()
+
+changes = LocalPubSub()
+
+#Records changes made to a board inside the current transaction: bumps the
+#board version once, appends the changes to the change log under that
+#version with a single executemany, and keeps them for the change stream.
+#Changes are published by the after_commit hook below and forgotten on
+#rollback, so open pages never hear about writes that did not happen.
+#Each change is a (kind, card) pair; workflow edits carry an empty card
+def recordChanges(boardid, changes):
+    if boardid is None or not changes:
+        return
+    version = bumpBoardVersion(boardid)
+    now = datetime.datetime.utcnow()
+    rows = [dict(boardid=boardid, version=version, kind=kind, cardid=card.get("id"), column=card.get("column"),
+                 text=card.get("text"), position=card.get("position"), created=now)
+            for kind, card in changes]
+    db.session.execute(ChangeLog.__table__.insert(), rows)
+    #The columns whose cards changed get the new version, which retires
+    #their cached fragments
+    touched = set(workflow.typeId(name) for kind, card in changes
+                  for name in (card.get("column"), card.get("previous")) if name)
+    touched.discard(None)
+    if touched:
+        ColumnCounter.query.filter(ColumnCounter.boardid==boardid).filter(ColumnCounter.type.in_(touched))\
+            .update({ColumnCounter.version: version}, synchronize_session=False)
+    pending = db.session.info.setdefault('changes', [])
+    for kind, card in changes:
+        pending.append((str(boardid), kind, card, version))
+
+@event.listens_for(db.session, 'after_commit')
+def publishChanges(session):
+    for boardid, kind, card, version in session.info.pop('changes', []):
+        changes.publish(boardid, (kind, card, version))
+
+@event.listens_for(db.session, 'after_rollback')
+def discardChanges(session):
+    session.info.pop('changes', None)
+
+#Formats the messages of a subscription as Server-Sent Events. Sends a
+#comment line when nothing happened for a while so proxies keep the
+#connection open, and unsubscribes once the client goes away
+def eventStream(boardid, subscription):
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                kind, card, version = subscription.get(timeout=app.config['CHANGE_STREAM_HEARTBEAT'])
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if version is not None:
+                yield "id: %d\n" % version
+            yield "event: %s\ndata: %s\n\n" % (kind, json.dumps(card))
+    finally:
+        changes.unsubscribe(boardid, subscription)
+
+
+####################################################################
+# Delta Sync Section
+####################################################################
+#Raised when the changes a client asks for were compacted away or belong
+#to a version the board never had, so it has to load the whole board again
+class ResyncRequired(Exception):
+    pass
+
+#What a change is about: a card, or for changes without a card, the kind
+#of change and its column. Only the latest change of each subject matters
+def changeSubject():
+    return db.func.coalesce(db.cast(ChangeLog.cardid, db.String),
+                            ChangeLog.kind + ':' + db.func.coalesce(ChangeLog.column, ''))
+
+#Returns what changed on a board after version `since`, compacted to the
+#latest state of every card: cards added or moved since then with their
+#current text, column and position, the ids of cards deleted since then,
+#and the columns whose cards were all given new positions
+def changesSince(boardid, since):
+    state = db.session.query(BoardVersion.version, BoardVersion.compacted).filter_by(boardid=boardid).first()
+    version, compacted = state or (0, 0)
+    if since < compacted or since > version:
+        raise ResyncRequired()
+    latest = db.session.query(db.func.max(ChangeLog.id)).filter(ChangeLog.boardid==boardid)\
+        .filter(ChangeLog.version > since).group_by(changeSubject())
+    rows = ChangeLog.query.filter(ChangeLog.id.in_(latest)).order_by(ChangeLog.id).all()
+    delta = dict(version=version, cards=[], deleted=[], reordered=[], workflow=False)
+    for row in rows:
+        if row.kind == "workflow":
+            delta["workflow"] = True
+        elif row.kind == "reordered":
+            delta["reordered"].append(row.column)
+        elif row.kind in ("deleted", "archived"):
+            delta["deleted"].append(row.cardid)
+        else:
+            delta["cards"].append(dict(id=row.cardid, text=row.text, column=row.column, position=row.position))
+    return delta
+
+#Keeps the change log small. Entries superseded by a later change of the same
+#card never show up in a delta, so they go at once. Entries older than
+#CHANGE_LOG_RETENTION go too, and the board remembers the newest version it
+#dropped, so clients that synced before it are told to reload the board
+def compactChangeLog(now=None):
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=app.config['CHANGE_LOG_RETENTION'])
+    try:
+        latest = db.session.query(db.func.max(ChangeLog.id)).group_by(ChangeLog.boardid, changeSubject())
+        superseded = ChangeLog.query.filter(~ChangeLog.id.in_(latest)).delete(synchronize_session=False)
+        expired = db.session.query(ChangeLog.boardid, db.func.max(ChangeLog.version))\
+            .filter(ChangeLog.created < cutoff).group_by(ChangeLog.boardid).all()
+        for boardid, version in expired:
+            BoardVersion.query.filter_by(boardid=boardid).filter(BoardVersion.compacted < version)\
+                .update({BoardVersion.compacted: version}, synchronize_session=False)
+        old = ChangeLog.query.filter(ChangeLog.created < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return superseded + old
+
+
+####################################################################
+# Background Tasks Section
+####################################################################
+log = logging.getLogger(__name__)
+
+#Runs a function every `interval` seconds in a daemon thread, inside an
+#application context. Failures are logged and the next run happens anyway
+def runPeriodically(interval, function):
+    def loop():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    function()
+                except Exception:
+                    log.exception("Background task %s failed", function.__name__)
+                finally:
+                    db.session.remove()
+    thread = threading.Thread(target=loop, name=function.__name__, daemon=True)
+    thread.start()
+    return thread
+
+#Starts the job workers and the housekeeping that keeps the board tables
+#small, once per process however often it is called
+backgroundTasksStarted = threading.Event()
+
+def startBackgroundTasks():
+    if backgroundTasksStarted.is_set():
+        return
+    backgroundTasksStarted.set()
+    runPeriodically(app.config['CHANGE_LOG_COMPACT_INTERVAL'], compactChangeLog)
+    runPeriodically(app.config['POSITION_REBALANCE_INTERVAL'], rebalancePositions)
+    runPeriodically(app.config['ARCHIVE_INTERVAL'], archiveCards)
+    runPeriodically(app.config['JOB_TIDY_INTERVAL'], tidyJobs)
+    jobs.start(app.config['JOB_WORKERS'])
+
+@app.cli.command('init-db')
+def initDatabaseCommand():
+    dbHelper()
+    print("Database ready")
+
+@app.cli.command('compact-changes')
+def compactChangesCommand():
+    print("Removed %d change log entries" % compactChangeLog())
+
+@app.cli.command('repair-counters')
+def repairCountersCommand():
+    print("Fixed %d column counters" % repairCounters())
+
+@app.cli.command('archive-cards')
+def archiveCardsCommand():
+    print("Archived %d cards" % archiveCards())
+
+@app.cli.command('run-jobs')
+def runJobsCommand():
+    print("Ran %d jobs" % runPendingJobs())
+
+#Long running process doing the background work of web workers started
+#with BACKGROUND_TASKS turned off
+@app.cli.command('run-worker')
+def runWorkerCommand():
+    startBackgroundTasks()
+    print("Running jobs and housekeeping, press Ctrl+C to stop")
+    while True:
+        time.sleep(3600)
+
+
+####################################################################
+# Bulk Operations Section
+####################################################################
+#SQLite refuses statements with more than 999 bound parameters,
+#so long lists of ids are sent in chunks of this size
+BULK_CHUNK_SIZE = 500
+
+BATCH_OPERATIONS = ("move", "delete")
+
+#Moves bind three parameters per card (id and position twice), so they
+#are sent in smaller chunks
+MOVE_CHUNK_SIZE = 250
+
+#Splits a list of ids into lists of at most `size` ids
+def chunked(ids, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+#Turns submitted card ids into integers, dropping duplicates
+#and anything that is not a number
+def parseTaskIds(values):
+    ids = list()
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return list(dict.fromkeys(ids))
+
+#Applies a list of move/delete operations to the cards of a board inside
+#one transaction (see runWrite). The current column of every card is read with one query,
+#the operations are replayed in memory and the outcome is written back with
+#set-based UPDATE/DELETE statements, so the number of statements does not
+#grow with the number of cards. Returns, for each operation, the result of
+#every id: "moved", "deleted", "final_stage" or "not_found"
+def applyBatch(boardid, operations):
+    return runWrite(lambda: batchWrite(boardid, operations))
+
+def batchWrite(boardid, operations):
+    ids = list(dict.fromkeys(i for operation in operations for i in operation["ids"]))
+    current = dict()
+    texts = dict()
+    positions = dict()
+    for chunk in chunked(ids):
+        rows = db.session.query(Todo.id, Todo.type, Todo.text, Todo.position)\
+            .filter(Todo.id.in_(chunk)).filter(Todo.boardid==boardid)
+        for i, tasktype, text, position in rows:
+            current[i] = tasktype
+            texts[i] = text
+            positions[i] = position
+    stages = workflow.nextStages(boardid)
+    state = dict(current)
+    results = list()
+    for operation in operations:
+        outcome = dict()
+        for i in operation["ids"]:
+            if i not in state:
+                outcome[i] = "not_found"
+            elif operation["op"] == "delete":
+                del state[i]
+                outcome[i] = "deleted"
+            elif state[i] in stages:
+                state[i] = stages[state[i]]
+                outcome[i] = "moved"
+            else:
+                outcome[i] = "final_stage"
+        results.append({"op": operation["op"], "results": outcome})
+
+    deleted = [i for i in current if i not in state]
+    moved = dict()
+    for i, newtype in state.items():
+        if newtype != current[i]:
+            moved.setdefault(newtype, []).append(i)
+    deltas = dict()
+    for i in deleted:
+        deltas[current[i]] = deltas.get(current[i], 0) - 1
+    for newtype, cards in moved.items():
+        deltas[newtype] = deltas.get(newtype, 0) + len(cards)
+        for i in cards:
+            deltas[current[i]] = deltas.get(current[i], 0) - 1
+    changeCounts(boardid, deltas)
+    for chunk in chunked(deleted):
+        Todo.query.filter(Todo.id.in_(chunk)).filter(Todo.boardid==boardid)\
+            .delete(synchronize_session=False)
+    #Moved cards go to the end of their new column, keeping their order.
+    #Each card gets its own key, picked by a CASE inside the one UPDATE
+    now = datetime.datetime.utcnow()
+    for newtype, cards in moved.items():
+        cards.sort(key=lambda i: (positions[i] or "", i))
+        positions.update(zip(cards, positionsAfter(lastPosition(boardid, newtype), len(cards))))
+        for chunk in chunked(cards, MOVE_CHUNK_SIZE):
+            position = db.case(dict((i, positions[i]) for i in chunk), value=Todo.id)
+            Todo.query.filter(Todo.id.in_(chunk)).filter(Todo.boardid==boardid)\
+                .update({Todo.type: newtype, Todo.position: position, Todo.movedat: now}, synchronize_session=False)
+    changes = [("deleted", dict(id=i, column=workflow.typeName(current[i]))) for i in deleted]
+    for newtype, cards in moved.items():
+        for i in cards:
+            changes.append(("moved", dict(id=i, text=texts[i], column=workflow.typeName(newtype),
+                                          position=positions[i], previous=workflow.typeName(current[i]))))
+    recordChanges(boardid, changes)
+    return results
+
+#Raised when a card cannot go where it was asked to
+class InvalidMove(Exception):
+    pass
+
+#Drag and drop: puts a card of the board in `column` right after the card
+#`after`, or first in the column when `after` is None. The new key is picked
+#between the keys of its new neighbours, so only the moved card's row is
+#written. Returns the card, or None when the board has no such card
+def repositionCard(boardid, cardid, column, after=None):
+    typeid = workflow.typeId(column)
+    def write():
+        card = db.session.query(Todo.type, Todo.text).filter(Todo.id==cardid).filter(Todo.boardid==boardid).first()
+        if card is None:
+            return None
+        if typeid not in workflow.columns(boardid):
+            raise InvalidMove("%s is not a column of this board" % column)
+        if typeid != card.type and not workflow.canMove(boardid, card.type, typeid):
+            raise InvalidMove("Cards cannot move from %s to %s" % (workflow.typeName(card.type), column))
+        if typeid != card.type:
+            changeCounts(boardid, {card.type: -1, typeid: 1})
+        siblings = db.session.query(Todo.position).filter(Todo.boardid==boardid).filter(Todo.type==typeid)\
+            .filter(Todo.id != cardid).order_by(Todo.position, Todo.id)
+        previous = None
+        if after is not None:
+            anchor = db.session.query(Todo.position).filter(Todo.id==after).filter(Todo.boardid==boardid)\
+                .filter(Todo.type==typeid).first()
+            if anchor is None or after == cardid:
+                raise InvalidMove("Card %s is not in %s" % (after, column))
+            previous = anchor.position
+            siblings = siblings.filter(db.tuple_(Todo.position, Todo.id) > (previous, after))
+        following = siblings.limit(1).scalar()
+        try:
+            position = positionBetween(previous, following)
+        except ValueError:
+            raise InvalidMove("Cards around the new place share a position, try again later")
+        values = {Todo.type: typeid, Todo.position: position}
+        if typeid != card.type:
+            values[Todo.movedat] = datetime.datetime.utcnow()
+        Todo.query.filter(Todo.id==cardid).update(values, synchronize_session=False)
+        moved = dict(id=cardid, text=card.text, column=column, position=position,
+                     previous=workflow.typeName(card.type))
+        recordChanges(boardid, [("moved", moved)])
+        return moved
+    return runWrite(write)
+
+#Validates the body of a batch request, returning the list of operations
+#or None when the body is malformed
+def parseBatch(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get("operations"), list):
+        return None
+    operations = list()
+    for operation in payload["operations"]:
+        if not isinstance(operation, dict) or operation.get("op") not in BATCH_OPERATIONS:
+            return None
+        if not isinstance(operation.get("ids"), list):
+            return None
+        operations.append({"op": operation["op"], "ids": parseTaskIds(operation["ids"])})
+    return operations
+
+
+####################################################################
+# Archive Section
+####################################################################
+#Cards that sat in an archive column (done by default) for ARCHIVE_AFTER
+#seconds move from Todo to ArchivedTodo, so the table every board read
+#walks only holds the cards people still work on. Archived cards are
+#listed and searched through /archive
+ARCHIVE_PAGE_SIZE = 50
+
+#Moves the old cards of the archive columns to the archive,
+#BULK_CHUNK_SIZE cards per write. Each board records the cards it lost
+#as "archived" changes, which clients handle like deletions.
+#Returns how many cards were archived
+def archiveCards(now=None):
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=app.config['ARCHIVE_AFTER'])
+    types = [workflow.typeId(name) for name in app.config['ARCHIVE_COLUMNS']]
+    types = [typeid for typeid in types if typeid is not None]
+    if not types:
+        return 0
+    #Cards from before movedat existed start their wait now
+    runWrite(lambda: Todo.query.filter(Todo.movedat == None)
+             .update({Todo.movedat: now}, synchronize_session=False))
+    columns = [Todo.id, Todo.text, Todo.userid, Todo.boardid, Todo.type, Todo.position, Todo.movedat]
+    def write():
+        rows = db.session.query(Todo.id, Todo.boardid, Todo.type).filter(Todo.type.in_(types))\
+            .filter(Todo.movedat < cutoff).limit(BULK_CHUNK_SIZE).all()
+        if rows:
+            ids = [row.id for row in rows]
+            boards = OrderedDict()
+            deltas = dict()
+            for row in rows:
+                card = dict(id=row.id, column=workflow.typeName(row.type))
+                boards.setdefault(row.boardid, []).append(("archived", card))
+                counts = deltas.setdefault(row.boardid, dict())
+                counts[row.type] = counts.get(row.type, 0) - 1
+            #Counted before the cards leave, like every other write
+            for boardid in boards:
+                changeCounts(boardid, deltas[boardid])
+            select = db.select(columns + [db.literal(now, db.DateTime)]).where(Todo.id.in_(ids))
+            db.session.execute(ArchivedTodo.__table__.insert().from_select(
+                [column.name for column in columns] + ['archivedat'], select))
+            Todo.query.filter(Todo.id.in_(ids)).delete(synchronize_session=False)
+            for boardid, changes in boards.items():
+                recordChanges(boardid, changes)
+        return len(rows)
+    archived = 0
+    while True:
+        count = runWrite(write)
+        archived += count
+        if count < BULK_CHUNK_SIZE:
+            return archived
+
+#A page of the archive of a board, most recently created cards first.
+#The cursor is the id of the last card of the previous page
+def loadArchivePage(boardid, before=None, limit=ARCHIVE_PAGE_SIZE):
+    query = ArchivedTodo.query.filter(ArchivedTodo.boardid==boardid)
+    if before is not None:
+        query = query.filter(ArchivedTodo.id < before)
+    cards = query.order_by(ArchivedTodo.id.desc()).limit(limit + 1).all()
+    cursor = None
+    if len(cards) > limit:
+        cards = cards[:limit]
+        cursor = str(cards[-1].id)
+    return dict(cards=cards, cursor=cursor)
+
+
+####################################################################
+# Import and Export Section
+####################################################################
+#Cards inserted by one executemany statement, each chunk being one write
+IMPORT_CHUNK_SIZE = 1000
+#Cards read per query while an export streams
+EXPORT_PAGE_SIZE = 1000
+#Rejected lines described in the import report, the others are only counted
+MAX_IMPORT_ERRORS = 100
+IMPORT_FORMATS = ("csv", "jsonl")
+EXPORT_MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+#Reads an upload one line at a time, yielding (line number, record) pairs
+#where record is a dict, or None for JSONL lines that are not an object.
+#CSV files need a header row naming the text and column fields
+def importRecords(stream, format):
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+#Inserts a chunk of (column, text) cards added by a user at the end of their
+#columns with one executemany statement, and tells clients to reload those columns
+def insertCards(boardid, cards, userid=None):
+    def write():
+        rows = list()
+        columns = list(OrderedDict.fromkeys(typeid for typeid, text in cards))
+        for typeid in columns:
+            texts = [text for column, text in cards if column == typeid]
+            changeCount(boardid, typeid, len(texts))
+            positions = positionsAfter(lastPosition(boardid, typeid), len(texts))
+            rows.extend(dict(text=text, userid=userid, boardid=boardid, type=typeid, position=position)
+                        for text, position in zip(texts, positions))
+        db.session.execute(Todo.__table__.insert(), rows)
+        recordChanges(boardid, [("reordered", dict(column=workflow.typeName(typeid))) for typeid in columns])
+        return len(rows)
+    return runWrite(write)
+
+#Adds the cards a user imports to a board, IMPORT_CHUNK_SIZE at a
+#time, so memory use does not depend on the size of the upload. Cards go to
+#the first column when they name none. Bad lines are skipped and reported.
+#A chunk that would go over a WIP limit stops the import, keeping the
+#chunks imported before it, and so does a file that cannot be read on
+def importCards(boardid, records, userid=None):
+    report = dict(imported=0, rejected=0, errors=[])
+    try:
+        importChunks(boardid, records, report, userid)
+    except WipLimitReached as error:
+        report["error"] = str(error)
+    except UnicodeDecodeError:
+        report["error"] = "The file is not UTF-8 text"
+    except csv.Error as error:
+        report["error"] = "The file is not valid CSV: %s" % error
+    return report
+
+def importChunks(boardid, records, report, userid=None):
+    columns = dict((workflow.typeName(typeid), typeid) for typeid in workflow.columns(boardid))
+    default = workflow.typeName(workflow.columns(boardid)[0])
+    maxlength = Todo.text.type.length
+    chunk = list()
+    for line, record in records:
+        if record is None:
+            error = "Not a card"
+        else:
+            text, column = record.get("text"), record.get("column") or default
+            if not isinstance(text, str) or not text.strip():
+                error = "Missing text"
+            elif len(text) > maxlength:
+                error = "Text longer than %d characters" % maxlength
+            elif not isinstance(column, str) or column not in columns:
+                error = "Unknown column %s" % column
+            else:
+                error = None
+        if error:
+            report["rejected"] += 1
+            if len(report["errors"]) < MAX_IMPORT_ERRORS:
+                report["errors"].append(dict(line=line, error=error))
+            continue
+        chunk.append((columns[column], text))
+        if len(chunk) == IMPORT_CHUNK_SIZE:
+            report["imported"] += insertCards(boardid, chunk, userid)
+            chunk = list()
+    if chunk:
+        report["imported"] += insertCards(boardid, chunk, userid)
+
+#Yields a board as CSV or JSONL, column by column in card order.
+#Cards are read EXPORT_PAGE_SIZE at a time with the same keyset pagination
+#as the board, as plain rows so none of them stays in the session
+def exportCards(boardid, format):
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "text", "column", "position"])
+    for typeid in workflow.columns(boardid):
+        column = workflow.typeName(typeid)
+        after = None
+        while True:
+            query = db.session.query(Todo.id, Todo.text, Todo.position).filter(Todo.boardid==boardid)\
+                .filter(Todo.type==typeid)
+            if after is not None:
+                query = query.filter(db.tuple_(Todo.position, Todo.id) > after)
+            page = query.order_by(Todo.position, Todo.id).limit(EXPORT_PAGE_SIZE).all()
+            if format == "csv":
+                writer.writerows((card.id, card.text, column, card.position) for card in page)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                yield "".join(json.dumps(dict(id=card.id, text=card.text, column=column, position=card.position)) + "\n"
+                              for card in page)
+            if len(page) < EXPORT_PAGE_SIZE:
+                break
+            after = (page[-1].position, page[-1].id)
+
+
+####################################################################
+# Jobs Section
+####################################################################
+#Work that would keep a request busy for seconds, like clearing a long
+#column or copying a board, is queued in the Job table and done by worker
+#threads while the request answers at once with the job's id. The queue
+#lives in the database, so queued jobs survive restarts and the workers of
+#every process share it: a worker takes a job with an UPDATE that only
+#succeeds while the job is still queued
+JOB_KINDS = OrderedDict()
+
+#Errors that would happen again on every attempt, so the job fails at once
+PERMANENT_JOB_ERRORS = (WipLimitReached, InvalidMove, InvalidMember, LookupError, ValueError)
+
+#Jobs listed by GET /jobs
+JOB_LIST_SIZE = 20
+
+metrics.counter('kanban_jobs_total', 'Job attempts, by kind of job and outcome')
+metrics.histogram('kanban_job_duration_seconds', 'Time spent running jobs, by kind of job')
+
+#Registers the function doing a kind of job, which members with at least
+#`role` on the board may queue. parse(boardid, payload) checks the body of
+#the request and returns the arguments of the job, raising ValueError when
+#they are wrong. The function gets the board id, the id of the user who
+#queued the job and those arguments, and returns the job's result
+def jobHandler(kind, role, parse):
+    def register(function):
+        JOB_KINDS[kind] = (function, role, parse)
+        return function
+    return register
+
+#Keeps JOB_WORKERS threads taking jobs from the queue. Queuing a job wakes
+#them up; jobs queued by other processes are found within JOB_POLL_INTERVAL
+class JobRunner(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.threads = list()
+        self.stopped = False
+
+    def start(self, workers):
+        with self.lock:
+            self.stopped = False
+            while len(self.threads) < workers:
+                thread = threading.Thread(target=self.loop, name="job-worker-%d" % len(self.threads), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            threads, self.threads = self.threads, list()
+        self.wakeup.set()
+        for thread in threads:
+            thread.join()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def loop(self):
+        while not self.stopped:
+            with app.app_context():
+                try:
+                    worked = runNextJob()
+                except Exception:
+                    log.exception("Job runner failed")
+                    worked = False
+                finally:
+                    db.session.remove()
+            if not worked and not self.stopped:
+                self.wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+                self.wakeup.clear()
+
+jobs = JobRunner()
+
+#Queues a job and returns its id
+def enqueueJob(kind, boardid, userid, arguments):
+    def write():
+        job = Job(kind=kind, boardid=boardid, userid=userid, payload=json.dumps(arguments))
+        db.session.add(job)
+        db.session.flush()
+        return job.id
+    jobid = runWrite(write)
+    jobs.notify()
+    return jobid
+
+#Takes the oldest due job off the queue, or returns None when there is none.
+#Another worker may take a job between the SELECT and the UPDATE, in which
+#case the next candidate is tried
+def claimJob(now):
+    table = Job.__table__
+    candidates = db.session.query(Job.id).filter(Job.status == "queued").filter(Job.runafter <= now)\
+        .order_by(Job.runafter, Job.id).limit(5).all()
+    for jobid, in candidates:
+        claimed = runWrite(lambda: db.session.execute(
+            table.update().where(table.c.id == jobid).where(table.c.status == "queued")
+            .values(status="running", attempts=table.c.attempts + 1, started=now)).rowcount)
+        if claimed:
+            return Job.query.get(jobid)
+    return None
+
+def finishJob(jobid, values):
+    runWrite(lambda: Job.query.filter(Job.id == jobid).update(values, synchronize_session=False))
+
+#Runs the next due job. A job that fails is queued again after a delay
+#growing with its attempts, until it made JOB_MAX_ATTEMPTS of them or it
+#failed with one of the PERMANENT_JOB_ERRORS. Returns False when no job was due
+def runNextJob(now=None):
+    now = now or datetime.datetime.utcnow()
+    job = claimJob(now)
+    if job is None:
+        return False
+    jobid, kind, attempts = job.id, job.kind, job.attempts
+    start = time.perf_counter()
+    try:
+        if kind not in JOB_KINDS:
+            raise LookupError("Unknown kind of job %s" % kind)
+        result = JOB_KINDS[kind][0](job.boardid, job.userid, json.loads(job.payload or "{}"))
+    except Exception as error:
+        db.session.rollback()
+        log.warning("Job %d (%s) failed on attempt %d: %s", jobid, kind, attempts, error)
+        values = dict(error=str(error) or error.__class__.__name__)
+        if isinstance(error, PERMANENT_JOB_ERRORS) or attempts >= app.config['JOB_MAX_ATTEMPTS']:
+            values.update(status="failed", finished=datetime.datetime.utcnow())
+        else:
+            values.update(status="queued", runafter=now + datetime.timedelta(
+                seconds=app.config['JOB_RETRY_DELAY'] * attempts))
+        finishJob(jobid, values)
+        metrics.inc('kanban_jobs_total', dict(kind=kind, outcome="failed" if values["status"] == "failed" else "retried"))
+    else:
+        finishJob(jobid, dict(status="done", result=json.dumps(result), error=None,
+                              finished=datetime.datetime.utcnow()))
+        metrics.inc('kanban_jobs_total', dict(kind=kind, outcome="done"))
+    metrics.observe('kanban_job_duration_seconds', dict(kind=kind), time.perf_counter() - start)
+    return True
+
+#Runs the due jobs one after the other in the calling thread, for the
+#run-jobs command. Returns how many were run
+def runPendingJobs(now=None):
+    count = 0
+    while runNextJob(now):
+        count += 1
+    return count
+
+#Queues again the jobs whose worker went away while running them, and
+#removes the ended jobs older than JOB_RETENTION. Returns both counts
+def tidyJobs(now=None):
+    now = now or datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=app.config['JOB_TIMEOUT'])
+    old = now - datetime.timedelta(seconds=app.config['JOB_RETENTION'])
+    requeued = runWrite(lambda: Job.query.filter(Job.status == "running").filter(Job.started < stale)
+                        .update({Job.status: "queued", Job.runafter: now}, synchronize_session=False))
+    removed = runWrite(lambda: Job.query.filter(Job.status.in_(("done", "failed"))).filter(Job.finished < old)
+                       .delete(synchronize_session=False))
+    return requeued, removed
+
+#What clients get to know about a job
+def jobData(job):
+    return dict(id=job.id, kind=job.kind, board=job.boardid, status=job.status, attempts=job.attempts,
+                result=json.loads(job.result) if job.result else None, error=job.error,
+                created=job.created.isoformat() + "Z", finished=job.finished.isoformat() + "Z" if job.finished else None)
+
+#Deletes every card of a column, BULK_CHUNK_SIZE cards per write, so other
+#writers get the database in between. Returns how many cards were deleted
+def clearColumn(boardid, typeid):
+    deleted = 0
+    while True:
+        ids = [i for i, in db.session.query(Todo.id).filter(Todo.boardid==boardid).filter(Todo.type==typeid)
+               .limit(BULK_CHUNK_SIZE)]
+        if not ids:
+            return deleted
+        applyBatch(boardid, [dict(op="delete", ids=ids)])
+        deleted += len(ids)
+
+#Copies the columns, moves, WIP limits and cards of a board to a new board
+#owned by userid, reading the cards IMPORT_CHUNK_SIZE at a time in board
+#order. A copy that fails halfway is removed, so a retry starts afresh.
+#Returns the id of the new board
+def copyBoard(boardid, userid, name):
+    copy = createBoard(userid, name)
+    try:
+        def write():
+            for column in BoardColumn.query.filter_by(boardid=boardid):
+                db.session.add(BoardColumn(boardid=copy, type=column.type, position=column.position))
+            for transition in TodoTransition.query.filter_by(boardid=boardid):
+                db.session.add(TodoTransition(boardid=copy, fromtype=transition.fromtype, totype=transition.totype))
+        runWrite(write)
+        workflow.invalidate()
+        for typeid in workflow.columns(boardid):
+            after = None
+            while True:
+                query = db.session.query(Todo.id, Todo.text, Todo.position).filter(Todo.boardid==boardid)\
+                    .filter(Todo.type==typeid)
+                if after is not None:
+                    query = query.filter(db.tuple_(Todo.position, Todo.id) > after)
+                page = query.order_by(Todo.position, Todo.id).limit(IMPORT_CHUNK_SIZE).all()
+                if page:
+                    insertCards(copy, [(typeid, card.text) for card in page], userid)
+                if len(page) < IMPORT_CHUNK_SIZE:
+                    break
+                after = (page[-1].position, page[-1].id)
+        limits = dict((workflow.typeName(typeid), limit) for typeid, (count, limit, version)
+                      in columnCounters(boardid).items() if limit is not None)
+        if limits:
+            setColumnLimits(copy, limits)
+    except Exception:
+        db.session.rollback()
+        deleteBoard(copy)
+        raise
+    return copy
+
+#Removes a board with its cards, workflow, counters and members
+def deleteBoard(boardid):
+    def write():
+        for model in (Todo, BoardColumn, TodoTransition, ColumnCounter, BoardVersion, ChangeLog):
+            model.query.filter(model.boardid == boardid).delete(synchronize_session=False)
+        for member in BoardMember.query.filter_by(boardid=boardid):
+            db.session.delete(member)
+        Board.query.filter(Board.id == boardid).delete(synchronize_session=False)
+    runWrite(write)
+    workflow.invalidate()
+
+def parseColumn(boardid, payload):
+    if workflow.typeId(payload.get("column")) not in workflow.columns(boardid):
+        raise ValueError("column must be a column of the board")
+    return dict(column=payload["column"])
+
+def parseBoardName(boardid, payload):
+    name = payload.get("name")
+    if not isinstance(name, str) or not name.strip() or len(name) > Board.name.type.length:
+        raise ValueError("name must be a board name of at most %d characters" % Board.name.type.length)
+    return dict(name=name.strip())
+
+def parseOperations(boardid, payload):
+    operations = parseBatch(payload)
+    if operations is None:
+        raise ValueError("Expected a list of move/delete operations")
+    return dict(operations=operations)
+
+@jobHandler("clear-column", "editor", parseColumn)
+def clearColumnJob(boardid, userid, arguments):
+    return dict(deleted=clearColumn(boardid, workflow.typeId(arguments["column"])))
+
+@jobHandler("copy-board", "viewer", parseBoardName)
+def copyBoardJob(boardid, userid, arguments):
+    return dict(board=copyBoard(boardid, userid, arguments["name"]))
+
+@jobHandler("batch", "editor", parseOperations)
+def batchJob(boardid, userid, arguments):
+    results = applyBatch(boardid, arguments["operations"])
+    return [dict(op=result["op"], results=dict((str(i), outcome) for i, outcome in result["results"].items()))
+            for result in results]
+
+@jobHandler("recount", "editor", lambda boardid, payload: dict())
+def recountJob(boardid, userid, arguments):
+    return dict(fixed=repairCounters(boardid))
+
+
+####################################################################
+# Static Assets Section
+####################################################################
+#Files of the static folder are served under a name holding a hash of their
+#content, e.g. /assets/doge.3f2a9c1b7e4d.jpg, so browsers may keep them
+#forever: a changed file gets a new name. Text files are compressed once,
+#with gzip and with brotli when the brotli package is installed, and each
+#client gets the smallest variant it accepts. The folder is read on first
+#use and kept in memory, which suits the few small files this app ships
+ASSET_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson',
+                      'image/svg+xml')
+
+Asset = namedtuple('Asset', 'path name digest mimetype data variants')
+
+def compressible(mimetype):
+    return bool(mimetype) and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+#Compressed variants of a file that came out smaller, by content coding
+def compressedVariants(data):
+    variants = dict()
+    candidates = [('gzip', lambda: gzip.compress(data, 9))]
+    if brotli is not None:
+        candidates.insert(0, ('br', lambda: brotli.compress(data, quality=11)))
+    for encoding, compress in candidates:
+        compressed = compress()
+        if len(compressed) < len(data):
+            variants[encoding] = compressed
+    return variants
+
+class AssetPipeline(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.assets = None
+        self.names = None
+
+    def load(self):
+        with self.lock:
+            if self.assets is not None:
+                return
+            assets, names = dict(), dict()
+            folder = app.static_folder
+            for root, dirs, files in os.walk(folder):
+                for filename in files:
+                    path = os.path.relpath(os.path.join(root, filename), folder).replace(os.sep, '/')
+                    with open(os.path.join(root, filename), 'rb') as source:
+                        data = source.read()
+                    digest = hashlib.sha256(data).hexdigest()[:12]
+                    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                    variants = compressedVariants(data) if compressible(mimetype) else dict()
+                    stem, dot, extension = path.rpartition('.')
+                    name = '%s.%s.%s' % (stem, digest, extension) if dot else '%s.%s' % (path, digest)
+                    assets[path] = names[name] = Asset(path, name, digest, mimetype, data, variants)
+            self.assets, self.names = assets, names
+
+    def clear(self):
+        with self.lock:
+            self.assets = self.names = None
+
+    #Fingerprinted URL of a file of the static folder, for templates
+    def url(self, path):
+        self.load()
+        asset = self.assets.get(path)
+        if asset is None:
+            return url_for('static', filename=path)
+        return url_for('staticAsset', name=asset.name)
+
+    def find(self, name):
+        self.load()
+        return self.names.get(name)
+
+assets = AssetPipeline()
+app.jinja_env.globals['asset_url'] = assets.url
+
+#Content codings served, smallest first
+ASSET_ENCODINGS = ('br', 'gzip')
+
+#Content coding the client prefers among the variants of an asset, or None.
+#Between codings of equal quality, as in "gzip, deflate, br", the one
+#coming first in ASSET_ENCODINGS wins
+def preferredEncoding(variants):
+    accepted = [(request.accept_encodings[encoding], -rank, encoding)
+                for rank, encoding in enumerate(ASSET_ENCODINGS) if encoding in variants]
+    accepted = [choice for choice in accepted if choice[0] > 0]
+    return max(accepted)[2] if accepted else None
+
+@app.route('/assets/<path:name>')
+def staticAsset(name):
+    asset = assets.find(name)
+    if asset is None:
+        abort(404)
+    if request.if_none_match.contains(asset.digest):
+        response = app.response_class(status=304)
+    else:
+        encoding = preferredEncoding(asset.variants)
+        response = app.response_class(asset.variants.get(encoding, asset.data), mimetype=asset.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(asset.digest)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % ASSET_MAX_AGE
+    return response
+
+#Gzips dynamic pages and JSON answers for clients that accept it. Streamed
+#responses, such as the change stream and exports, are sent as they are so
+#they are not held back. A strong ETag becomes weak, as it now names the
+#content before compression
+@app.after_request
+def compressResponse(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or not compressible(response.mimetype)
+            or request.accept_encodings['gzip'] <= 0):
+        return response
+    data = response.get_data()
+    if len(data) < app.config['GZIP_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, app.config['GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
 
 
 ####################################################################
@@ -117,27 +2726,55 @@ def login():
     #proceeds to check if login is valid
     if request.method == "POST" and form.validate():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
-            if user is None:
-                error="Invalid Username"
-            elif not user.check_password(form.password.data):
-                error = "Invalid Password"
-            return render_template('login.html', form=form, error=error)
+        if user is None:
+            return render_template('login.html', form=form, error="Invalid Username")
+        #The password is hashed only once per attempt
+        if not user.check_password(form.password.data):
+            return render_template('login.html', form=form, error="Invalid Password")
+        #Upgrades hashes made with older parameters while we know the password
+        if user.needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+        renewSession()
         login_user(user, True)
-        #Flask login immediately adds "next" argument into
-        #the login request to redirect to the index page and
-        #prevent malicious attacks in the URL, as it only allows
-        #redirects inside the application
+        #Flask login adds a "next" argument to the login page when it
+        #sends a user there, which is followed back after the login.
+        #Only paths inside the application are, so a crafted link cannot
+        #send the user to another site
         next_page = request.args.get('next')
-        if not next_page or url_parse(next_page).netloc != '':
-            next_page = 'index.html'
-        return redirect(url_for('index'))
+        if not safeRedirect(next_page):
+            next_page = url_for('index')
+        return redirect(next_page)
     #If request method is GET, just returns login page
     return render_template('login.html', form=form)
 
+#Whether a redirect target stays inside the application: a path with no
+#scheme or host, which browsers would not read as one either (//host, /\host)
+def safeRedirect(target):
+    if not target or not target.startswith('/') or target.startswith(('//', '/\\')):
+        return False
+    parsed = urlparse(target)
+    return not parsed.scheme and not parsed.netloc
+
+#Answered when all the password hashing processes stay busy for too long
+@app.errorhandler(HashingBusy)
+def hashingBusy(error):
+    return "Too many logins right now, please try again in a moment", 503, {"Retry-After": "1"}
+
+#Adds and moves into a full column are refused. Plain form posts go back
+#to the board, which shows why
+@app.errorhandler(WipLimitReached)
+def wipLimitReached(error):
+    if request.is_json or request.headers.get('X-Requested-With') == 'fetch':
+        return jsonify(error=str(error)), 409
+    flash(str(error))
+    return redirect(url_for('index'))
+
 #Logs user out
 @app.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        userCache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('index'))
 
@@ -161,67 +2798,83 @@ def register_page():
             newuser.set_password(passw)
             db.session.add(newuser)
             db.session.commit()
+            renewSession()
             login_user(newuser)
-
-            return render_template('index.html', error="Registered with success!")
+            return renderBoard(newuser.boardid, error="Registered with success!")
     #If request method is GET, returns register page
     return render_template("register.html", form=form)
 
 
+#Pages with a change stream open send their forms with fetch and patch
+#themselves from the stream, so they only need to know the write worked.
+#Plain form posts are redirected to the board as before
+def afterWrite():
+    if request.headers.get('X-Requested-With') == 'fetch':
+        return '', 204
+    return redirect(url_for('index'))
+
 #Routes to add tasks by type (To do, doing, done)
 @app.route('/addTodoTask', methods=['POST'])
+@login_required
 def addtodo():
     addTaskHelper("todo", request)
-    return redirect(url_for('index'))
+    return afterWrite()
 
 @app.route('/addDoingTask', methods=['POST'])
+@login_required
 def adddoing():
     addTaskHelper("doing",request)
-    return redirect(url_for('index'))
+    return afterWrite()
 
 @app.route('/addDoneTask', methods=['POST'])
+@login_required
 def adddone():
     addTaskHelper("done",request)
-    return redirect(url_for('index'))
+    return afterWrite()
+
+#Adds a task to any column of the board, including custom ones
+@app.route('/addTask/<column>', methods=['POST'])
+@login_required
+def addtask(column):
+    addTaskHelper(column, request)
+    return afterWrite()
 
-#Helper function to add tasks in the database under the correct user id and task type
+#Helper function to add tasks in the database under the correct board, user id and task type
 def addTaskHelper(typetask,request):
-    tasktype = TodoType.query.filter_by(type=typetask).first()
-    todo =Todo(text=request.form['todoitem'],type=tasktype.id ,userid=current_user.get_id())
-    db.session.add(todo)
-    db.session.commit()
+    boardid = currentBoard("editor")
+    tasktype = workflow.typeId(typetask)
+    if tasktype not in workflow.columns(boardid):
+        abort(404)
+    text = request.form['todoitem']
+    userid = current_user.id
+    def write():
+        changeCount(boardid, tasktype, 1)
+        position = positionBetween(lastPosition(boardid, tasktype), None)
+        todo =Todo(text=text,type=tasktype ,userid=userid, boardid=boardid, position=position)
+        db.session.add(todo)
+        db.session.flush()
+        card = cardData(todo)
+        recordChanges(boardid, [("added", card)])
+        return card
+    return runWrite(write)
 
 #Helper function to change the task type,
 #moving from one state to the next (except for "done" tasks)
 def moveTask(request):
-    tasks = request.form.getlist("todotask")
-    for task in tasks:
-        t = Todo.query.filter(Todo.id==task).filter(Todo.userid==current_user.get_id()).first()
-        if t:
-            tasktype = TodoType.query.filter_by(id=t.type).first()
-            if tasktype.type =="todo":
-                newtype = "doing"
-            elif tasktype.type =="doing":
-                newtype = "done"
-            tasktype = TodoType.query.filter_by(type=newtype).first()
-            t.type = tasktype.id
-            db.session.add(t)
+    tasks = parseTaskIds(request.form.getlist("todotask"))
     if tasks:
-        db.session.commit()
+        applyBatch(currentBoard("editor"), [{"op": "move", "ids": tasks}])
 
-#Helper function to delete all selected tasks on the database according to user id
+#Helper function to delete all selected tasks on the database according to board id
 def deleteTask(request):
-    tasks = request.form.getlist("todotask")
-    for task in tasks:
-        t = Todo.query.filter(Todo.id==task).filter(Todo.userid==current_user.get_id()).first()
-        if t:
-            db.session.delete(t)
+    tasks = parseTaskIds(request.form.getlist("todotask"))
     if tasks:
-        db.session.commit()
+        applyBatch(currentBoard("editor"), [{"op": "delete", "ids": tasks}])
 
 #Route to delete or move tasks, depending on the button used
 #to call the route
 @app.route('/todo', methods=['POST'])
+@login_required
 def todo():
 
     if request.method == 'POST':
@@ -229,22 +2882,767 @@ def todo():
             deleteTask(request)
         elif request.form.get('button') == 'Move task to next stage':
             moveTask(request)
-    return redirect(url_for('index'))
+    return afterWrite()
+
+#JSON route to move and delete many tasks at once. Expects a body like
+#{"operations": [{"op": "move", "ids": [1, 2]}, {"op": "delete", "ids": [3]}]}
+#and answers with the result of every id, operation by operation
+@app.route('/todo/batch', methods=['POST'])
+@login_required
+def todoBatch():
+    operations = parseBatch(request.get_json(silent=True))
+    if operations is None:
+        return jsonify(error="Expected a list of move/delete operations"), 400
+    results = applyBatch(currentBoard("editor"), operations)
+    for result in results:
+        result["results"] = dict((str(i), outcome) for i, outcome in result["results"].items())
+    return jsonify(operations=results)
+
+#JSON route to read or edit the workflow of the board. A POST may carry
+#{"columns": ["todo", "review", "done"]},
+#{"transitions": [["todo", "review"], ["review", "done"]]} and/or
+#{"limits": {"doing": 3, "review": null}} to set or remove WIP limits.
+#Only owners of the board may edit it
+@app.route('/workflow', methods=['GET', 'POST'])
+@login_required
+def boardWorkflow():
+    boardid = currentBoard("owner" if request.method == 'POST' else "viewer")
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify(error="Expected a JSON object"), 400
+        columns = payload.get("columns")
+        transitions = payload.get("transitions")
+        if columns is not None:
+            if not isinstance(columns, list) or not columns or not all(isinstance(c, str) and c for c in columns):
+                return jsonify(error="columns must be a list of names"), 400
+            setBoardColumns(boardid, columns)
+        if transitions is not None:
+            if not isinstance(transitions, list) or not all(isinstance(t, list) and len(t) == 2 and all(isinstance(n, str) and n for n in t) for t in transitions):
+                return jsonify(error="transitions must be a list of [from, to] pairs"), 400
+            setBoardTransitions(boardid, transitions)
+        limits = payload.get("limits")
+        if limits is not None:
+            if not isinstance(limits, dict) or not all(
+                    workflow.typeId(name) in workflow.columns(boardid) and
+                    (limit is None or (isinstance(limit, int) and not isinstance(limit, bool) and limit >= 0))
+                    for name, limit in limits.items()):
+                return jsonify(error="limits must map columns of the board to a number of cards or null"), 400
+            setColumnLimits(boardid, limits)
+    return jsonify(describeWorkflow(boardid))
+
+#JSON route returning the next page of a column. ?after= takes the cursor
+#returned with the previous page and ?limit= the number of cards wanted
+@app.route('/columns/<column>')
+@login_required
+def columnPage(column):
+    boardid = currentBoard()
+    typeid = workflow.typeId(column)
+    if typeid not in workflow.columns(boardid):
+        abort(404)
+    try:
+        after = parseCursor(request.args.get('after'))
+        limit = int(request.args.get('limit', app.config['COLUMN_PAGE_SIZE']))
+    except ValueError:
+        return jsonify(error="Invalid cursor or limit"), 400
+    limit = min(max(limit, 1), MAX_COLUMN_PAGE_SIZE)
+    def build():
+        page = loadColumnPage(boardid, typeid, after, limit)
+        return jsonify(cards=[cardData(todo) for todo in page["cards"]], next=page["cursor"])
+    return conditionalBoardResponse(boardid, build)
+
+#JSON route returning the board with the first page of every column.
+#Sends an ETag and answers 304 when If-None-Match holds the current one
+@app.route('/board')
+@login_required
+def boardJson():
+    boardid = currentBoard()
+    def build():
+        board = loadBoard(boardid, app.config['COLUMN_PAGE_SIZE'])
+        columns = [dict(name=column["name"], title=column["title"], next=column["cursor"],
+                        count=column["count"], limit=column["limit"],
+                        cards=[cardData(todo) for todo in column["cards"]])
+                   for column in boardView(boardid, board)]
+        return jsonify(columns=columns)
+    return conditionalBoardResponse(boardid, build)
+
+#Server-Sent Events stream of the changes made to the board, by the
+#logged in user or anyone else: added, moved and deleted cards
+@app.route('/stream')
+@login_required
+def changeStream():
+    boardid = currentBoard()
+    channel = str(boardid)
+    subscription = changes.subscribe(channel)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(eventStream(channel, subscription), mimetype='text/event-stream', headers=headers)
+
+#JSON route returning what changed on the board since the version given in
+#?since=, which clients take from the "version" of their previous sync.
+#Answers 410 when the client is too far behind and must load /board again
+@app.route('/changes')
+@login_required
+def boardChanges():
+    try:
+        since = int(request.args['since'])
+    except (KeyError, ValueError):
+        return jsonify(error="since must be a board version"), 400
+    boardid = currentBoard()
+    try:
+        return jsonify(changesSince(boardid, since))
+    except ResyncRequired:
+        return jsonify(error="Too far behind, load the whole board again", version=boardVersion(boardid)), 410
+
+#JSON route for drag and drop. Expects {"column": "doing", "after": 12} to
+#put the card right after card 12 of the doing column, or "after": null to
+#put it first
+@app.route('/cards/<int:cardid>/position', methods=['POST'])
+@login_required
+def moveCard(cardid):
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("column"), str):
+        return jsonify(error="Expected the column and the card to go after"), 400
+    after = payload.get("after")
+    if after is not None and (not isinstance(after, int) or isinstance(after, bool)):
+        return jsonify(error="after must be a card id or null"), 400
+    try:
+        card = repositionCard(currentBoard("editor"), cardid, payload["column"], after)
+    except InvalidMove as error:
+        return jsonify(error=str(error)), 409
+    if card is None:
+        abort(404)
+    return jsonify(card)
+
+#JSON route searching the cards of the board, best matches first.
+#?q= holds the words to look for, word* matches words starting with word,
+#and ?column= limits the search to one column
+@app.route('/search')
+@login_required
+def search():
+    boardid = currentBoard()
+    query = request.args.get('q', '')
+    typeid = None
+    if request.args.get('column'):
+        typeid = workflow.typeId(request.args['column'])
+        if typeid not in workflow.columns(boardid):
+            abort(404)
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify(error="Invalid limit"), 400
+    limit = min(max(limit, 1), MAX_SEARCH_RESULTS)
+    cards = searchCards(boardid, query, typeid, limit)
+    return jsonify(cards=[cardData(card) for card in cards])
+
+#Imports cards from a CSV or JSONL upload, sent either as the "file" field
+#of a form or as the request body. The format comes from ?format= or the
+#extension of the uploaded file. Answers with how many cards were imported
+#and which lines were rejected
+@app.route('/import', methods=['POST'])
+@login_required
+def importBoard():
+    boardid = currentBoard("editor")
+    #A form encoded body is parsed into fields, which leaves no file to read
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        return jsonify(error="Send the file as a multipart upload or as the raw request body "
+                             "with its own Content-Type, e.g. text/csv"), 400
+    upload = request.files.get('file') if request.mimetype == 'multipart/form-data' else None
+    format = request.args.get('format')
+    if format is None and upload is not None and upload.filename:
+        format = upload.filename.rpartition('.')[2].lower()
+    if format not in IMPORT_FORMATS:
+        return jsonify(error="format must be one of %s" % ", ".join(IMPORT_FORMATS)), 400
+    stream = upload.stream if upload is not None else request.stream
+    return jsonify(importCards(boardid, importRecords(stream, format), current_user.id))
+
+#Streams the whole board as CSV (the default) or JSONL
+@app.route('/export')
+@login_required
+def exportBoard():
+    boardid = currentBoard()
+    format = request.args.get('format', 'csv')
+    if format not in IMPORT_FORMATS:
+        return jsonify(error="format must be one of %s" % ", ".join(IMPORT_FORMATS)), 400
+    headers = {'Content-Disposition': 'attachment; filename=board.%s' % format}
+    return Response(stream_with_context(exportCards(boardid, format)),
+                    mimetype=EXPORT_MIMETYPES[format], headers=headers)
+
+#JSON route browsing the archived cards of the board, newest first, with
+#?before= holding the "next" of the previous page. With ?q= it searches
+#the archive instead, best matches first
+@app.route('/archive')
+@login_required
+def archive():
+    boardid = currentBoard()
+    try:
+        before = request.args.get('before')
+        before = int(before) if before else None
+        limit = int(request.args.get('limit', ARCHIVE_PAGE_SIZE))
+    except ValueError:
+        return jsonify(error="Invalid cursor or limit"), 400
+    if request.args.get('q') is not None:
+        limit = min(max(limit, 1), MAX_SEARCH_RESULTS)
+        cards = searchCards(boardid, request.args['q'], limit=limit, model=ArchivedTodo)
+        return jsonify(cards=[cardData(card) for card in cards])
+    page = loadArchivePage(boardid, before, min(max(limit, 1), MAX_COLUMN_PAGE_SIZE))
+    return jsonify(cards=[cardData(card) for card in page["cards"]], next=page["cursor"])
+
+#Prometheus endpoint with the metrics of this process, see the Metrics Section
+@app.route('/metrics')
+def metricsPage():
+    token = app.config['METRICS_TOKEN']
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), 'Bearer %s' % token):
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+#Reports how well the in-memory caches are doing
+@app.route('/stats/cache')
+@login_required
+def cacheStats():
+    return jsonify(users=userCache.stats(), fragments=fragmentCache.stats(),
+                   memberships=membershipCache.stats())
+
+#JSON route listing the boards of the user. A POST with {"name": "Team"}
+#creates a board, owned by the user
+@app.route('/boards', methods=['GET', 'POST'])
+@login_required
+def boards():
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        try:
+            name = parseBoardName(None, payload if isinstance(payload, dict) else dict())["name"]
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
+        boardid = createBoard(current_user.id, name)
+        return jsonify(id=boardid, name=name, role="owner"), 201
+    return jsonify(boards=[dict(id=boardid, name=name, role=role)
+                           for boardid, name, role in userBoards(current_user.id)])
+
+#JSON route listing the members of a board. Owners add a member or change
+#their role with a POST of {"username": "bob", "role": "editor"}
+@app.route('/boards/<int:boardid>/members', methods=['GET', 'POST'])
+@login_required
+def members(boardid):
+    if request.method == 'POST':
+        checkBoard(boardid, "owner")
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get("username"), str):
+            return jsonify(error="Expected the username and role of the member"), 400
+        user = User.query.filter_by(username=payload["username"]).first()
+        if user is None:
+            abort(404)
+        try:
+            setMember(boardid, user.id, payload.get("role", "editor"))
+        except InvalidMember as error:
+            return jsonify(error=str(error)), 400
+    else:
+        checkBoard(boardid)
+    return jsonify(members=[dict(id=userid, username=username, role=role)
+                            for userid, username, role in boardMembers(boardid)])
+
+#Takes a member off a board. Owners may remove anyone but the board's
+#creator, and members may leave by removing themselves
+@app.route('/boards/<int:boardid>/members/<int:userid>', methods=['DELETE'])
+@login_required
+def removeBoardMember(boardid, userid):
+    checkBoard(boardid, "viewer" if userid == current_user.id else "owner")
+    try:
+        if not removeMember(boardid, userid):
+            abort(404)
+    except InvalidMember as error:
+        return jsonify(error=str(error)), 400
+    return '', 204
+
+#Queues a long running operation on the board and answers 202 at once,
+#with the job to poll at /jobs/<id>. The body names the kind of job and
+#its arguments: {"kind": "clear-column", "column": "done"},
+#{"kind": "copy-board", "name": "Copy"}, {"kind": "batch", "operations": [...]}
+#or {"kind": "recount"}. GET lists the last jobs of the user
+@app.route('/jobs', methods=['GET', 'POST'])
+@login_required
+def jobList():
+    if request.method == 'GET':
+        recent = Job.query.filter(Job.userid==current_user.id).order_by(Job.id.desc()).limit(JOB_LIST_SIZE)
+        return jsonify(jobs=[jobData(job) for job in recent])
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or payload.get("kind") not in JOB_KINDS:
+        return jsonify(error="kind must be one of %s" % ", ".join(JOB_KINDS)), 400
+    function, role, parse = JOB_KINDS[payload["kind"]]
+    boardid = currentBoard(role)
+    try:
+        arguments = parse(boardid, payload)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    jobid = enqueueJob(payload["kind"], boardid, current_user.id, arguments)
+    return jsonify(jobData(Job.query.get(jobid))), 202, {'Location': url_for('jobStatus', jobid=jobid)}
+
+#JSON route telling how a job of the user is doing: its status (queued,
+#running, done or failed), attempts, and its result or last error
+@app.route('/jobs/<int:jobid>')
+@login_required
+def jobStatus(jobid):
+    job = Job.query.get(jobid)
+    if job is None or job.userid != current_user.id:
+        abort(404)
+    return jsonify(jobData(job))
+
+#Renders the board page of a board the user is a member of
+def renderBoard(boardid, **context):
+    counters = columnCounters(boardid)
+    return render_template('index.html', columns=boardView(boardid, columnFragments(boardid, counters), counters),
+                           board=boardid, role=boardRole(current_user.id, boardid),
+                           boards=userBoards(current_user.id), **context)
 
 #Route to the main page. It requires login to access it.
-#Returns all the tasks registered under the logged in user
+#Returns all the tasks of the board asked for with ?board=, which is
+#remembered for the next visits, or of the last board opened
 @app.route('/')
 @login_required
 def index():
-    todo = Todo.query.filter(TodoType.type=="todo").filter(Todo.type==TodoType.id).filter(Todo.userid==current_user.get_id()).all()
-    doing = Todo.query.filter(TodoType.type=="doing").filter(Todo.type==TodoType.id).filter(Todo.userid==current_user.get_id()).all()
-    done = Todo.query.filter(TodoType.type=="done").filter(Todo.type==TodoType.id).filter(Todo.userid==current_user.get_id()).all()
-    return render_template('index.html', todoall=todo, doingall=doing, doneall=done)
+    boardid = currentBoard()
+    if request.args.get('board'):
+        session['board'] = boardid
+    return renderBoard(boardid)
+
+
+####################################################################
+# Sessions Section
+####################################################################
+#Minimal client for the Redis protocol (RESP), enough for the few commands
+#the session store needs. Keeps one connection per thread and reconnects
+#once when a connection turns out to be broken
+class RedisClient(object):
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or 'localhost', parsed.port or 6379)
+        self.password = parsed.password
+        self.database = int(parsed.path.strip('/') or 0)
+        self.local = threading.local()
+
+    def connect(self):
+        connection = socket.create_connection(self.address, timeout=5)
+        self.local.connection = connection
+        self.local.reader = connection.makefile('rb')
+        if self.password:
+            self.send('AUTH', self.password)
+        if self.database:
+            self.send('SELECT', self.database)
+
+    def execute(self, *args):
+        if getattr(self.local, 'connection', None) is None:
+            self.connect()
+        try:
+            return self.send(*args)
+        except (OSError, EOFError):
+            self.local.connection = None
+            self.connect()
+            return self.send(*args)
+
+    def send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self.local.connection.sendall(b''.join(parts))
+        return self.reply()
+
+    def reply(self):
+        line = self.local.reader.readline()
+        if not line:
+            raise EOFError("Connection closed by the server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RuntimeError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            if int(rest) < 0:
+                return None
+            data = self.local.reader.read(int(rest) + 2)
+            return data[:-2]
+        if kind == b'*':
+            if int(rest) < 0:
+                return None
+            return [self.reply() for i in range(int(rest))]
+        raise RuntimeError("Unexpected reply from the server: %r" % line)
+
+#Session stores save the serialized session under its id for ttl seconds.
+#This one keeps them in Redis, shared by every worker and every node
+class RedisSessionStore(object):
+    def __init__(self, url, prefix='session:'):
+        self.client = RedisClient(url)
+        self.prefix = prefix
+
+    def get(self, sid):
+        data = self.client.execute('GET', self.prefix + sid)
+        return data.decode('utf-8') if data is not None else None
+
+    def set(self, sid, data, ttl):
+        self.client.execute('SET', self.prefix + sid, data, 'EX', max(int(ttl), 1))
+
+    def delete(self, sid):
+        self.client.execute('DEL', self.prefix + sid)
+
+#Keeps sessions in a SQLite file of their own, shared by the worker
+#processes of one machine without adding writes to the board database
+class SqliteSessionStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().execute('CREATE TABLE IF NOT EXISTS Session '
+                                  '(sid TEXT PRIMARY KEY, data TEXT, expires REAL)')
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            self.local.connection = connection
+        return self.local.connection
+
+    def get(self, sid):
+        row = self.connection().execute('SELECT data FROM Session WHERE sid = ? AND expires > ?',
+                                        (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, data, ttl):
+        connection = self.connection()
+        connection.execute('INSERT OR REPLACE INTO Session VALUES (?, ?, ?)', (sid, data, time.time() + ttl))
+        #Expired sessions are swept now and then instead of on every write
+        if secrets.randbelow(100) == 0:
+            connection.execute('DELETE FROM Session WHERE expires <= ?', (time.time(),))
+
+    def delete(self, sid):
+        self.connection().execute('DELETE FROM Session WHERE sid = ?', (sid,))
+
+#Keeps every session in a file of its own, named after a hash of its id
+class FilesystemSessionStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, sid):
+        return os.path.join(self.directory, hashlib.sha256(sid.encode('utf-8')).hexdigest())
+
+    def get(self, sid):
+        try:
+            with open(self.path(sid)) as stored:
+                expires, data = stored.read().split('\n', 1)
+        except (OSError, ValueError):
+            return None
+        if float(expires) <= time.time():
+            self.delete(sid)
+            return None
+        return data
+
+    def set(self, sid, data, ttl):
+        path = self.path(sid)
+        temporary = '%s.%s.tmp' % (path, threading.get_ident())
+        with open(temporary, 'w') as stored:
+            stored.write('%f\n%s' % (time.time() + ttl, data))
+        os.replace(temporary, path)
+
+    def delete(self, sid):
+        try:
+            os.remove(self.path(sid))
+        except OSError:
+            pass
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+#Flask session interface keeping session data in a store and only a signed
+#random session id in the cookie. As the data no longer lives in one
+#process, any worker on any node can serve any user
+class StoredSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='kanban-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie:
+            try:
+                sid = self.signer(app).unsign(cookie).decode('utf-8')
+            except BadSignature:
+                sid = None
+            data = self.store.get(sid) if sid else None
+            if data is not None:
+                return ServerSideSession(self.serializer.loads(data), sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.store.set(session.sid, self.serializer.dumps(dict(session)), ttl)
+        cookie = self.signer(app).sign(session.sid.encode('utf-8')).decode('utf-8')
+        response.set_cookie(app.session_cookie_name, cookie,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+#Gives a stored session a new id when its user logs in or registers, so an
+#id planted in the browser beforehand (session fixation) does not end up
+#holding the login. The data moves over to the new id
+def renewSession():
+    current = session._get_current_object()
+    if isinstance(current, ServerSideSession) and not current.new:
+        app.session_interface.store.delete(current.sid)
+        current.sid = secrets.token_urlsafe(32)
+        current.modified = True
+
+#Builds the session store named by SESSION_TYPE, or None for Flask's own
+#signed cookie sessions
+def sessionStore(app):
+    kind = app.config['SESSION_TYPE']
+    if kind == 'cookie':
+        return None
+    if kind == 'filesystem':
+        return FilesystemSessionStore(app.config['SESSION_FILE_DIR'] or os.path.join(app.instance_path, 'sessions'))
+    if kind == 'sqlite':
+        return SqliteSessionStore(app.config['SESSION_SQLITE_PATH'] or os.path.join(app.instance_path, 'sessions.db'))
+    if kind == 'redis':
+        return RedisSessionStore(app.config['SESSION_REDIS_URL'])
+    raise ValueError("Unknown SESSION_TYPE %r" % kind)
+
+
+####################################################################
+# Rate Limiting Section
+####################################################################
+metrics.counter('kanban_rate_limited_total', 'Requests refused with 429 because a token bucket was empty, by endpoint')
+
+#Token buckets kept in a dict of this process. A bucket is a tuple of its
+#tokens, when they were counted and when it will be full again, and every
+#update replaces the whole tuple with one dict assignment, so no lock is
+#taken. Two requests racing for the last token of a bucket may both get
+#through, which lets in a request too many rather than one too few.
+#Buckets that have filled up again are the same as no bucket, and are
+#dropped when there are more than maxsize of them
+class MemoryBuckets(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.buckets = dict()
+
+    #Takes a token from the bucket `key`, holding at most `capacity` tokens
+    #and gaining `rate` tokens per second. Returns 0 when a token was taken,
+    #otherwise the seconds until the next token
+    def take(self, key, capacity, rate, now):
+        tokens, counted, full = self.buckets.get(key, (capacity, now, now))
+        tokens = min(capacity, tokens + (now - counted) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        if key not in self.buckets and len(self.buckets) >= self.maxsize:
+            self.purge(now)
+        tokens -= 1
+        self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+        return 0
+
+    def purge(self, now):
+        for key, (tokens, counted, full) in list(self.buckets.items()):
+            if full <= now:
+                self.buckets.pop(key, None)
+        #Every bucket is in use: start over rather than grow without bound
+        if len(self.buckets) >= self.maxsize:
+            self.buckets.clear()
+
+#Token buckets shared by every worker and every node through Redis. The
+#bucket is updated by a script, which Redis runs atomically, with the
+#clock of the Redis server so that the nodes agree on the time (Redis 5
+#or later). Buckets expire once they would be full again
+RATE_LIMIT_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'counted')
+local tokens = tonumber(bucket[1]) or capacity
+local counted = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - counted) * rate)
+if tokens < 1 then
+    return tostring((1 - tokens) / rate)
+end
+tokens = tokens - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'counted', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return '0'
+"""
+
+class RedisBuckets(object):
+    def __init__(self, url, prefix='ratelimit:'):
+        self.client = RedisClient(url)
+        self.prefix = prefix
+
+    def take(self, key, capacity, rate, now):
+        return float(self.client.execute('EVAL', RATE_LIMIT_SCRIPT, 1, self.prefix + key, capacity, repr(rate)))
+
+#Checks requests against RATE_LIMITS. The buckets are made on first use,
+#after create_app() had its say on RATE_LIMIT_STORAGE
+class RateLimiter(object):
+    def __init__(self):
+        self.buckets = None
+
+    def storage(self):
+        buckets = self.buckets
+        if buckets is None:
+            kind = app.config['RATE_LIMIT_STORAGE']
+            if kind == 'memory':
+                buckets = MemoryBuckets(app.config['RATE_LIMIT_MAX_BUCKETS'])
+            elif kind == 'redis':
+                buckets = RedisBuckets(app.config['RATE_LIMIT_REDIS_URL'])
+            else:
+                raise ValueError("Unknown RATE_LIMIT_STORAGE %r" % kind)
+            self.buckets = buckets
+        return buckets
+
+    def reset(self):
+        self.buckets = None
+
+    #Key of RATE_LIMITS limiting a request, None when it is not limited
+    def limitFor(self, method, endpoint):
+        limits = app.config['RATE_LIMITS']
+        for name in ("%s %s" % (method, endpoint), endpoint):
+            if name in limits:
+                return name
+        return None
+
+    #Takes a token from the bucket of every client key (address, user) for
+    #the limit. Returns 0 when the request may go on, otherwise the
+    #seconds to wait. A shared storage that cannot be reached lets requests
+    #through: the limits protect the app, they should not take it down
+    def check(self, name, clients):
+        capacity, period = app.config['RATE_LIMITS'][name]
+        rate = capacity / float(period)
+        now = time.monotonic()
+        try:
+            for client in clients:
+                wait = self.storage().take("%s:%s" % (name.replace(" ", ":"), client), capacity, rate, now)
+                if wait:
+                    return wait
+        except (OSError, EOFError, RuntimeError) as error:
+            log.warning("Rate limits not checked: %s", error)
+        return 0
+
+rateLimiter = RateLimiter()
+
+#Requests finding a bucket empty are answered 429, with the seconds to wait
+#rounded up in Retry-After. Behind a reverse proxy, remote_addr is the
+#client address only when TRUSTED_PROXIES is set, see create_app()
+@app.before_request
+def limitRequestRate():
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return None
+    name = rateLimiter.limitFor(request.method, request.endpoint)
+    if name is None:
+        return None
+    clients = ["ip:%s" % request.remote_addr]
+    if current_user.is_authenticated:
+        clients.append("user:%d" % current_user.id)
+    wait = rateLimiter.check(name, clients)
+    if not wait:
+        return None
+    metrics.inc('kanban_rate_limited_total', dict(endpoint=request.endpoint))
+    retry = str(max(1, int(math.ceil(wait))))
+    message = "Too many requests, please try again in %s seconds" % retry
+    if request.is_json or request.headers.get('X-Requested-With') == 'fetch':
+        return jsonify(error=message), 429, {"Retry-After": retry}
+    return message, 429, {"Retry-After": retry}
+
+
+####################################################################
+# Deployment Section
+####################################################################
+#The application before create_app() wrapped it in a ProxyFix
+plainWsgiApp = app.wsgi_app
+
+#Points the change stream at a Redis server shared by the workers, or
+#back at this process when url is None
+def usePubSub(url):
+    global changes
+    if getattr(changes, 'url', None) == url:
+        return
+    if isinstance(changes, RedisPubSub):
+        changes.close()
+    changes = RedisPubSub(url) if url else LocalPubSub()
+
+#Settings that are always strings, even when their value reads as JSON,
+#e.g. a numeric secret key. So are the settings ending in these suffixes
+#and those whose default is a string
+STRING_SETTINGS = ('SECRET_KEY', 'METRICS_TOKEN')
+STRING_SETTING_SUFFIXES = ('_URI', '_URL', '_PATH', '_DIR')
+
+#Reads a KANBAN_* environment variable value as JSON when it is JSON
+#(numbers, true/false, lists) and as a plain string otherwise
+def environmentValue(name, value):
+    if name in STRING_SETTINGS or name.endswith(STRING_SETTING_SUFFIXES) or isinstance(app.config.get(name), str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+#Application factory for deployments, e.g. gunicorn "kanban:create_app()".
+#The module holds one application per process, which create_app configures
+#from, in order: the defaults above, the file named by KANBAN_SETTINGS,
+#KANBAN_<KEY> environment variables (KANBAN_SECRET_KEY,
+#KANBAN_SQLALCHEMY_DATABASE_URI, KANBAN_SESSION_TYPE, ...) and the
+#`config` argument. Every worker has to share the same SECRET_KEY.
+#The database is set up and background tasks start here too, so each
+#worker process created through the factory does both unless
+#INIT_DATABASE and BACKGROUND_TASKS are off
+def create_app(config=None):
+    app.config.from_envvar('KANBAN_SETTINGS', silent=True)
+    for name, value in os.environ.items():
+        if name.startswith('KANBAN_') and name != 'KANBAN_SETTINGS':
+            setting = name[len('KANBAN_'):]
+            app.config[setting] = environmentValue(setting, value)
+    app.config.update(config or {})
+    if app.config.get('SECRET_KEY') in (None, '', DEVELOPMENT_SECRET_KEY):
+        if not (app.debug or app.testing):
+            raise RuntimeError("Set SECRET_KEY (e.g. KANBAN_SECRET_KEY) so that every worker signs sessions alike")
+        log.warning("No SECRET_KEY configured, sessions will not survive a restart")
+        app.config['SECRET_KEY'] = DEVELOPMENT_SECRET_KEY
+    if app.config['SQLITE_PRODUCTION']:
+        useSqliteProduction(app.config['WRITE_COALESCING'])
+    store = sessionStore(app)
+    if store is not None:
+        app.session_interface = StoredSessionInterface(store)
+    resizeCaches()
+    rateLimiter.reset()
+    usePubSub(app.config['CHANGE_STREAM_REDIS_URL'])
+    proxies = app.config['TRUSTED_PROXIES']
+    app.wsgi_app = ProxyFix(plainWsgiApp, x_for=proxies, x_proto=proxies, x_host=proxies) if proxies else plainWsgiApp
+    #The tables have to be there before the background tasks use them
+    if app.config['INIT_DATABASE']:
+        dbHelper()
+    if app.config['BACKGROUND_TASKS']:
+        startBackgroundTasks()
+    return app
 
 
 ####################################################################
 # Runs application
 ####################################################################
 if __name__ == '__main__':
-    dbHelper()
+    app.debug = True
+    create_app()
     app.run(debug=True)
@@ -1,13 +1,96 @@
 
 import os
+import io
+import csv
+import json
+import gzip
+import re
+import datetime
+import time
+import socket
+import threading
+import tempfile
+import socketserver
+import fnmatch
+from urllib.parse import urlparse
 import unittest
+from unittest import mock
 from flask import url_for
 from kanban import app, db
 import kanban
+import bench
 from flask_login import login_user, logout_user, current_user
 
 
 
+#Local stand-in for a Redis server, speaking just enough of the protocol
+#for the session store: PING, GET, SET with EX, DEL and SELECT, and for
+#the change relay: PUBLISH and PSUBSCRIBE
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.data = dict()
+        self.lock = threading.Lock()
+        self.subscribers = list()
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), RedisStandInHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self):
+        return 'redis://127.0.0.1:%d/1' % self.server_address[1]
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = list()
+            for i in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            command = args[0].upper()
+            data = self.server.data
+            if command in (b'PING', b'SELECT'):
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'SET':
+                data[args[1]] = args[2]
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'GET':
+                value = data.get(args[1])
+                self.wfile.write(b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value))
+            elif command == b'DEL':
+                self.wfile.write(b':%d\r\n' % (data.pop(args[1], None) is not None))
+            elif command == b'PSUBSCRIBE':
+                with self.server.lock:
+                    self.wfile.write(b'*3\r\n$10\r\npsubscribe\r\n$%d\r\n%s\r\n:1\r\n' % (len(args[1]), args[1]))
+                    self.server.subscribers.append((args[1], self.wfile))
+            elif command == b'PUBLISH':
+                channel, message = args[1], args[2]
+                with self.server.lock:
+                    receivers = [(pattern, wfile) for pattern, wfile in self.server.subscribers
+                                 if fnmatch.fnmatchcase(channel.decode(), pattern.decode())]
+                    for pattern, wfile in receivers:
+                        parts = [b'pmessage', pattern, channel, message]
+                        wfile.write(b'*4\r\n' + b''.join(b'$%d\r\n%s\r\n' % (len(part), part) for part in parts))
+                    self.wfile.write(b':%d\r\n' % len(receivers))
+            elif command == b'EVAL':
+                #Only the rate limit script is run, done here in Python
+                key, capacity, rate = args[3], float(args[4]), float(args[5])
+                now = time.time()
+                tokens, counted = data.get(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - counted) * rate)
+                wait = b'0'
+                if tokens < 1:
+                    wait = repr((1 - tokens) / rate).encode('ascii')
+                else:
+                    data[key] = (tokens - 1, now)
+                self.wfile.write(b'$%d\r\n%s\r\n' % (len(wait), wait))
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
 class AppTests(unittest.TestCase):
 
 ####################################################################
@@ -18,10 +101,17 @@ class AppTests(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
+        app.config['BACKGROUND_TASKS'] = False
+        app.config['INIT_DATABASE'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
         self.client = app.test_client()
         db.drop_all()
         db.create_all()
+        kanban.workflow.invalidate()
+        kanban.userCache.clear()
+        kanban.fragmentCache.clear()
+        kanban.membershipCache.clear()
+        kanban.rateLimiter.reset()
 
     # executed after each test
     def tearDown(self):
@@ -54,6 +144,55 @@ class AppTests(unittest.TestCase):
             db.session.add_all(types)
             db.session.commit()
 
+    #Registers an user, logs him/her in and makes sure the task types exist
+    def login(self, username="Test User", password="password"):
+        self.insert_user(username, password)
+        self.insert_task_types()
+        return self.client.post(
+            '/login',
+            data=dict(username=username, password=password),
+            follow_redirects=True
+        )
+
+    #Switches to the SQLite production profile, which needs a new engine
+    def use_sqlite_production(self, coalesceWrites=False):
+        db.session.remove()
+        kanban.useSqliteProduction(coalesceWrites)
+        app.extensions['sqlalchemy'].connectors.clear()
+        self.addCleanup(self.use_default_sqlite)
+
+    def use_default_sqlite(self):
+        db.session.remove()
+        db.get_engine().dispose()
+        app.config['SQLITE_PRODUCTION'] = False
+        app.config['WRITE_COALESCING'] = False
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+        app.extensions['sqlalchemy'].connectors.clear()
+
+    #Runs create_app with the given settings, putting the app back as it was afterwards
+    def create_app(self, **config):
+        saved = dict(app.config)
+        interface = app.session_interface
+        def restore():
+            app.config.clear()
+            app.config.update(saved)
+            app.session_interface = interface
+            app.wsgi_app = kanban.plainWsgiApp
+            kanban.usePubSub(None)
+            kanban.resizeCaches()
+        self.addCleanup(restore)
+        return kanban.create_app(config)
+
+    #Inserts a task straight into the database and returns its id. Users
+    #get personal boards numbered like them, so the board defaults to the user's
+    def insert_task(self, text, tasktype=1, userid=1, boardid=None):
+        boardid = boardid or userid
+        position = kanban.positionBetween(kanban.lastPosition(boardid, tasktype), None)
+        todo = kanban.Todo(text=text, type=tasktype, userid=userid, boardid=boardid, position=position)
+        db.session.add(todo)
+        db.session.commit()
+        return todo.id
+
 ####################################################################
 # Test Section
 ####################################################################
@@ -297,5 +436,1283 @@ class AppTests(unittest.TestCase):
                     #Type = 3 indicated that the type of the task is "done"
                     self.assertTrue(todo.type==3)
 
+####################################################################
+# Test Section - Board loading
+####################################################################
+    #Checks that the board snapshot splits cards by column and only
+    #returns cards of the requested user
+    def test_load_board_splits_columns(self):
+        self.insert_user("Test User", "password")
+        self.insert_user("Another User", "password")
+        self.insert_task_types()
+        self.insert_task("first", 1)
+        self.insert_task("second", 2)
+        self.insert_task("third", 1)
+        self.insert_task("not mine", 1, userid=2)
+        board = kanban.loadBoard(1)
+        self.assertEqual([t.text for t in board["todo"]["cards"]], ["first", "third"])
+        self.assertEqual([t.text for t in board["doing"]["cards"]], ["second"])
+        self.assertEqual(board["done"]["cards"], [])
+
+    def test_db_helper_adds_missing_index(self):
+        db.engine.execute('DROP INDEX ix_Todo_boardid_type_position')
+        db.engine.execute('CREATE INDEX ix_Todo_userid_type ON Todo (userid, type)')
+        kanban.dbHelper()
+        kanban.dbHelper()
+        names = [i['name'] for i in db.inspect(db.engine).get_indexes('Todo')]
+        self.assertIn('ix_Todo_boardid_type_position', names)
+        self.assertNotIn('ix_Todo_userid_type', names)
+        self.assertEqual(kanban.workflow.columns(1), [1, 2, 3])
+
+    def test_todo_has_board_type_position_index(self):
+        indexes = dict((i.name, [c.name for c in i.columns]) for i in kanban.Todo.__table__.indexes)
+        self.assertEqual(indexes['ix_Todo_boardid_type_position'], ['boardid', 'type', 'position'])
+
+####################################################################
+# Test Section - Bulk move and delete
+####################################################################
+    def test_move_many_tasks_to_next_stage(self):
+        with self.client:
+            self.login()
+            first = self.insert_task("first", 1)
+            second = self.insert_task("second", 2)
+            third = self.insert_task("third", 3)
+            self.client.post('/todo', data=dict(todotask=[first, second, third], button='Move task to next stage'))
+            types = dict(db.session.query(kanban.Todo.id, kanban.Todo.type))
+            self.assertEqual(types, {first: 2, second: 3, third: 3})
+
+    def test_delete_only_own_tasks(self):
+        with self.client:
+            self.login()
+            mine = self.insert_task("mine")
+            other = self.insert_task("other", userid=2)
+            self.client.post('/todo', data=dict(todotask=[mine, other], button='Delete task'))
+            remaining = [t.id for t in kanban.Todo.query.all()]
+            self.assertEqual(remaining, [other])
+
+    def test_batch_reports_result_per_id(self):
+        with self.client:
+            self.login()
+            first = self.insert_task("first", 1)
+            second = self.insert_task("second", 3)
+            other = self.insert_task("other", userid=2)
+            response = self.client.post('/todo/batch', json=dict(operations=[
+                dict(op="move", ids=[first, second, other]),
+                dict(op="move", ids=[first]),
+                dict(op="delete", ids=[second]),
+            ]))
+            self.assertEqual(response.status_code, 200)
+            operations = response.get_json()["operations"]
+            self.assertEqual(operations[0]["results"], {str(first): "moved", str(second): "final_stage", str(other): "not_found"})
+            self.assertEqual(operations[1]["results"], {str(first): "moved"})
+            self.assertEqual(operations[2]["results"], {str(second): "deleted"})
+            self.assertEqual(kanban.Todo.query.get(first).type, 3)
+            self.assertEqual(kanban.Todo.query.get(second), None)
+
+    def test_batch_rejects_unknown_operation(self):
+        with self.client:
+            self.login()
+            response = self.client.post('/todo/batch', json=dict(operations=[dict(op="archive", ids=[1])]))
+            self.assertEqual(response.status_code, 400)
+
+####################################################################
+# Test Section - Workflow
+####################################################################
+    def test_default_workflow(self):
+        self.insert_task_types()
+        self.assertEqual(kanban.workflow.columns(1), [1, 2, 3])
+        self.assertEqual(kanban.workflow.nextStages(1), {1: 2, 2: 3})
+        self.assertEqual(kanban.workflow.typeName(2), "doing")
+
+    def test_custom_columns_and_transitions(self):
+        with self.client:
+            self.login()
+            response = self.client.post('/workflow', json=dict(
+                columns=["todo", "review", "done"],
+                transitions=[["todo", "review"], ["review", "done"], ["review", "todo"]],
+            ))
+            self.assertEqual(response.get_json()["columns"], ["todo", "review", "done"])
+            review = kanban.workflow.typeId("review")
+            task = self.insert_task("needs review")
+            self.client.post('/todo', data=dict(todotask=task, button='Move task to next stage'))
+            self.assertEqual(kanban.Todo.query.get(task).type, review)
+            self.assertTrue(kanban.workflow.canMove(1, review, 1))
+            page = self.client.get('/')
+            self.assertIn(b'REVIEW', page.data)
+            self.assertNotIn(b'VERY DOING', page.data)
+
+    def test_add_task_to_custom_column(self):
+        with self.client:
+            self.login()
+            kanban.setBoardColumns(1, ["todo", "blocked"])
+            response = self.client.post('/addTask/blocked', data=dict(todoitem='Blocked Task'), follow_redirects=True)
+            self.assertIn(b'Blocked Task', response.data)
+            response = self.client.post('/addTask/doing', data=dict(todoitem='Doing Task'))
+            self.assertEqual(response.status_code, 404)
+
+    def test_workflow_is_not_read_again_until_edited(self):
+        self.insert_task_types()
+        kanban.workflow.columns(1)
+        db.session.add(kanban.BoardColumn(boardid=1, type=2, position=0))
+        db.session.commit()
+        self.assertEqual(kanban.workflow.columns(1), [1, 2, 3])
+        kanban.setBoardColumns(1, ["doing"])
+        self.assertEqual(kanban.workflow.columns(1), [2])
+
+####################################################################
+# Test Section - Password hashing
+####################################################################
+    def test_login_upgrades_old_password_hash(self):
+        iterations = app.config['PASSWORD_HASH_ITERATIONS']
+        app.config['PASSWORD_HASH_ITERATIONS'] = 1000
+        try:
+            self.insert_user("Test User", "password")
+        finally:
+            app.config['PASSWORD_HASH_ITERATIONS'] = iterations
+        self.insert_task_types()
+        user = kanban.User.query.first()
+        self.assertTrue(user.needs_rehash())
+        log = self.client.post('/login', data=dict(username="Test User", password="password"), follow_redirects=True)
+        self.assertIn(b'SUCH TO DO', log.data)
+        user = kanban.User.query.first()
+        self.assertFalse(user.needs_rehash())
+        self.assertTrue(user.check_password("password"))
+
+    def test_login_follows_next_inside_the_app(self):
+        self.insert_user("Test User", "password")
+        self.insert_task_types()
+        credentials = dict(username="Test User", password="password")
+        response = self.client.post('/login?next=/boards', data=credentials)
+        self.assertEqual(urlparse(response.headers['Location']).path, '/boards')
+        self.client.get('/logout')
+        for target in ('http://evil.example/', '//evil.example/', '/\\evil.example/'):
+            response = self.client.post('/login', data=credentials, query_string=dict(next=target))
+            self.assertEqual(urlparse(response.headers['Location']).path, '/')
+            self.client.get('/logout')
+
+    def test_hashing_inside_request_thread(self):
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        app.config['PASSWORD_HASH_WORKERS'] = 0
+        try:
+            user = kanban.User(username="Test User")
+            user.set_password("password")
+            self.assertTrue(user.check_password("password"))
+            self.assertFalse(user.check_password("other"))
+        finally:
+            app.config['PASSWORD_HASH_WORKERS'] = workers
+
+    def test_login_when_hashing_is_busy(self):
+        self.insert_user("Test User", "password")
+        pool, slots = kanban.hasher.executor(app.config['PASSWORD_HASH_WORKERS'])
+        timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        app.config['PASSWORD_HASH_TIMEOUT'] = 0
+        acquired = 0
+        try:
+            while slots.acquire(blocking=False):
+                acquired += 1
+            log = self.client.post('/login', data=dict(username="Test User", password="password"))
+            self.assertEqual(log.status_code, 503)
+            self.assertEqual(log.headers["Retry-After"], "1")
+        finally:
+            for i in range(acquired):
+                slots.release()
+            app.config['PASSWORD_HASH_TIMEOUT'] = timeout
+
+    def test_broken_hashing_pool_is_replaced(self):
+        pool, slots = kanban.hasher.executor(app.config['PASSWORD_HASH_WORKERS'])
+        broken = mock.Mock()
+        broken.submit.side_effect = kanban.BrokenProcessPool("A process died")
+        kanban.hasher.pool = broken
+        user = kanban.User(username="Test User")
+        user.set_password("password")
+        self.assertTrue(user.check_password("password"))
+        self.assertIsNot(kanban.hasher.pool, broken)
+        broken.shutdown.assert_called_once_with(wait=False)
+        pool.shutdown()
+
+####################################################################
+# Test Section - User cache
+####################################################################
+    def test_lru_cache_evicts_and_expires(self):
+        cache = kanban.LRUCache(2, 60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), "one")
+        cache.ttl = -1
+        cache.set(4, "four")
+        self.assertEqual(cache.get(4), None)
+        self.assertEqual(cache.stats()["evictions"], 2)
+        self.assertEqual(cache.stats()["hits"], 2)
+
+    def test_logged_in_user_comes_from_cache(self):
+        with self.client:
+            self.login()
+            self.client.get('/')
+            self.client.get('/')
+            stats = self.client.get('/stats/cache').get_json()["users"]
+            self.assertEqual(stats["size"], 1)
+            self.assertTrue(stats["hits"] >= 2)
+
+    def test_user_cache_invalidated_on_update_and_logout(self):
+        with self.client:
+            self.login()
+            self.client.get('/')
+            self.assertTrue(kanban.userCache.get(1) is not None)
+            user = kanban.User.query.get(1)
+            user.username = "Renamed User"
+            db.session.commit()
+            self.assertEqual(kanban.userCache.get(1), None)
+            self.client.get('/')
+            self.assertEqual(kanban.userCache.get(1).username, "Renamed User")
+            self.client.get('/logout')
+            self.assertEqual(kanban.userCache.get(1), None)
+
+####################################################################
+# Test Section - Column pagination
+####################################################################
+    def test_board_only_loads_first_page_of_columns(self):
+        self.insert_user("Test User", "password")
+        self.insert_task_types()
+        ids = [self.insert_task("card %d" % i) for i in range(5)]
+        self.insert_task("doing card", 2)
+        board = kanban.loadBoard(1, 2)
+        self.assertEqual([t.id for t in board["todo"]["cards"]], ids[:2])
+        self.assertEqual(board["todo"]["cursor"], 'a1:%d' % ids[1])
+        self.assertEqual([t.text for t in board["doing"]["cards"]], ["doing card"])
+        self.assertEqual(board["doing"]["cursor"], None)
+
+    def test_column_pages_follow_cursor(self):
+        with self.client:
+            self.login()
+            ids = [self.insert_task("card %d" % i) for i in range(5)]
+            first = self.client.get('/columns/todo?limit=3').get_json()
+            self.assertEqual([c["id"] for c in first["cards"]], ids[:3])
+            second = self.client.get('/columns/todo?limit=3&after=' + first["next"]).get_json()
+            self.assertEqual([c["id"] for c in second["cards"]], ids[3:])
+            self.assertEqual(second["next"], None)
+            self.assertEqual(self.client.get('/columns/todo?after=abc').status_code, 400)
+            self.assertEqual(self.client.get('/columns/nowhere').status_code, 404)
+
+    def test_index_renders_load_more_button(self):
+        with self.client:
+            self.login()
+            for i in range(3):
+                self.insert_task("card %d" % i)
+            page_size = app.config['COLUMN_PAGE_SIZE']
+            app.config['COLUMN_PAGE_SIZE'] = 2
+            try:
+                page = self.client.get('/')
+            finally:
+                app.config['COLUMN_PAGE_SIZE'] = page_size
+            self.assertIn(b'card 1', page.data)
+            self.assertNotIn(b'card 2', page.data)
+            self.assertIn(b'Load more', page.data)
+
+####################################################################
+# Test Section - Board JSON API
+####################################################################
+    def test_board_json_and_not_modified(self):
+        with self.client:
+            self.login()
+            self.client.post('/addTodoTask', data=dict(todoitem='To Do Task'))
+            response = self.client.get('/board')
+            columns = response.get_json()["columns"]
+            self.assertEqual([c["name"] for c in columns], ["todo", "doing", "done"])
+            self.assertEqual(columns[0]["cards"][0]["text"], "To Do Task")
+            etag = response.headers["ETag"]
+            again = self.client.get('/board', headers={"If-None-Match": etag})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.headers["ETag"], etag)
+
+    def test_writes_change_board_etag(self):
+        with self.client:
+            self.login()
+            self.client.post('/addTodoTask', data=dict(todoitem='To Do Task'))
+            etag = self.client.get('/board').headers["ETag"]
+            task = kanban.Todo.query.first().id
+            self.client.post('/todo', data=dict(todotask=task, button='Move task to next stage'))
+            moved = self.client.get('/board', headers={"If-None-Match": etag})
+            self.assertEqual(moved.status_code, 200)
+            self.client.post('/todo', data=dict(todotask=task, button='Delete task'))
+            deleted = self.client.get('/columns/doing', headers={"If-None-Match": moved.headers["ETag"]})
+            self.assertEqual(deleted.status_code, 200)
+            self.assertEqual(kanban.boardVersion(1), 3)
+
+####################################################################
+# Test Section - Change stream
+####################################################################
+    def test_writes_publish_card_changes(self):
+        with self.client:
+            self.login()
+            subscription = kanban.changes.subscribe("1")
+            try:
+                self.client.post('/addTodoTask', data=dict(todoitem='To Do Task'))
+                task = kanban.Todo.query.first().id
+                self.client.post('/todo', data=dict(todotask=task, button='Move task to next stage'))
+                self.client.post('/todo', data=dict(todotask=task, button='Delete task'))
+                events = [subscription.get_nowait() for i in range(3)]
+            finally:
+                kanban.changes.unsubscribe("1", subscription)
+            self.assertEqual([kind for kind, card, version in events], ["added", "moved", "deleted"])
+            self.assertEqual([version for kind, card, version in events], [1, 2, 3])
+            self.assertEqual(events[0][1], dict(id=task, text='To Do Task', column='todo', position='a0'))
+            self.assertEqual(events[1][1]["column"], 'doing')
+            self.assertTrue(subscription.empty())
+
+    def test_rolled_back_changes_are_not_published(self):
+        subscription = kanban.changes.subscribe("1")
+        try:
+            kanban.recordChanges(1, [("added", dict(id=1))])
+            db.session.rollback()
+            db.session.commit()
+            self.assertTrue(subscription.empty())
+        finally:
+            kanban.changes.unsubscribe("1", subscription)
+
+    def test_stream_sends_server_sent_events(self):
+        with self.client:
+            self.login()
+            stream = self.client.get('/stream', buffered=False)
+            self.assertEqual(stream.mimetype, 'text/event-stream')
+            self.client.post('/addTodoTask', data=dict(todoitem='Streamed Task'),
+                             headers={'X-Requested-With': 'fetch'})
+            chunks = iter(stream.response)
+            self.assertTrue(next(chunks).startswith(b'retry:'))
+            self.assertEqual(next(chunks), b'id: 1\n')
+            event = next(chunks)
+            self.assertTrue(event.startswith(b'event: added'))
+            self.assertIn(b'Streamed Task', event)
+            stream.close()
+            self.assertEqual(kanban.changes.channels, {})
+
+    def test_changes_are_relayed_between_processes(self):
+        server = RedisStandIn()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        #Two relays stand for two worker processes
+        self.create_app(SESSION_TYPE='cookie', CHANGE_STREAM_REDIS_URL=server.url())
+        other = kanban.RedisPubSub(server.url())
+        self.addCleanup(other.close)
+        for i in range(100):
+            if len(server.subscribers) == 2:
+                break
+            time.sleep(0.01)
+        subscription = other.subscribe("1")
+        kanban.recordChanges(1, [("added", dict(id=1, column="todo"))])
+        db.session.commit()
+        self.assertEqual(subscription.get(timeout=5), ("added", dict(id=1, column="todo"), 1))
+        self.assertEqual(kanban.changes.url, server.url())
+        #A relay that lost Redis tells its streams to reload once it is back
+        other.resetAll()
+        self.assertEqual(subscription.get(timeout=5), ("reset", {}, None))
+
+    def test_fetch_writes_answer_no_content(self):
+        with self.client:
+            self.login()
+            response = self.client.post('/addTodoTask', data=dict(todoitem='To Do Task'),
+                                        headers={'X-Requested-With': 'fetch'})
+            self.assertEqual(response.status_code, 204)
+
+####################################################################
+# Test Section - Delta sync
+####################################################################
+    def test_changes_since_version_are_compacted(self):
+        with self.client:
+            self.login()
+            self.client.post('/addTodoTask', data=dict(todoitem='first'))
+            self.client.post('/addTodoTask', data=dict(todoitem='second'))
+            first, second = [t.id for t in kanban.Todo.query.order_by(kanban.Todo.id)]
+            self.client.post('/todo', data=dict(todotask=first, button='Move task to next stage'))
+            self.client.post('/todo', data=dict(todotask=first, button='Move task to next stage'))
+            self.client.post('/todo', data=dict(todotask=second, button='Delete task'))
+            delta = self.client.get('/changes?since=1').get_json()
+            self.assertEqual(delta["version"], 5)
+            self.assertEqual(delta["cards"], [dict(id=first, text='first', column='done', position='a0')])
+            self.assertEqual(delta["deleted"], [second])
+            self.assertEqual(self.client.get('/changes?since=5').get_json()["cards"], [])
+            self.assertEqual(self.client.get('/changes?since=9').status_code, 410)
+            self.assertEqual(self.client.get('/changes').status_code, 400)
+
+    def test_compaction_drops_superseded_and_old_entries(self):
+        with self.client:
+            self.login()
+            self.client.post('/addTodoTask', data=dict(todoitem='first'))
+            task = kanban.Todo.query.first().id
+            self.client.post('/todo', data=dict(todotask=task, button='Move task to next stage'))
+            self.assertEqual(kanban.compactChangeLog(), 1)
+            self.assertEqual(self.client.get('/changes?since=0').get_json()["cards"][0]["column"], 'doing')
+            later = datetime.datetime.utcnow() + datetime.timedelta(seconds=app.config['CHANGE_LOG_RETENTION'] + 1)
+            self.assertEqual(kanban.compactChangeLog(later), 1)
+            self.assertEqual(kanban.ChangeLog.query.count(), 0)
+            self.assertEqual(self.client.get('/changes?since=1').status_code, 410)
+            self.assertEqual(self.client.get('/changes?since=2').get_json()["cards"], [])
+
+    def test_db_helper_adds_missing_columns(self):
+        db.engine.execute('DROP TABLE BoardVersion')
+        db.engine.execute('CREATE TABLE BoardVersion (boardid INTEGER PRIMARY KEY, version INTEGER NOT NULL)')
+        db.engine.execute('INSERT INTO BoardVersion VALUES (1, 4)')
+        kanban.dbHelper()
+        self.assertEqual(kanban.BoardVersion.query.get(1).compacted, 0)
+
+####################################################################
+# Test Section - SQLite production profile
+####################################################################
+    def test_production_profile_pragmas_and_pool(self):
+        self.use_sqlite_production()
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(db.session.execute('PRAGMA cache_size').scalar(), -64000)
+        self.assertEqual(type(db.get_engine().pool).__name__, 'QueuePool')
+
+    def test_coalesced_writes_commit_together_and_fail_alone(self):
+        self.use_sqlite_production(coalesceWrites=True)
+        self.insert_task_types()
+        wait = app.config['WRITE_COALESCE_WAIT']
+        app.config['WRITE_COALESCE_WAIT'] = 0.3
+        batches = kanban.coalescer.batches
+        subscription = kanban.changes.subscribe("1")
+        self.addCleanup(kanban.changes.unsubscribe, "1", subscription)
+        results = dict()
+        def add(number):
+            def write():
+                if number == 3:
+                    db.session.add(kanban.Todo(text="never saved", type=1, userid=1, boardid=1))
+                    raise ValueError("bad card")
+                todo = kanban.Todo(text="card %d" % number, type=1, userid=1, boardid=1)
+                db.session.add(todo)
+                db.session.flush()
+                kanban.recordChanges(1, [("added", kanban.cardData(todo))])
+                return todo.id
+            try:
+                results[number] = kanban.runWrite(write)
+            except ValueError as error:
+                results[number] = error
+        try:
+            threads = [threading.Thread(target=add, args=(number,)) for number in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            app.config['WRITE_COALESCE_WAIT'] = wait
+        self.assertTrue(isinstance(results.pop(3), ValueError))
+        texts = sorted(t.text for t in kanban.Todo.query.all())
+        self.assertEqual(texts, ["card 0", "card 1", "card 2", "card 4"])
+        self.assertEqual(sorted(results.values()), sorted(t.id for t in kanban.Todo.query.all()))
+        self.assertEqual(kanban.ChangeLog.query.count(), 4)
+        self.assertEqual(subscription.qsize(), 4)
+        self.assertTrue(kanban.coalescer.batches - batches < 4)
+
+    def test_coalescer_survives_a_broken_session(self):
+        self.use_sqlite_production(coalesceWrites=True)
+        self.insert_task_types()
+        session = db.session
+        original = dict((name, getattr(session, name)) for name in ('begin_nested', 'commit', 'rollback'))
+        failing = set()
+        #Fails the given session methods on the writer thread only
+        def method(name):
+            def call(*args, **kwargs):
+                if name in failing and threading.current_thread().name == 'write-coalescer':
+                    raise RuntimeError("%s failed" % name)
+                return original[name](*args, **kwargs)
+            return call
+        results = list()
+        def write():
+            try:
+                results.append(kanban.runWrite(lambda: kanban.Todo.query.count()))
+            except RuntimeError as error:
+                results.append(str(error))
+        with mock.patch.multiple(session, **dict((name, method(name)) for name in original)):
+            #A dead writer thread would leave the writes waiting forever
+            for broken in (['begin_nested'], ['commit', 'rollback'], []):
+                failing.clear()
+                failing.update(broken)
+                thread = threading.Thread(target=write)
+                thread.start()
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        self.assertEqual(results, ["begin_nested failed", "rollback failed", 0])
+
+    def test_routes_work_with_write_coalescing(self):
+        self.use_sqlite_production(coalesceWrites=True)
+        with self.client:
+            self.login()
+            response = self.client.post('/addTodoTask', data=dict(todoitem='To Do Task'), follow_redirects=True)
+            self.assertIn(b'To Do Task', response.data)
+            task = kanban.Todo.query.first().id
+            self.client.post('/todo', data=dict(todotask=task, button='Move task to next stage'))
+            self.assertEqual(kanban.Todo.query.get(task).type, 2)
+
+####################################################################
+# Test Section - Deployment and sessions
+####################################################################
+    def test_create_app_requires_secret_key(self):
+        self.assertRaises(RuntimeError, self.create_app, TESTING=False)
+        configured = self.create_app(TESTING=False, SECRET_KEY='shared secret', SESSION_TYPE='cookie')
+        self.assertEqual(configured.secret_key, 'shared secret')
+
+    def test_sqlite_sessions_shared_between_workers(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sessions.db')
+        self.create_app(SECRET_KEY='shared secret', SESSION_TYPE='sqlite', SESSION_SQLITE_PATH=path)
+        self.login()
+        #Another worker process has its own store object on the same file
+        app.session_interface = kanban.StoredSessionInterface(kanban.SqliteSessionStore(path))
+        page = self.client.get('/', follow_redirects=True)
+        self.assertIn(b'SUCH TO DO', page.data)
+        self.client.get('/logout')
+        page = self.client.get('/', follow_redirects=True)
+        self.assertIn(b'Click Here to Register!', page.data)
+
+    def test_redis_sessions(self):
+        server = RedisStandIn()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.create_app(SECRET_KEY='shared secret', SESSION_TYPE='redis', SESSION_REDIS_URL=server.url())
+        self.login()
+        self.assertEqual(len(server.data), 1)
+        page = self.client.get('/', follow_redirects=True)
+        self.assertIn(b'SUCH TO DO', page.data)
+
+    def test_factory_sizes_caches_from_environment(self):
+        with mock.patch.dict(os.environ, {'KANBAN_USER_CACHE_TTL': '5', 'KANBAN_FRAGMENT_CACHE_SIZE': '10'}):
+            self.create_app(SESSION_TYPE='cookie')
+        self.assertEqual(kanban.userCache.ttl, 5)
+        self.assertEqual(kanban.fragmentCache.stats()["maxsize"], 10)
+
+    def test_string_settings_stay_strings(self):
+        environment = {'KANBAN_SECRET_KEY': '12345', 'KANBAN_SESSION_TYPE': 'cookie',
+                       'KANBAN_SQLALCHEMY_DATABASE_URI': 'sqlite:///test.db', 'KANBAN_JOB_WORKERS': '0'}
+        with mock.patch.dict(os.environ, environment):
+            self.create_app()
+        self.assertEqual(app.config['SECRET_KEY'], '12345')
+        self.assertEqual(app.config['JOB_WORKERS'], 0)
+
+    def test_login_gives_the_session_a_new_id(self):
+        store = kanban.FilesystemSessionStore(tempfile.mkdtemp())
+        self.create_app(SECRET_KEY='shared secret', SESSION_TYPE='filesystem', SESSION_FILE_DIR=store.directory)
+        self.insert_user("Test User", "password")
+        #The id an attacker would have planted through a visit of their own
+        with self.client.session_transaction() as stored:
+            stored['planted'] = True
+            planted = stored.sid
+        self.client.post('/login', data=dict(username="Test User", password="password"))
+        with self.client.session_transaction() as stored:
+            self.assertNotEqual(stored.sid, planted)
+            self.assertTrue(stored['planted'])
+        self.assertEqual(store.get(planted), None)
+
+    def test_tampered_session_cookie_starts_new_session(self):
+        self.create_app(SECRET_KEY='shared secret', SESSION_TYPE='filesystem', SESSION_FILE_DIR=tempfile.mkdtemp())
+        self.login()
+        cookie = app.session_cookie_name
+        self.client.set_cookie('localhost', cookie, 'forged.signature')
+        #The remember me cookie would log the user back in
+        self.client.delete_cookie('localhost', 'remember_token')
+        page = self.client.get('/', follow_redirects=True)
+        self.assertIn(b'Click Here to Register!', page.data)
+
+    def test_filesystem_session_store_expires(self):
+        store = kanban.FilesystemSessionStore(tempfile.mkdtemp())
+        store.set('abc', '{"a": 1}', 60)
+        self.assertEqual(store.get('abc'), '{"a": 1}')
+        store.set('old', '{}', -1)
+        self.assertEqual(store.get('old'), None)
+        store.delete('abc')
+        self.assertEqual(store.get('abc'), None)
+
+####################################################################
+# Test Section - Card positions
+####################################################################
+    def test_position_between_orders_keys(self):
+        first = kanban.positionBetween(None, None)
+        later = kanban.positionBetween(first, None)
+        earlier = kanban.positionBetween(None, first)
+        middle = kanban.positionBetween(first, later)
+        self.assertEqual(sorted([later, middle, earlier, first]), [earlier, first, middle, later])
+        keys = kanban.positionsAfter(later, 100)
+        self.assertEqual(sorted(keys), keys)
+        self.assertTrue(keys[0] > later)
+        with self.assertRaises(ValueError):
+            kanban.positionBetween(first, first)
+
+    def test_reposition_card_between_neighbours(self):
+        self.login()
+        first = self.insert_task("first")
+        second = self.insert_task("second")
+        third = self.insert_task("third")
+        response = self.client.post('/cards/%d/position' % third, json=dict(column="todo", after=first))
+        self.assertEqual(response.status_code, 200)
+        order = [card.id for card in kanban.loadBoard(1)["todo"]["cards"]]
+        self.assertEqual(order, [first, third, second])
+        response = self.client.post('/cards/%d/position' % second, json=dict(column="todo", after=None))
+        order = [card.id for card in kanban.loadBoard(1)["todo"]["cards"]]
+        self.assertEqual(order, [second, first, third])
+
+    def test_reposition_card_checks_transitions(self):
+        self.login()
+        task = self.insert_task("first")
+        response = self.client.post('/cards/%d/position' % task, json=dict(column="done"))
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post('/cards/%d/position' % task, json=dict(column="doing"))
+        self.assertEqual(response.get_json()["column"], "doing")
+        response = self.client.post('/cards/999/position', json=dict(column="doing"))
+        self.assertEqual(response.status_code, 404)
+
+    def test_rebalance_renumbers_long_and_missing_keys(self):
+        self.insert_task_types()
+        db.session.add_all([kanban.Todo(text="old", type=1, userid=1, boardid=1),
+                            kanban.Todo(text="long", type=1, userid=1, boardid=1, position="a0" + "V" * 30)])
+        db.session.commit()
+        self.assertEqual(kanban.rebalancePositions(), 1)
+        positions = [card.position for card in kanban.loadBoard(1)["todo"]["cards"]]
+        self.assertEqual([card.text for card in kanban.loadBoard(1)["todo"]["cards"]], ["long", "old"])
+        self.assertTrue(all(len(p) <= 3 for p in positions))
+        self.assertEqual(kanban.rebalancePositions(), 0)
+
+####################################################################
+# Test Section - Search
+####################################################################
+    def test_search_ranks_and_filters_by_user(self):
+        self.login()
+        self.insert_task("buy milk")
+        best = self.insert_task("milk milk milk")
+        self.insert_task("walk the dog")
+        self.insert_task("milk for someone else", userid=2)
+        response = self.client.get('/search?q=milk')
+        cards = response.get_json()["cards"]
+        self.assertEqual([card["text"] for card in cards], ["milk milk milk", "buy milk"])
+        self.assertEqual(cards[0]["id"], best)
+
+    def test_search_prefix_and_column(self):
+        self.login()
+        self.insert_task("deploy the release")
+        self.insert_task("deployment notes", 2)
+        response = self.client.get('/search?q=deploy*')
+        self.assertEqual(len(response.get_json()["cards"]), 2)
+        response = self.client.get('/search?q=deploy*&column=doing')
+        self.assertEqual([card["text"] for card in response.get_json()["cards"]], ["deployment notes"])
+        self.assertEqual(self.client.get('/search?q=deploy&column=nope').status_code, 404)
+        #Query syntax typed by the user is taken as plain words
+        self.assertEqual(self.client.get('/search?q="deploy" OR (').status_code, 200)
+
+    def test_search_follows_moves_and_deletes(self):
+        self.login()
+        task = self.insert_task("write report")
+        kanban.applyBatch(1, [dict(op="move", ids=[task])])
+        self.assertEqual([card.id for card in kanban.searchCards(1, "report", 2)], [task])
+        self.assertEqual(kanban.searchCards(1, "report", 1), [])
+        kanban.applyBatch(1, [dict(op="delete", ids=[task])])
+        self.assertEqual(kanban.searchCards(1, "report"), [])
+
+    def test_db_helper_indexes_existing_cards(self):
+        self.insert_task_types()
+        self.insert_task("old card")
+        db.engine.execute('DROP TABLE TodoSearch')
+        kanban.dbHelper()
+        self.assertEqual([card.text for card in kanban.searchCards(1, "old")], ["old card"])
+
+####################################################################
+# Test Section - Import and export
+####################################################################
+    def test_import_csv_upload(self):
+        self.login()
+        self.insert_task("already here")
+        upload = io.BytesIO(b'text,column\r\nfirst,\r\n"second, with comma",doing\r\n,todo\r\nthird,nope\r\n')
+        response = self.client.post('/import', data=dict(file=(upload, 'cards.csv')),
+                                    content_type='multipart/form-data')
+        report = response.get_json()
+        self.assertEqual(report["imported"], 2)
+        self.assertEqual(report["rejected"], 2)
+        self.assertEqual([error["line"] for error in report["errors"]], [4, 5])
+        board = kanban.loadBoard(1)
+        self.assertEqual([card.text for card in board["todo"]["cards"]], ["already here", "first"])
+        self.assertEqual([card.text for card in board["doing"]["cards"]], ["second, with comma"])
+
+    def test_import_jsonl_body_in_chunks(self):
+        self.login()
+        body = "".join(json.dumps(dict(text="card %d" % i)) + "\n" for i in range(25)) + "not json\n"
+        with mock.patch.object(kanban, 'IMPORT_CHUNK_SIZE', 10):
+            response = self.client.post('/import?format=jsonl', data=body)
+        self.assertEqual(response.get_json()["imported"], 25)
+        self.assertEqual(response.get_json()["errors"], [dict(line=26, error="Not a card")])
+        cards = kanban.loadBoard(1)["todo"]["cards"]
+        self.assertEqual([card.text for card in cards], ["card %d" % i for i in range(25)])
+        self.assertEqual(kanban.boardVersion(1), 3)
+        self.assertEqual(self.client.post('/import?format=xml', data="").status_code, 400)
+
+    def test_import_reports_unreadable_files(self):
+        self.login()
+        response = self.client.post('/import?format=csv', data=b'text\nfirst\n',
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 400)
+        body = b'text\nfirst\nsecond\n\xff\xfe broken\n'
+        with mock.patch.object(kanban, 'IMPORT_CHUNK_SIZE', 2):
+            report = self.client.post('/import?format=csv', data=body, content_type='text/csv').get_json()
+        self.assertEqual((report["imported"], report["error"]), (2, "The file is not UTF-8 text"))
+        body = b'text\n' + b'x' * (csv.field_size_limit() + 1) + b'\n'
+        report = self.client.post('/import?format=csv', data=body, content_type='text/csv').get_json()
+        self.assertIn("not valid CSV", report["error"])
+        self.assertEqual(kanban.Todo.query.count(), 2)
+
+    def test_export_streams_board(self):
+        self.login()
+        self.insert_task("first")
+        self.insert_task("second", 2)
+        self.insert_task("third")
+        with mock.patch.object(kanban, 'EXPORT_PAGE_SIZE', 1):
+            response = self.client.get('/export?format=jsonl')
+            cards = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([(card["text"], card["column"]) for card in cards],
+                         [("first", "todo"), ("third", "todo"), ("second", "doing")])
+        response = self.client.get('/export')
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.reader(io.StringIO(response.data.decode())))
+        self.assertEqual(rows[0], ["id", "text", "column", "position"])
+        self.assertEqual(len(rows), 4)
+
+####################################################################
+# Test Section - Archive
+####################################################################
+    def test_archive_moves_old_done_cards(self):
+        self.login()
+        old = self.insert_task("shipped long ago", 3)
+        recent = self.insert_task("shipped today", 3)
+        doing = self.insert_task("still working", 2)
+        week = datetime.timedelta(days=7)
+        kanban.Todo.query.filter(kanban.Todo.id.in_([old, doing])).update(
+            {kanban.Todo.movedat: datetime.datetime.utcnow() - 10 * week}, synchronize_session=False)
+        db.session.commit()
+        version = kanban.boardVersion(1)
+        self.assertEqual(kanban.archiveCards(), 1)
+        board = kanban.loadBoard(1)
+        self.assertEqual([card.id for card in board["done"]["cards"]], [recent])
+        self.assertEqual([card.id for card in board["doing"]["cards"]], [doing])
+        self.assertEqual(kanban.changesSince(1, version)["deleted"], [old])
+        self.assertEqual(kanban.archiveCards(), 0)
+
+    def test_moving_a_card_restarts_its_wait(self):
+        self.login()
+        task = self.insert_task("review", 2)
+        kanban.Todo.query.update({kanban.Todo.movedat: datetime.datetime(2000, 1, 1)})
+        db.session.commit()
+        kanban.applyBatch(1, [dict(op="move", ids=[task])])
+        self.assertEqual(kanban.archiveCards(), 0)
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=31)
+        self.assertEqual(kanban.archiveCards(now=later), 1)
+
+    def test_archive_is_browsable_and_searchable(self):
+        self.login()
+        for i in range(3):
+            self.insert_task("old report %d" % i, 3)
+        self.insert_task("report on the board", 1)
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=31)
+        self.assertEqual(kanban.archiveCards(now=later), 3)
+        page = self.client.get('/archive?limit=2').get_json()
+        self.assertEqual([card["text"] for card in page["cards"]], ["old report 2", "old report 1"])
+        page = self.client.get('/archive?limit=2&before=' + page["next"]).get_json()
+        self.assertEqual([card["text"] for card in page["cards"]], ["old report 0"])
+        self.assertEqual(page["next"], None)
+        found = self.client.get('/archive?q=report').get_json()["cards"]
+        self.assertEqual(len(found), 3)
+        self.assertTrue(all(card["column"] == "done" for card in found))
+        self.assertEqual(len(self.client.get('/search?q=report').get_json()["cards"]), 1)
+
+    def test_old_card_table_stops_reusing_archived_ids(self):
+        self.login()
+        db.session.remove()
+        with db.engine.begin() as connection:
+            kanban.dropSearchIndex(kanban.Todo.__table__, connection)
+            connection.execute('DROP TABLE "Todo"')
+            connection.execute('CREATE TABLE "Todo" (id INTEGER NOT NULL PRIMARY KEY, text VARCHAR(200), '
+                               'userid INTEGER, type INTEGER)')
+        kanban.addMissingColumns()
+        kept = self.insert_task("kept card")
+        newest = self.insert_task("newest card", 3)
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=31)
+        self.assertEqual(kanban.archiveCards(now=later), 1)
+        kanban.dbHelper()
+        ddl = db.engine.execute("SELECT sql FROM sqlite_master WHERE name = 'Todo'").scalar()
+        self.assertIn("AUTOINCREMENT", ddl)
+        self.assertGreater(self.insert_task("another card", 3), newest)
+        self.assertEqual(kanban.archiveCards(now=later + datetime.timedelta(days=31)), 1)
+        self.assertEqual([card.id for card in kanban.searchCards(1, "kept")], [kept])
+
+####################################################################
+# Test Section - Column counters and WIP limits
+####################################################################
+    def counts(self):
+        return dict((kanban.workflow.typeName(typeid), count)
+                    for typeid, (count, limit, version) in kanban.columnCounters(1).items())
+
+    def test_counters_follow_writes(self):
+        self.login()
+        self.client.post('/addTodoTask', data=dict(todoitem="first"))
+        self.client.post('/addTodoTask', data=dict(todoitem="second"))
+        self.client.post('/addDoingTask', data=dict(todoitem="third"))
+        self.assertEqual(self.counts(), dict(todo=2, doing=1, done=0))
+        first, second, third = [todo.id for todo in kanban.Todo.query.order_by(kanban.Todo.id)]
+        kanban.applyBatch(1, [dict(op="move", ids=[first, third]), dict(op="delete", ids=[second])])
+        self.assertEqual(self.counts(), dict(todo=0, doing=1, done=1))
+        self.client.post('/cards/%d/position' % first, json=dict(column="done"))
+        self.assertEqual(self.counts(), dict(todo=0, doing=0, done=2))
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=31)
+        kanban.archiveCards(now=later)
+        self.assertEqual(self.counts(), dict(todo=0, doing=0, done=0))
+        self.assertEqual(kanban.repairCounters(), 0)
+
+    def test_archive_counts_column_without_counter(self):
+        self.login()
+        for i in range(3):
+            self.insert_task("done %d" % i, 3)
+        kanban.ColumnCounter.query.delete()
+        db.session.commit()
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+        kanban.Todo.query.filter(kanban.Todo.text != "done 2").update({kanban.Todo.movedat: old},
+                                                                       synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(kanban.archiveCards(), 2)
+        self.assertEqual(self.counts()["done"], 1)
+        self.assertEqual(kanban.repairCounters(), 0)
+
+    def test_wip_limit_rejects_adds_and_moves(self):
+        self.login()
+        response = self.client.post('/workflow', json=dict(limits=dict(doing=1)))
+        self.assertEqual(response.get_json()["limits"], dict(doing=1))
+        todo = self.insert_task("waiting")
+        self.client.post('/addDoingTask', data=dict(todoitem="busy"))
+        response = self.client.post('/addDoingTask', data=dict(todoitem="too much"),
+                                    headers={'X-Requested-With': 'fetch'})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post('/todo/batch', json=dict(operations=[dict(op="move", ids=[todo])]))
+        self.assertEqual(response.status_code, 409)
+        page = self.client.post('/addDoingTask', data=dict(todoitem="too much"), follow_redirects=True)
+        self.assertIn(b'doing is full', page.data)
+        self.assertEqual(kanban.Todo.query.filter_by(type=2).count(), 1)
+        self.client.post('/workflow', json=dict(limits=dict(doing=None)))
+        response = self.client.post('/todo/batch', json=dict(operations=[dict(op="move", ids=[todo])]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post('/workflow', json=dict(limits=dict(nope=1))).status_code, 400)
+
+    def test_repair_counters_fixes_drift(self):
+        self.login()
+        self.client.post('/addTodoTask', data=dict(todoitem="first"))
+        self.insert_task("added behind the counters' back")
+        kanban.ColumnCounter.query.filter_by(type=3).delete()
+        db.session.add(kanban.ColumnCounter(boardid=1, type=3, count=7))
+        db.session.commit()
+        self.assertEqual(kanban.repairCounters(), 2)
+        self.assertEqual(self.counts(), dict(todo=2, doing=0, done=0))
+        board = self.client.get('/board').get_json()
+        self.assertEqual([(column["count"], column["limit"]) for column in board["columns"]],
+                         [(2, None), (0, None), (0, None)])
+
+####################################################################
+# Test Section - Metrics
+####################################################################
+    def test_metrics_count_requests_and_statements(self):
+        self.login()
+        kanban.metrics.reset()
+        for i in range(3):
+            self.insert_task("task %d" % i)
+        self.client.get('/board')
+        page = self.client.get('/metrics').data.decode()
+        self.assertIn('kanban_requests_total{endpoint="boardJson",method="GET",status="200"} 1', page)
+        self.assertIn('kanban_request_duration_seconds_count{endpoint="boardJson",method="GET"} 1', page)
+        self.assertIn('# TYPE kanban_request_sql_statements histogram', page)
+        self.assertIn('kanban_sql_duration_seconds_bucket{statement="SELECT",le="+Inf"}', page)
+        self.assertIn('kanban_user_cache_size ', page)
+
+    def test_moves_issue_a_fixed_number_of_statements(self):
+        self.login()
+        few = [self.insert_task("few %d" % i) for i in range(2)]
+        many = [self.insert_task("many %d" % i) for i in range(40)]
+        #The first move also starts the column counters
+        self.client.post('/todo', data=dict(button='Move task to next stage', todotask=[self.insert_task("first")]))
+        statements = list()
+        for ids in (few, many):
+            kanban.metrics.reset()
+            self.client.post('/todo', data=dict(button='Move task to next stage', todotask=ids))
+            page = kanban.metrics.render()
+            statements.append(re.search(r'kanban_request_sql_statements_sum\{endpoint="todo",method="POST"\} (\d+)', page).group(1))
+        self.assertEqual(statements[0], statements[1])
+
+    def test_slow_queries_are_logged(self):
+        app.config['SLOW_QUERY_THRESHOLD'] = 0
+        self.addCleanup(app.config.__setitem__, 'SLOW_QUERY_THRESHOLD', 0.1)
+        with self.assertLogs('kanban', level='WARNING') as logs:
+            kanban.Todo.query.all()
+        self.assertIn('Slow query', logs.output[0])
+
+    def test_metrics_token(self):
+        app.config['METRICS_TOKEN'] = 'scraper'
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN', None)
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(response.status_code, 200)
+
+####################################################################
+# Test Section - Benchmark suite
+####################################################################
+    def test_benchmark_seeds_and_reports(self):
+        bench.seedDatabase(4, 40, log=lambda message: None)
+        self.assertEqual(kanban.User.query.count(), 4)
+        self.assertEqual(kanban.Todo.query.filter_by(userid=2).count(), 10)
+        users = bench.pickUsers(2)
+        results = bench.runMode("client", users, ["board", "move"], 6, 1, log=lambda message: None)
+        self.assertEqual(list(results), ["board", "move"])
+        self.assertEqual(results["board"]["requests"], 6)
+        self.assertEqual(results["board"]["errors"], 0)
+        self.assertTrue(results["move"]["sql_per_request"] > 0)
+
+    def test_benchmark_compare_flags_regressions(self):
+        before = dict(client=dict(board=dict(p95_ms=10.0, sql_per_request=3.0)))
+        after = dict(client=dict(board=dict(p95_ms=11.0, sql_per_request=3.0)))
+        self.assertEqual(bench.compareResults(before, after), [])
+        after = dict(client=dict(board=dict(p95_ms=20.0, sql_per_request=13.0)))
+        self.assertEqual(len(bench.compareResults(before, after)), 2)
+        self.assertEqual(bench.percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(bench.percentile(list(range(1, 101)), 0.99), 99)
+
+####################################################################
+# Test Section - Fragment cache and static assets
+####################################################################
+    def test_unchanged_columns_are_not_rendered_again(self):
+        self.login()
+        self.client.post('/addTodoTask', data=dict(todoitem="first"))
+        self.client.post('/addDoneTask', data=dict(todoitem="shipped"))
+        kanban.fragmentCache.clear()
+        self.client.get('/')
+        with mock.patch.object(kanban, 'loadBoard', wraps=kanban.loadBoard) as load:
+            page = self.client.get('/')
+            self.assertIn(b'shipped', page.data)
+            self.assertEqual(load.call_count, 0)
+            self.client.post('/addTodoTask', data=dict(todoitem="second"))
+            page = self.client.get('/')
+            self.assertIn(b'second', page.data)
+            self.assertEqual(load.call_args[0][2], [1])
+
+    def test_moves_retire_both_columns(self):
+        self.login()
+        self.client.post('/addTodoTask', data=dict(todoitem="first"))
+        self.client.post('/addDoingTask', data=dict(todoitem="busy"))
+        self.client.get('/')
+        task = kanban.Todo.query.filter_by(text="first").first().id
+        self.client.post('/todo', data=dict(button='Move task to next stage', todotask=[task]))
+        page = self.client.get('/').data.decode()
+        doing = page.index('id="doing"')
+        self.assertTrue(page.index('card-%d"' % task) > doing)
+
+    def test_static_assets_are_fingerprinted(self):
+        page = self.client.get('/login').data.decode()
+        url = re.search(r'url\("(/assets/doge\.[0-9a-f]{12}\.jpg)"\)', page).group(1)
+        response = self.client.get(url)
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response.data, open(os.path.join(app.static_folder, 'doge.jpg'), 'rb').read())
+        self.assertNotIn('Content-Encoding', response.headers)
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.get('/assets/doge.000000000000.jpg').status_code, 404)
+        self.assertTrue(len(kanban.compressedVariants(b'text ' * 200)['gzip']) < 1000)
+
+    def test_brotli_wins_ties_with_gzip(self):
+        def choose(header):
+            with app.test_request_context(headers={'Accept-Encoding': header}):
+                return kanban.preferredEncoding(dict(br=b'', gzip=b''))
+        self.assertEqual(choose('gzip, deflate, br'), 'br')
+        self.assertEqual(choose('gzip;q=1.0, br;q=0.5'), 'gzip')
+        self.assertEqual(choose('br;q=0, gzip'), 'gzip')
+        self.assertEqual(choose('identity'), None)
+
+    def test_dynamic_responses_are_gzipped(self):
+        self.login()
+        for i in range(30):
+            self.insert_task("card number %d" % i)
+        response = self.client.get('/board', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))["columns"]), 3)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.client.get('/board', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('Content-Encoding', self.client.get('/board').headers)
+
+####################################################################
+# Test Section - Shared boards
+####################################################################
+    def test_shared_board_roles(self):
+        self.insert_user("Viewer", "password")
+        self.insert_user("Stranger", "password")
+        self.login()
+        response = self.client.post('/boards', json=dict(name="Team"))
+        self.assertEqual(response.status_code, 201)
+        team = response.get_json()["id"]
+        response = self.client.post('/boards/%d/members' % team, json=dict(username="Viewer", role="viewer"))
+        self.assertEqual([m["role"] for m in response.get_json()["members"]], ["viewer", "owner"])
+        self.client.post('/addTodoTask?board=%d' % team, data=dict(todoitem="shared card"))
+        self.client.post('/addTodoTask', data=dict(todoitem="private card"))
+        self.client.get('/logout')
+        self.client.post('/login', data=dict(username="Viewer", password="password"))
+        cards = self.client.get('/board?board=%d' % team).get_json()["columns"][0]["cards"]
+        self.assertEqual([card["text"] for card in cards], ["shared card"])
+        self.assertEqual(self.client.get('/search?q=card&board=%d' % team).get_json()["cards"][0]["text"], "shared card")
+        self.assertEqual(self.client.post('/addTodoTask?board=%d' % team, data=dict(todoitem="no")).status_code, 403)
+        self.assertEqual(self.client.post('/boards/%d/members' % team, json=dict(username="Stranger")).status_code, 403)
+        self.assertEqual(self.client.get('/board?board=3').status_code, 404)
+        self.assertEqual(kanban.Todo.query.filter_by(text="shared card").first().userid, 3)
+
+    def test_opened_board_is_remembered(self):
+        self.login()
+        team = kanban.createBoard(1, "Team")
+        self.insert_task("shared card", boardid=team)
+        page = self.client.get('/?board=%d' % team)
+        self.assertIn(b'shared card', page.data)
+        self.assertIn(b'<option value="%d" selected>Team</option>' % team, page.data)
+        self.assertEqual(self.client.get('/board').get_json()["columns"][0]["cards"][0]["text"], "shared card")
+        self.assertEqual(self.client.get('/?board=99').status_code, 404)
+        self.assertEqual(len(self.client.get('/boards').get_json()["boards"]), 2)
+
+    def test_membership_checks_are_cached(self):
+        self.insert_user("Member", "password")
+        self.login()
+        team = kanban.createBoard(1, "Team")
+        self.client.get('/board?board=%d' % team)
+        with mock.patch.object(kanban.db.session, 'query', wraps=kanban.db.session.query) as query:
+            self.client.get('/board?board=%d' % team)
+            self.assertFalse(any(arg is kanban.BoardMember.role for call in query.call_args_list for arg in call[0]))
+            kanban.membershipCache.clear()
+            self.client.get('/board?board=%d' % team)
+            self.assertTrue(any(arg is kanban.BoardMember.role for call in query.call_args_list for arg in call[0]))
+        kanban.setMember(team, 2, "editor")
+        self.assertEqual(kanban.boardRole(2, team), "editor")
+        kanban.setMember(team, 2, "viewer")
+        self.assertEqual(kanban.boardRole(2, team), "viewer")
+        with self.assertRaises(kanban.InvalidMember):
+            kanban.removeMember(team, 1)
+        self.assertTrue(kanban.removeMember(team, 2))
+        self.assertEqual(kanban.boardRole(2, team), None)
+
+    def test_db_helper_gives_old_users_personal_boards(self):
+        self.insert_task_types()
+        db.session.execute(kanban.User.__table__.insert(), [dict(id=1, username="old"), dict(id=2, username="older")])
+        db.session.execute(kanban.Board.__table__.insert().values(id=2, name="Taken", ownerid=5))
+        db.session.execute(kanban.Todo.__table__.insert().values(text="old card", userid=2, type=1))
+        db.session.commit()
+        kanban.dbHelper()
+        self.assertEqual(kanban.User.query.get(1).boardid, 1)
+        board = kanban.User.query.get(2).boardid
+        self.assertNotIn(board, (1, 2))
+        self.assertEqual(kanban.boardRole(2, board), "owner")
+        self.assertEqual([card.text for card in kanban.searchCards(board, "old")], ["old card"])
+
+####################################################################
+# Test Section - Background jobs
+####################################################################
+    def test_clear_column_job(self):
+        self.login()
+        for i in range(12):
+            self.insert_task("done %d" % i, 3)
+        self.insert_task("still to do")
+        with mock.patch.object(kanban, 'BULK_CHUNK_SIZE', 5):
+            response = self.client.post('/jobs', json=dict(kind="clear-column", column="done"))
+            self.assertEqual(response.status_code, 202)
+            job = response.get_json()
+            self.assertEqual(job["status"], "queued")
+            self.assertEqual(kanban.Todo.query.count(), 13)
+            self.assertEqual(kanban.runPendingJobs(), 1)
+        job = self.client.get(response.headers['Location']).get_json()
+        self.assertEqual((job["status"], job["result"]), ("done", dict(deleted=12)))
+        self.assertEqual([t.text for t in kanban.Todo.query.all()], ["still to do"])
+        self.assertEqual(kanban.columnCounters(1)[3][0], 0)
+        self.assertEqual(self.client.post('/jobs', json=dict(kind="clear-column", column="nope")).status_code, 400)
+        self.assertEqual(self.client.post('/jobs', json=dict(kind="format-disk")).status_code, 400)
+
+    def test_failed_jobs_are_retried(self):
+        self.login()
+        calls = list()
+        def flaky(boardid, userid, arguments):
+            calls.append(arguments)
+            raise RuntimeError("database is locked")
+        with mock.patch.dict(kanban.JOB_KINDS, flaky=(flaky, "viewer", None)):
+            jobid = kanban.enqueueJob("flaky", 1, 1, dict(n=1))
+            now = datetime.datetime.utcnow()
+            self.assertEqual(kanban.runPendingJobs(now), 1)
+            job = kanban.Job.query.get(jobid)
+            self.assertEqual((job.status, job.attempts, job.error), ("queued", 1, "database is locked"))
+            self.assertEqual(kanban.runPendingJobs(now), 0)
+            later = now + datetime.timedelta(seconds=60)
+            self.assertEqual(kanban.runPendingJobs(later), 1)
+            self.assertEqual(kanban.runPendingJobs(later + datetime.timedelta(seconds=60)), 1)
+        job = kanban.Job.query.get(jobid)
+        self.assertEqual((job.status, job.attempts, len(calls)), ("failed", 3, 3))
+        jobid = kanban.enqueueJob("batch", 1, 1, dict())
+        kanban.runPendingJobs()
+        self.assertEqual(kanban.Job.query.get(jobid).attempts, 1)
+        self.assertEqual(kanban.Job.query.get(jobid).status, "failed")
+
+    def test_copy_board_job(self):
+        self.login()
+        self.client.post('/workflow', json=dict(columns=["todo", "review", "done"], limits=dict(review=5)))
+        self.client.post('/addTodoTask', data=dict(todoitem="first"))
+        self.client.post('/addTask/review', data=dict(todoitem="second"))
+        self.client.post('/addTodoTask', data=dict(todoitem="third"))
+        jobid = self.client.post('/jobs', json=dict(kind="copy-board", name="Copy")).get_json()["id"]
+        kanban.runPendingJobs()
+        copy = self.client.get('/jobs/%d' % jobid).get_json()["result"]["board"]
+        self.assertEqual(kanban.boardRole(1, copy), "owner")
+        board = self.client.get('/board?board=%d' % copy).get_json()["columns"]
+        self.assertEqual([(c["name"], c["limit"], [card["text"] for card in c["cards"]]) for c in board],
+                         [("todo", None, ["first", "third"]), ("review", 5, ["second"]), ("done", None, [])])
+        self.assertEqual(len(self.client.get('/jobs').get_json()["jobs"]), 1)
+        self.client.get('/logout')
+        self.login("Someone Else")
+        self.assertEqual(self.client.get('/jobs/%d' % jobid).status_code, 404)
+
+    def test_job_workers_run_queued_jobs(self):
+        self.login()
+        self.insert_task("first")
+        runner = kanban.JobRunner()
+        with mock.patch.object(kanban, 'jobs', runner):
+            runner.start(2)
+            self.addCleanup(runner.stop)
+            jobid = self.client.post('/jobs', json=dict(kind="batch", operations=[
+                dict(op="move", ids=[1])])).get_json()["id"]
+            for i in range(100):
+                db.session.remove()
+                if kanban.Job.query.get(jobid).status == "done":
+                    break
+                threading.Event().wait(0.05)
+        job = self.client.get('/jobs/%d' % jobid).get_json()
+        self.assertEqual(job["result"], [dict(op="move", results={"1": "moved"})])
+        self.assertEqual(kanban.Todo.query.get(1).type, 2)
+        stale = kanban.enqueueJob("recount", 1, 1, dict())
+        kanban.Job.query.filter_by(id=stale).update(dict(status="running", started=datetime.datetime(2000, 1, 1)))
+        db.session.commit()
+        self.assertEqual(kanban.tidyJobs(), (1, 0))
+        self.assertEqual(kanban.Job.query.get(stale).status, "queued")
+
+    def test_factory_sets_up_database_before_background_tasks(self):
+        db.session.remove()
+        db.drop_all()
+        tables = list()
+        started = lambda: tables.extend(kanban.inspect(db.engine).get_table_names())
+        with mock.patch.object(kanban, 'startBackgroundTasks', side_effect=started):
+            self.create_app(SESSION_TYPE='cookie', INIT_DATABASE=True, BACKGROUND_TASKS=True)
+        self.assertIn('Job', tables)
+        self.assertIn('TodoSearch', tables)
+        self.assertEqual(kanban.TodoType.query.count(), 3)
+
+    def test_factory_starts_background_tasks_once(self):
+        self.addCleanup(kanban.backgroundTasksStarted.clear)
+        kanban.backgroundTasksStarted.clear()
+        with mock.patch.object(kanban, 'runPeriodically') as periodic, \
+                mock.patch.object(kanban.jobs, 'start') as start:
+            self.create_app(SESSION_TYPE='cookie')
+            self.assertFalse(start.called)
+            self.create_app(SESSION_TYPE='cookie', BACKGROUND_TASKS=True)
+            self.create_app(SESSION_TYPE='cookie', BACKGROUND_TASKS=True)
+        start.assert_called_once_with(app.config['JOB_WORKERS'])
+        self.assertEqual(periodic.call_count, 4)
+
+####################################################################
+# Test Section - Rate limits
+####################################################################
+    def test_memory_bucket_refills(self):
+        buckets = kanban.MemoryBuckets(maxsize=2)
+        self.assertEqual(buckets.take("a", 2, 1.0, 100), 0)
+        self.assertEqual(buckets.take("a", 2, 1.0, 100), 0)
+        self.assertEqual(buckets.take("a", 2, 1.0, 100.25), 0.75)
+        self.assertEqual(buckets.take("a", 2, 1.0, 101), 0)
+        #Full buckets are dropped to make room for new ones
+        self.assertEqual(buckets.take("b", 2, 1.0, 101), 0)
+        self.assertEqual(buckets.take("c", 2, 1.0, 103), 0)
+        self.assertEqual(sorted(buckets.buckets), ["c"])
+
+    def test_login_is_rate_limited_per_address(self):
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'login': (3, 60)})
+        kanban.metrics.reset()
+        self.insert_user("Test User", "password")
+        for i in range(3):
+            response = self.client.post('/login', data=dict(username="Test User", password="wrong"))
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post('/login', data=dict(username="Test User", password="wrong"))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '20')
+        other = self.client.post('/login', data=dict(username="Test User", password="wrong"),
+                                 environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(other.status_code, 200)
+        self.assertIn('kanban_rate_limited_total{endpoint="login"} 1', kanban.metrics.render())
+
+    def test_method_limits_leave_other_methods_alone(self):
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'POST register_page': (2, 600)})
+        for i in range(5):
+            self.assertEqual(self.client.get('/register').status_code, 200)
+        for name in ("first", "second"):
+            response = self.client.post('/register', data=dict(username=name + " user", password="password"))
+            self.assertNotEqual(response.status_code, 429)
+        self.assertEqual(self.client.post('/register', data=dict(username="third user", password="x")).status_code, 429)
+        self.assertEqual(self.client.get('/register').status_code, 200)
+
+    def test_trusted_proxy_gives_client_addresses(self):
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'POST login': (1, 60)}, TRUSTED_PROXIES=1)
+        login = lambda address: self.client.post('/login', data=dict(username="nobody", password="wrong"),
+                                                 headers={'X-Forwarded-For': address}).status_code
+        self.assertEqual(login('198.51.100.1'), 200)
+        self.assertEqual(login('198.51.100.1'), 429)
+        self.assertEqual(login('198.51.100.2'), 200)
+        #Without a trusted proxy the header is ignored, and the proxy is the client
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'POST login': (1, 60)}, TRUSTED_PROXIES=0)
+        self.assertEqual(login('198.51.100.3'), 200)
+        self.assertEqual(login('198.51.100.4'), 429)
+
+    def test_writes_are_rate_limited_per_user(self):
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'addtask': (2, 60)})
+        self.login()
+        fetch = {'X-Requested-With': 'fetch'}
+        for address in ('10.0.0.1', '10.0.0.2'):
+            response = self.client.post('/addTask/todo', data=dict(todoitem=address), headers=fetch,
+                                        environ_base={'REMOTE_ADDR': address})
+            self.assertEqual(response.status_code, 204)
+        #A new address does not help once the user ran out of tokens
+        response = self.client.post('/addTask/todo', data=dict(todoitem="more"), headers=fetch,
+                                    environ_base={'REMOTE_ADDR': '10.0.0.3'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Too many requests", response.get_json()['error'])
+        #Another user sending from the same address has buckets of their own
+        self.insert_user("Other User", "password")
+        other = app.test_client()
+        other.post('/login', data=dict(username="Other User", password="password"),
+                   environ_base={'REMOTE_ADDR': '10.0.0.4'})
+        response = other.post('/addTask/todo', data=dict(todoitem="other"), headers=fetch,
+                              environ_base={'REMOTE_ADDR': '10.0.0.4'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(kanban.Todo.query.count(), 3)
+
+    def test_redis_buckets_are_shared(self):
+        server = RedisStandIn()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'login': (2, 60)},
+                        RATE_LIMIT_STORAGE='redis', RATE_LIMIT_REDIS_URL=server.url())
+        self.assertEqual(self.client.get('/login').status_code, 200)
+        #Another worker process starts with buckets of its own in memory,
+        #but not in Redis
+        kanban.rateLimiter.reset()
+        self.assertEqual(self.client.get('/login').status_code, 200)
+        self.assertEqual(self.client.get('/login').status_code, 429)
+        self.assertIn(b'ratelimit:login:ip:127.0.0.1', server.data)
+
+    def test_unreachable_redis_lets_requests_through(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.create_app(SESSION_TYPE='cookie', RATE_LIMITS={'login': (1, 60)},
+                        RATE_LIMIT_STORAGE='redis', RATE_LIMIT_REDIS_URL='redis://127.0.0.1:%d/0' % port)
+        self.assertEqual(self.client.get('/login').status_code, 200)
+        self.assertEqual(self.client.get('/login').status_code, 200)
+
 if __name__ == '__main__':
     unittest.main()